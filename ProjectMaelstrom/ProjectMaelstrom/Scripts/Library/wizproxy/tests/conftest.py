@@ -0,0 +1,3 @@
+# wizproxy.plugin and wizproxy.core import each other, which only resolves
+# when wizproxy.core is imported first like the entry points do.
+import wizproxy.core  # noqa
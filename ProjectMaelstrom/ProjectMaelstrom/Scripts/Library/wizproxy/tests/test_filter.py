@@ -0,0 +1,168 @@
+import pytest
+
+from wizproxy.plugin import Direction, Plugin, PluginCollection, listen
+from wizproxy.plugin._filter import Filter
+from wizproxy.proto import Frame, parse_header
+
+S2C = Direction.SERVER_TO_CLIENT
+C2S = Direction.CLIENT_TO_SERVER
+
+
+def data(service_id: int, order: int, payload: bytes) -> memoryview:
+    out = bytearray()
+    Frame(b"", None, service_id, order, payload).write_into(out)
+    return memoryview(out)
+
+
+def control(opcode: int, payload: bytes) -> memoryview:
+    out = bytearray()
+    Frame(b"", opcode, None, None, payload).write_into(out)
+    return memoryview(out)
+
+
+def test_opcode():
+    flt = Filter(S2C, 3, None, None)
+
+    assert flt.accepts(3, None, None)
+    assert not flt.accepts(4, None, None)
+    assert not flt.accepts(None, 3, 1)
+
+
+def test_service_and_order():
+    flt = Filter(S2C, None, 5, 221)
+
+    assert flt.accepts(None, 5, 221)
+    assert not flt.accepts(None, 5, 220)
+    assert not flt.accepts(None, 6, 221)
+
+
+def test_service_any_order():
+    flt = Filter(S2C, None, 5, None)
+
+    assert flt.accepts(None, 5, 1)
+    assert flt.accepts(None, 5, 221)
+    assert not flt.accepts(None, 6, 1)
+
+
+def test_collections():
+    flt = Filter(S2C, None, {5, 7}, range(10, 20))
+
+    assert flt.accepts(None, 5, 10)
+    assert flt.accepts(None, 7, 19)
+    assert not flt.accepts(None, 6, 15)
+    assert not flt.accepts(None, 5, 20)
+
+    assert Filter(S2C, [0, 3], None, None).accepts(0, None, None)
+
+
+def test_unfiltered():
+    flt = Filter(C2S, None, None, None)
+
+    assert flt.accepts(3, None, None)
+    assert flt.accepts(None, 5, 221)
+    assert not flt.filters_payload
+    assert flt.accepts_payload(b"anything")
+
+
+@pytest.mark.parametrize(
+    "opcode, service_id, order",
+    [(3, 5, None), (3, 5, 1), (None, None, 1), (3, None, 1)],
+)
+def test_invalid(opcode, service_id, order):
+    with pytest.raises(ValueError):
+        Filter(S2C, opcode, service_id, order)
+
+
+def test_prefix():
+    flt = Filter(S2C, None, 5, None, prefix=b"\x01\x02")
+
+    assert flt.filters_payload
+    assert flt.accepts_payload(b"\x01\x02")
+    assert flt.accepts_payload(b"\x01\x02\x03")
+    assert flt.accepts_payload(memoryview(b"\x01\x02\x03"))
+    assert not flt.accepts_payload(b"\x01\x03\x02")
+    assert not flt.accepts_payload(b"\x01")
+    assert not flt.accepts_payload(b"")
+
+
+def test_length():
+    flt = Filter(S2C, None, 5, None, length=3)
+
+    assert flt.filters_payload
+    assert flt.accepts_payload(b"abc")
+    assert not flt.accepts_payload(b"ab")
+    assert not flt.accepts_payload(b"abcd")
+
+
+def test_length_range():
+    flt = Filter(S2C, None, 5, None, length=range(2, 4))
+
+    assert not flt.accepts_payload(b"a")
+    assert flt.accepts_payload(b"ab")
+    assert flt.accepts_payload(memoryview(b"abc"))
+    assert not flt.accepts_payload(b"abcd")
+
+
+def test_prefix_and_length():
+    flt = Filter(S2C, None, 5, None, prefix=b"ab", length={3, 5})
+
+    assert flt.accepts_payload(b"abc")
+    assert flt.accepts_payload(b"abcde")
+    assert not flt.accepts_payload(b"abcd")
+    assert not flt.accepts_payload(b"xbc")
+
+
+def test_can_dispatch():
+    flt = Filter(S2C, None, 5, 221, prefix=b"ab")
+
+    assert flt.can_dispatch(Frame.parse(data(5, 221, b"abc")))
+    assert not flt.can_dispatch(Frame.parse(data(5, 221, b"xbc")))
+    assert not flt.can_dispatch(Frame.parse(data(5, 222, b"abc")))
+
+
+class Listeners(Plugin):
+    @listen(S2C, service_id=5, order=221, prefix=b"ab")
+    async def prefixed(self, ctx, frame):
+        pass
+
+    @listen(S2C, service_id=5, length=range(0, 3))
+    async def short(self, ctx, frame):
+        pass
+
+    @listen(S2C, opcode=3)
+    async def keep_alive(self, ctx, frame):
+        pass
+
+    @listen(C2S, service_id=5)
+    async def outgoing(self, ctx, frame):
+        pass
+
+
+def selected(plugins: PluginCollection, dir: Direction, raw: memoryview) -> set[str]:
+    listeners = plugins.select(dir, raw, parse_header(raw))
+    return {listener.__name__ for _, listener, _, _, _ in listeners}
+
+
+def test_select():
+    plugins = PluginCollection()
+    plugins.add(Listeners())
+
+    assert selected(plugins, S2C, data(5, 221, b"abc")) == {"prefixed"}
+    assert selected(plugins, S2C, data(5, 221, b"ab")) == {"prefixed", "short"}
+    assert selected(plugins, S2C, data(5, 221, b"x")) == {"short"}
+    assert selected(plugins, S2C, data(5, 220, b"abc")) == set()
+    assert selected(plugins, S2C, control(3, b"")) == {"keep_alive"}
+    assert selected(plugins, C2S, data(5, 221, b"abc")) == {"outgoing"}
+
+    # Payload conditions are checked for every frame, not cached per kind.
+    assert selected(plugins, S2C, data(5, 221, b"abc")) == {"prefixed"}
+    assert selected(plugins, S2C, data(5, 221, b"xyz")) == set()
+
+
+def test_wants():
+    plugins = PluginCollection()
+    plugins.add(Listeners())
+
+    assert plugins.wants(S2C, parse_header(data(5, 221, b"xyz")))
+    assert not plugins.wants(S2C, parse_header(data(6, 1, b"abc")))
+    assert not plugins.wants(C2S, parse_header(control(3, b"")))
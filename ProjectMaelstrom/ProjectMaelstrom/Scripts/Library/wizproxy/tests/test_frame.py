@@ -0,0 +1,137 @@
+import pytest
+
+from wizproxy.proto import Bytes, Frame, parse_header
+
+
+def encode(frame: Frame) -> bytes:
+    # The original field-by-field encoder, kept as the reference format.
+    buf = Bytes()
+    payload_len = len(frame.payload)
+
+    size = 4 + payload_len
+    if frame.opcode is None:
+        size += 5
+
+    buf.write_u16(0xF00D)
+    if size < 0x8000:
+        buf.write_u16(size)
+    else:
+        buf.write_u16(0x8000)
+        buf.write_u32(size)
+
+    is_control = frame.opcode is not None
+
+    buf.write_u8(1 if is_control else 0)
+    buf.write_u8(frame.opcode or 0)
+    buf.write_u16(0)
+
+    if is_control:
+        buf.write(frame.payload)
+    else:
+        buf.write_u8(frame.service_id)
+        buf.write_u8(frame.order)
+        buf.write_u16(payload_len + 4)
+        buf.write(frame.payload)
+        buf.write_u8(0)
+
+    return buf.getvalue()
+
+
+def control(opcode: int, payload: bytes) -> Frame:
+    return Frame(b"", opcode, None, None, payload)
+
+
+def data(service_id: int, order: int, payload: bytes) -> Frame:
+    return Frame(b"", None, service_id, order, payload)
+
+
+# Sizes around the boundary at which frames carry a 32-bit size. Data frames
+# repeat their payload length in 16 bits, which limits them further.
+PAYLOAD_SIZES = [0, 1, 100, 0x8000 - 10, 0x8000 - 9, 0x8000 - 4, 0x8000]
+
+FRAMES = [
+    *(control(3, bytes(i % 251 for i in range(n))) for n in PAYLOAD_SIZES + [0x12345]),
+    *(data(5, 221, bytes(i % 253 for i in range(n))) for n in PAYLOAD_SIZES + [0xFFFB]),
+]
+
+
+def frame_id(frame: Frame) -> str:
+    kind = "control" if frame.opcode is not None else "data"
+    return f"{kind}-{len(frame.payload)}"
+
+
+@pytest.mark.parametrize("frame", FRAMES, ids=frame_id)
+def test_write_into_matches_encoder(frame: Frame):
+    out = bytearray()
+    written = frame.write_into(out)
+
+    assert written == len(out)
+    assert out == encode(frame)
+
+
+@pytest.mark.parametrize("frame", FRAMES, ids=frame_id)
+def test_write_matches_encoder(frame: Frame):
+    buf = Bytes()
+    written = frame.write(buf)
+
+    assert written == len(buf.getvalue())
+    assert buf.getvalue() == encode(frame)
+
+
+def test_write_into_reused_buffer():
+    out = bytearray(b"\xff" * 0x10000)
+    frames = FRAMES[:4] + FRAMES[-4:]
+
+    offset = 7
+    for frame in frames:
+        written = frame.write_into(out, offset)
+
+        assert written == len(encode(frame))
+        offset += written
+
+    # Frames are written back to back and the buffer is grown as needed.
+    assert out[:7] == b"\xff" * 7
+    assert out[7:offset] == b"".join(encode(frame) for frame in frames)
+    assert len(out) >= max(offset, 0x10000)
+
+
+@pytest.mark.parametrize("frame", FRAMES, ids=frame_id)
+def test_parse_header_round_trip(frame: Frame):
+    raw = memoryview(encode(frame))
+    opcode, service_id, order, start, end = parse_header(raw)
+
+    assert (opcode, service_id, order) == (frame.opcode, frame.service_id, frame.order)
+    assert raw[start:end] == frame.payload
+
+
+@pytest.mark.parametrize("frame", FRAMES, ids=frame_id)
+def test_parse_round_trip(frame: Frame):
+    raw = encode(frame)
+    parsed = Frame.parse(raw)
+
+    assert parsed.opcode == frame.opcode
+    assert parsed.service_id == frame.service_id
+    assert parsed.order == frame.order
+    assert parsed.payload == frame.payload
+    assert parsed.original == raw
+
+    out = bytearray()
+    parsed.write_into(out)
+    assert out == raw
+
+
+def test_parse_with_header():
+    raw = encode(data(7, 2, b"hello"))
+    header = parse_header(memoryview(raw))
+
+    assert Frame.parse(raw, header).payload == b"hello"
+
+
+def test_changed_payload_is_written():
+    parsed = Frame.parse(encode(data(5, 221, b"before")))
+    parsed.payload = b"after, but longer"
+
+    out = bytearray()
+    parsed.write_into(out)
+
+    assert out == encode(data(5, 221, b"after, but longer"))
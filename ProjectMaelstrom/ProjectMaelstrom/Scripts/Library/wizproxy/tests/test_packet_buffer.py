@@ -0,0 +1,238 @@
+import random
+from typing import Optional
+
+import pytest
+
+from wizproxy.crypto import AesContext
+from wizproxy.proto import Frame
+from wizproxy.transport.packet_buffer import LARGE_HEAD_SIZE, PacketBuffer
+
+KEY = bytes(range(16))
+NONCE = bytes(range(16, 32))
+
+
+def data(service_id: int, order: int, payload: bytes) -> bytes:
+    out = bytearray()
+    Frame(b"", None, service_id, order, payload).write_into(out)
+    return bytes(out)
+
+
+def aes_pair() -> tuple[AesContext, AesContext]:
+    # Client chunks are small, so frames cross many nonce rotations.
+    return AesContext.client(KEY, NONCE), AesContext.client(KEY, NONCE)
+
+
+def chunks(raw: bytes, seed: int, max_size: int = 700) -> list[bytes]:
+    rng = random.Random(seed)
+
+    res = []
+    pos = 0
+    while pos < len(raw):
+        size = rng.randint(1, max_size)
+        res.append(raw[pos : pos + size])
+        pos += size
+
+    return res
+
+
+def drain(
+    buffer: PacketBuffer, aes: Optional[AesContext] = None, stream=None
+) -> list[tuple[bool, bool, bytes]]:
+    res = []
+    while (frame := buffer.poll_frame(aes, stream)) is not None:
+        encrypted, raw = frame
+        res.append((encrypted, buffer.partial, bytes(raw)))
+
+    return res
+
+
+def receive(
+    pieces: list[bytes], aes: Optional[AesContext] = None, stream=None
+) -> list[tuple[bool, bool, bytes]]:
+    buffer = PacketBuffer()
+
+    res = []
+    for piece in pieces:
+        buffer.feed(piece)
+        res.extend(drain(buffer, aes, stream))
+
+    assert buffer.buf_len == 0
+    return res
+
+
+FRAMES = [data(5, i, bytes(range(i)) * 3) for i in range(1, 60)]
+
+
+def test_frames_in_one_feed():
+    assert receive([b"".join(FRAMES)]) == [(False, False, f) for f in FRAMES]
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_frames_split_across_feeds(seed: int):
+    pieces = chunks(b"".join(FRAMES), seed, max_size=40)
+
+    assert receive(pieces) == [(False, False, f) for f in FRAMES]
+
+
+def test_frames_fed_bytewise():
+    raw = b"".join(FRAMES[:5])
+    pieces = [raw[i : i + 1] for i in range(len(raw))]
+
+    assert receive(pieces) == [(False, False, f) for f in FRAMES[:5]]
+
+
+def test_held_views_survive_feed():
+    buffer = PacketBuffer()
+    buffer.feed(FRAMES[0] + FRAMES[1][:5])
+
+    _, view = buffer.poll_frame(None)
+    assert buffer.poll_frame(None) is None
+
+    # The held view pins the buffer, so feeding has to move the unread
+    # data elsewhere instead of resizing the memory under the view.
+    buffer.feed(FRAMES[1][5:] + FRAMES[2])
+    assert view.obj is not buffer.buf
+    assert view == FRAMES[0]
+
+    # Keep every frame alive while more data keeps coming in.
+    held = [view]
+    for frame in FRAMES[3:20]:
+        held.append(buffer.poll_frame(None)[1])
+        buffer.feed(frame)
+    while (res := buffer.poll_frame(None)) is not None:
+        held.append(res[1])
+
+    assert [bytes(v) for v in held] == FRAMES[:20]
+
+
+def test_views_released_allow_reuse():
+    buffer = PacketBuffer()
+
+    for frame in FRAMES:
+        buffer.feed(frame)
+        with buffer.poll_frame(None)[1] as view:
+            assert view == frame
+
+    assert buffer.pos == len(FRAMES[-1])
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_encrypted_frames(seed: int):
+    sender, receiver = aes_pair()
+
+    # The handshake is in plaintext, everything after it is encrypted.
+    raw = FRAMES[0] + sender.encrypt(b"".join(FRAMES[1:]))
+
+    assert receive(chunks(raw, seed), receiver) == [
+        (False, False, FRAMES[0]),
+        *((True, False, f) for f in FRAMES[1:]),
+    ]
+
+
+def test_invalid_magic():
+    buffer = PacketBuffer()
+    buffer.feed(b"\x0e\xf0" + FRAMES[0][2:])
+
+    with pytest.raises(ValueError):
+        buffer.poll_frame(None)
+
+
+LARGE = data(5, 221, bytes(i % 241 for i in range(0xC000)))
+SMALL = FRAMES[10]
+
+
+def never(head: memoryview, size: int) -> bool:
+    return False
+
+
+def always(head: memoryview, size: int) -> bool:
+    return True
+
+
+@pytest.mark.parametrize("stream", [None, never])
+def test_large_frame_buffered(stream):
+    pieces = chunks(SMALL + LARGE + SMALL, 0, max_size=0x3000)
+
+    assert receive(pieces, stream=stream) == [
+        (False, False, SMALL),
+        (False, False, LARGE),
+        (False, False, SMALL),
+    ]
+
+
+@pytest.mark.parametrize("stream", [None, never])
+def test_encrypted_large_frame_buffered(stream):
+    sender, receiver = aes_pair()
+    pieces = chunks(sender.encrypt(SMALL + LARGE + SMALL), 0, max_size=0x3000)
+
+    assert receive(pieces, receiver, stream) == [
+        (True, False, SMALL),
+        (True, False, LARGE),
+        (True, False, SMALL),
+    ]
+
+
+def test_stream_predicate_arguments():
+    calls = []
+
+    def stream(head: memoryview, size: int) -> bool:
+        calls.append((bytes(head), size))
+        return False
+
+    receive([SMALL, LARGE[:10], LARGE[10:], LARGE], stream=stream)
+
+    # Small frames are never asked about, large ones exactly once each.
+    assert calls == [(LARGE[:LARGE_HEAD_SIZE], len(LARGE))] * 2
+
+
+def split_stream(frames: list[tuple[bool, bool, bytes]], encrypted: bool):
+    # Joins the pieces of streamed frames back together.
+    res = []
+    pieces = []
+    for enc, partial, raw in frames:
+        assert enc == encrypted
+        if partial:
+            pieces.append(raw)
+            continue
+
+        if pieces:
+            res.append(b"".join(pieces))
+            pieces = []
+        res.append(raw)
+
+    if pieces:
+        res.append(b"".join(pieces))
+    return res
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_stream_large_frame(seed: int):
+    pieces = chunks(SMALL + LARGE + SMALL, seed, max_size=0x3000)
+    frames = receive(pieces, stream=always)
+
+    # The large frame is handed out in several pieces as data arrives.
+    assert sum(partial for _, partial, _ in frames) > 1
+    assert frames[0] == (False, False, SMALL)
+    assert frames[-1] == (False, False, SMALL)
+    assert split_stream(frames, False) == [SMALL, LARGE, SMALL]
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_stream_encrypted_large_frame(seed: int):
+    sender, receiver = aes_pair()
+    pieces = chunks(sender.encrypt(SMALL + LARGE + SMALL), seed, max_size=0x3000)
+    frames = receive(pieces, receiver, always)
+
+    assert sum(partial for _, partial, _ in frames) > 1
+    assert frames[0] == (True, False, SMALL)
+    assert frames[-1] == (True, False, SMALL)
+    assert split_stream(frames, True) == [SMALL, LARGE, SMALL]
+
+
+def test_stream_consecutive_large_frames():
+    sender, receiver = aes_pair()
+    pieces = chunks(sender.encrypt(LARGE * 3), 0, max_size=0x1000)
+    frames = receive(pieces, receiver, always)
+
+    assert b"".join(raw for _, _, raw in frames) == LARGE * 3
+    assert all(partial for _, partial, _ in frames)
@@ -0,0 +1,187 @@
+from types import SimpleNamespace
+from typing import Optional
+
+import pytest
+import trio
+import trio.testing
+
+from wizproxy.crypto import AesContext
+from wizproxy.proto import Frame
+from wizproxy.transport.writer import FrameWriter
+
+KEY = bytes(range(16))
+NONCE = bytes(range(16, 32))
+
+
+class Stream:
+    """Records what is sent, optionally failing the next send."""
+
+    def __init__(self):
+        self.sent = []
+        self.fail = False
+
+    async def send_all(self, data):
+        if self.fail:
+            self.fail = False
+            raise trio.BrokenResourceError
+
+        self.sent.append(bytes(data))
+
+
+def writer(aes: Optional[AesContext] = None, **kwargs) -> tuple[FrameWriter, Stream]:
+    stream = Stream()
+    session = SimpleNamespace(client_aes=aes, server_aes=None)
+    return FrameWriter(stream, session, True, **kwargs), stream
+
+
+def run(main):
+    # A mock clock only moves forward when told to.
+    clock = trio.testing.MockClock()
+    trio.run(main, clock, clock=clock)
+
+
+FRAMES = [bytes([i]) * (i + 10) for i in range(10)]
+
+
+def test_coalesce():
+    async def main(clock):
+        w, stream = writer(max_delay=1.0)
+        for frame in FRAMES:
+            await w.write(False, frame)
+
+        assert stream.sent == []
+        await w.flush()
+        assert stream.sent == [b"".join(FRAMES)]
+
+        # There is nothing left to flush.
+        await w.flush()
+        assert len(stream.sent) == 1
+
+    run(main)
+
+
+def test_flush_on_delay():
+    async def main(clock):
+        w, stream = writer(max_delay=0.01)
+        await w.write(False, FRAMES[0])
+        await w.write(False, FRAMES[1])
+        assert stream.sent == []
+
+        # A frame written after the delay passed flushes the whole batch.
+        clock.jump(0.01)
+        await w.write(False, FRAMES[2])
+        assert stream.sent == [b"".join(FRAMES[:3])]
+
+        # The delay starts over with the next batch.
+        await w.write(False, FRAMES[3])
+        clock.jump(0.005)
+        await w.write(False, FRAMES[4])
+        assert len(stream.sent) == 1
+
+        clock.jump(0.005)
+        await w.write(False, FRAMES[5])
+        assert stream.sent[1:] == [b"".join(FRAMES[3:6])]
+
+    run(main)
+
+
+def test_no_delay():
+    async def main(clock):
+        w, stream = writer(max_delay=0)
+        for frame in FRAMES:
+            await w.write(False, frame)
+
+        assert stream.sent == FRAMES
+
+    run(main)
+
+
+def test_flush_on_size():
+    async def main(clock):
+        w, stream = writer(max_delay=1.0, max_bytes=46)
+        for frame in FRAMES[:5]:
+            await w.write(False, frame)
+
+        # 10 + 11 + 12 + 13 bytes reach the limit, 14 are still pending.
+        assert stream.sent == [b"".join(FRAMES[:4])]
+        await w.flush()
+        assert stream.sent[1:] == [FRAMES[4]]
+
+    run(main)
+
+
+def test_oversized_write():
+    async def main(clock):
+        w, stream = writer(max_delay=1.0, max_bytes=50)
+        large = b"x" * 60
+
+        await w.write(False, FRAMES[0])
+        await w.write(False, large)
+        await w.write(False, FRAMES[1])
+
+        # Pending frames go out first, the large one is sent on its own.
+        assert stream.sent == [FRAMES[0], large]
+        await w.flush()
+        assert stream.sent[2:] == [FRAMES[1]]
+
+    run(main)
+
+
+def test_encrypted_batches():
+    async def main(clock):
+        w, stream = writer(AesContext.client(KEY, NONCE), max_delay=1.0)
+        receiver = AesContext.client(KEY, NONCE)
+
+        # A batch is either plaintext or encrypted, never both.
+        await w.write(False, FRAMES[0])
+        await w.write(True, FRAMES[1])
+        assert stream.sent == [FRAMES[0]]
+
+        for frame in FRAMES[2:]:
+            await w.write(True, frame)
+        await w.flush()
+        assert len(stream.sent) == 2
+
+        # Encrypting the batch at once matches encrypting frames one by one.
+        reference = AesContext.client(KEY, NONCE)
+        assert stream.sent[1] == b"".join(reference.encrypt(f) for f in FRAMES[1:])
+        assert receiver.decrypt(stream.sent[1]) == b"".join(FRAMES[1:])
+
+    run(main)
+
+
+def test_write_frame():
+    async def main(clock):
+        w, stream = writer(max_delay=1.0)
+        frame = Frame(b"", None, 5, 221, b"payload")
+
+        await w.write(False, FRAMES[0])
+        await w.write_frame(False, frame)
+        await w.flush()
+
+        raw = bytearray()
+        frame.write_into(raw)
+        assert stream.sent == [FRAMES[0] + raw]
+
+    run(main)
+
+
+def test_failed_send_releases_buffer():
+    async def main(clock):
+        w, stream = writer(max_delay=1.0)
+        await w.write(False, FRAMES[0])
+
+        stream.fail = True
+        with pytest.raises(trio.BrokenResourceError) as error:
+            await w.flush()
+
+        # The batch buffer must not stay pinned by a view while the error
+        # and its traceback are still around, or it could never grow for
+        # the next, larger batch.
+        assert error.traceback
+        for frame in FRAMES:
+            await w.write(False, frame * 10)
+        await w.flush()
+        assert stream.sent == [b"".join(frame * 10 for frame in FRAMES)]
+
+    run(main)
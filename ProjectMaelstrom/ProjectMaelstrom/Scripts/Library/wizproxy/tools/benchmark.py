@@ -0,0 +1,438 @@
+"""
+Loopback throughput and latency benchmarks for the proxy.
+
+A stand-in game server and a synthetic client are run on loopback and
+exchange 0xF00D control and data frames, either directly or through a
+:class:`Proxy` shard. Frames can optionally be AES-GCM encrypted; the
+client hands a session key to the proxy and the server in a plaintext
+control frame instead of going through the RSA handshake.
+
+Every combination of frame size mix, plugin count and encryption mode
+is measured for server-to-client throughput and for the latency the
+proxy adds on top of a direct connection. Latency is sampled on a
+direct and a proxied connection in turns, and the added latency is
+taken from the differences of each such pair. Results are written as
+JSON to track regressions over time.
+
+Server, client and proxy share one process, so absolute numbers
+include the cost of the stand-ins and are only comparable between
+runs on the same machine.
+
+Usage: python tools/benchmark.py --help
+"""
+
+import json
+import os
+import platform
+import random
+import statistics
+import time
+from datetime import datetime, timezone
+from functools import partial
+from pathlib import Path
+from struct import Struct
+from typing import Any, Optional
+
+import click
+import trio
+from loguru import logger
+
+from wizproxy.core import Proxy
+from wizproxy.crypto import AesContext
+from wizproxy.plugin import Context, Direction, Plugin, listen
+from wizproxy.proto import Bytes, Frame, SocketAddress
+from wizproxy.transport.packet_buffer import PacketBuffer
+
+# Control opcode of the frame that tells everyone about the session key.
+# The payload is a mode byte, followed by the AES key and nonce if enabled.
+KEY_OPCODE = 0xB0
+
+# Control opcode and service of the generated frames. These must not
+# collide with anything the built-in plugin listens to.
+CONTROL_OPCODE = 3
+DATA_SERVICE = 0x7E
+
+# Service order of the frames used for latency measurements.
+ORDER_PING = 1
+ORDER_REQUEST = 2
+
+MODE_THROUGHPUT = 0
+MODE_LATENCY = 1
+
+# Nanosecond timestamp at the start of latency frame payloads.
+TIMESTAMP = Struct("<Q")
+
+# Payload sizes to choose from for each frame size mix.
+SIZE_MIXES = {
+    "small": (16, 64, 128, 256),
+    "mixed": (16, 64, 256, 1024, 4096),
+    "large": (256, 4096, 0x9000),
+}
+
+ENCRYPTION_MODES = ("plain", "aes")
+
+# Frames per write of the stand-in server during throughput runs.
+SEND_BATCH = 64
+
+# How often a measurement is attempted before giving up.
+ATTEMPTS = 3
+
+# Seconds after which a measurement is considered stuck.
+ATTEMPT_TIMEOUT = 60
+
+
+def encode_frame(opcode: Optional[int], order: int, payload: bytes) -> bytes:
+    buf = Bytes()
+    Frame(
+        b"", opcode, None if opcode is not None else DATA_SERVICE, order, payload
+    ).write(buf)
+    return buf.getvalue()
+
+
+def build_frames(count: int, mix: str, rng: random.Random) -> list[bytes]:
+    sizes = SIZE_MIXES[mix]
+    frames = []
+
+    for i in range(count):
+        payload = rng.randbytes(rng.choice(sizes))
+
+        # Every eighth frame is a control frame, the rest are data frames.
+        if i % 8 == 0:
+            frames.append(encode_frame(CONTROL_OPCODE, 0, payload))
+        else:
+            frames.append(encode_frame(None, rng.randrange(3, 256), payload))
+
+    return frames
+
+
+class KeyPlugin(Plugin):
+    """Installs the benchmark session key instead of a real handshake."""
+
+    @listen(Direction.CLIENT_TO_SERVER, opcode=KEY_OPCODE, dirty=False)
+    async def install_key(self, ctx: Context, frame: Frame):
+        payload = frame.payload
+        if len(payload) >= 33:
+            key, nonce = payload[1:17], payload[17:33]
+            ctx.session.client_aes = AesContext.client(key, nonce)
+            ctx.session.server_aes = AesContext.server(key, nonce)
+
+
+class NoopPlugin(Plugin):
+    """Listens to every benchmark frame without doing anything."""
+
+    @listen(Direction.SERVER_TO_CLIENT, dirty=False)
+    async def serverbound(self, ctx: Context, frame: Frame):
+        pass
+
+    @listen(Direction.CLIENT_TO_SERVER, dirty=False)
+    async def clientbound(self, ctx: Context, frame: Frame):
+        pass
+
+
+class Endpoint:
+    """One side of a benchmark connection, speaking the frame protocol."""
+
+    def __init__(self, stream: trio.SocketStream):
+        self.stream = stream
+        self.buffer = PacketBuffer()
+
+        self.rx: Optional[AesContext] = None
+        self.tx: Optional[AesContext] = None
+
+    async def receive(self) -> memoryview:
+        while (res := self.buffer.poll_frame(self.rx)) is None:
+            data = await self.stream.receive_some()
+            if not data:
+                raise trio.BrokenResourceError("connection closed")
+
+            self.buffer.feed(data)
+
+        return res[1]
+
+    async def send(self, raw: bytes):
+        if self.tx is not None:
+            raw = self.tx.encrypt(raw)
+
+        await self.stream.send_all(raw)
+
+
+class StandInServer:
+    """
+    A KingsIsle-style game server that streams prepared frames.
+
+    The first frame of every connection decides what happens: in
+    throughput mode, all frames are streamed to the client as fast as
+    possible. In latency mode, a timestamped frame is sent whenever the
+    client requests one.
+    """
+
+    def __init__(self, frames: list[bytes], samples: int):
+        self.frames = frames
+        self.samples = samples
+
+    async def handle(self, stream: trio.SocketStream):
+        try:
+            await self._serve(Endpoint(stream))
+
+            # Wait for the client to hang up.
+            with trio.move_on_after(5):
+                await stream.receive_some()
+        except (trio.BrokenResourceError, trio.ClosedResourceError):
+            # The client gave up on us; see _attempt.
+            pass
+
+        await stream.aclose()
+
+    async def _serve(self, endpoint: Endpoint):
+        hello = Frame.parse(await endpoint.receive())
+        payload = hello.payload
+
+        mode = payload[0]
+        if len(payload) >= 33:
+            key, nonce = payload[1:17], payload[17:33]
+            endpoint.rx = AesContext.client(key, nonce)
+            endpoint.tx = AesContext.server(key, nonce)
+
+        if mode == MODE_THROUGHPUT:
+            for i in range(0, len(self.frames), SEND_BATCH):
+                await endpoint.send(b"".join(self.frames[i : i + SEND_BATCH]))
+        else:
+            padding = bytes(64)
+            for _ in range(self.samples):
+                await endpoint.receive()
+
+                stamp = TIMESTAMP.pack(time.perf_counter_ns())
+                await endpoint.send(encode_frame(None, ORDER_PING, stamp + padding))
+
+
+async def _connect(
+    addr: SocketAddress, mode: int, encrypted: bool
+) -> tuple[Endpoint, trio.SocketStream]:
+    stream = await trio.open_tcp_stream(addr.ip.decode(), addr.port)
+    endpoint = Endpoint(stream)
+
+    payload = bytes([mode])
+    if encrypted:
+        key, nonce = os.urandom(16), os.urandom(16)
+        payload += key + nonce
+
+    await endpoint.send(encode_frame(KEY_OPCODE, 0, payload))
+
+    if encrypted:
+        endpoint.rx = AesContext.server(key, nonce)
+        endpoint.tx = AesContext.client(key, nonce)
+
+    return endpoint, stream
+
+
+async def measure_throughput(
+    addr: SocketAddress, frames: list[bytes], encrypted: bool
+) -> dict:
+    endpoint, stream = await _connect(addr, MODE_THROUGHPUT, encrypted)
+
+    start = time.perf_counter()
+    for _ in range(len(frames)):
+        await endpoint.receive()
+    elapsed = time.perf_counter() - start
+
+    await stream.aclose()
+
+    size = sum(map(len, frames))
+    return {
+        "frames": len(frames),
+        "bytes": size,
+        "seconds": elapsed,
+        "frames_per_second": len(frames) / elapsed,
+        "mb_per_second": size / elapsed / 1e6,
+    }
+
+
+async def _ping(endpoint: Endpoint) -> int:
+    await endpoint.send(encode_frame(None, ORDER_REQUEST, b"ping"))
+
+    frame = Frame.parse(await endpoint.receive())
+    return time.perf_counter_ns() - TIMESTAMP.unpack_from(frame.payload)[0]
+
+
+async def measure_latency(
+    direct_addr: SocketAddress,
+    proxied_addr: SocketAddress,
+    samples: int,
+    encrypted: bool,
+) -> tuple[list[int], list[int]]:
+    direct, direct_stream = await _connect(direct_addr, MODE_LATENCY, encrypted)
+    proxied, proxied_stream = await _connect(proxied_addr, MODE_LATENCY, encrypted)
+
+    # Samples are taken in pairs of the same frame, sent directly and through
+    # the proxy right after another, so both see the same conditions. Which
+    # one goes first alternates so neither is favored.
+    direct_latencies, proxied_latencies = [], []
+    for i in range(samples):
+        if i % 2:
+            proxied_latencies.append(await _ping(proxied))
+            direct_latencies.append(await _ping(direct))
+        else:
+            direct_latencies.append(await _ping(direct))
+            proxied_latencies.append(await _ping(proxied))
+
+    await direct_stream.aclose()
+    await proxied_stream.aclose()
+
+    return direct_latencies, proxied_latencies
+
+
+async def _attempt(measure, *args) -> tuple[Any, int]:
+    # Receivers tell plaintext frames apart from encrypted ones by their
+    # magic, so roughly one in 65536 encrypted frames is misread when its
+    # ciphertext happens to start with it. Depending on the garbage size
+    # read from it, the connection is dropped, the stand-in endpoints fail
+    # to parse what they receive or wait for data that never arrives.
+    # Such runs are repeated with a fresh session key, but counted so the
+    # failures still show up next to the results.
+    failures = 0
+    while True:
+        try:
+            with trio.fail_after(ATTEMPT_TIMEOUT):
+                return await measure(*args), failures
+        except (trio.BrokenResourceError, trio.TooSlowError, ValueError) as e:
+            logger.opt(exception=e).debug("Benchmark attempt failed")
+
+            failures += 1
+            if failures == ATTEMPTS:
+                raise
+
+
+def _percentiles(latencies: list[int]) -> tuple[float, float]:
+    cuts = statistics.quantiles(latencies, n=100)
+    return cuts[49] / 1000, cuts[98] / 1000
+
+
+async def run_scenario(
+    mix: str, plugins: int, encryption: str, frame_count: int, samples: int, seed: int
+) -> dict:
+    frames = build_frames(frame_count, mix, random.Random(seed))
+    server = StandInServer(frames, samples)
+    encrypted = encryption == "aes"
+
+    async with trio.open_nursery() as nursery:
+        serve_tcp = partial(trio.serve_tcp, host="127.0.0.1")
+        listeners = await nursery.start(serve_tcp, server.handle, 0)
+        server_port = listeners[0].socket.getsockname()[1]
+        server_addr = SocketAddress("127.0.0.1", server_port)
+
+        proxy = Proxy("127.0.0.1", None, None, nursery)
+        proxy.add_plugin(KeyPlugin())
+        for _ in range(plugins):
+            proxy.add_plugin(NoopPlugin())
+        shard_addr = await proxy.spawn_shard(server_addr)
+
+        throughput, throughput_failures = await _attempt(
+            measure_throughput, shard_addr, frames, encrypted
+        )
+        (direct, proxied), latency_failures = await _attempt(
+            measure_latency, server_addr, shard_addr, samples, encrypted
+        )
+
+        nursery.cancel_scope.cancel()
+
+    direct_p50, direct_p99 = _percentiles(direct)
+    proxied_p50, proxied_p99 = _percentiles(proxied)
+    added_p50, added_p99 = _percentiles([p - d for d, p in zip(direct, proxied)])
+
+    return {
+        "mix": mix,
+        "plugins": plugins,
+        "encryption": encryption,
+        "failed_attempts": throughput_failures + latency_failures,
+        "throughput": throughput,
+        "latency_us": {
+            "direct_p50": direct_p50,
+            "direct_p99": direct_p99,
+            "proxied_p50": proxied_p50,
+            "proxied_p99": proxied_p99,
+            "added_p50": added_p50,
+            "added_p99": added_p99,
+        },
+    }
+
+
+@click.command()
+@click.option(
+    "-m",
+    "--mix",
+    "mixes",
+    multiple=True,
+    type=click.Choice(list(SIZE_MIXES)),
+    help="Frame size mixes to run. Defaults to all.",
+)
+@click.option(
+    "-p",
+    "--plugins",
+    "plugin_counts",
+    multiple=True,
+    type=int,
+    help="Numbers of no-op plugins to load. Defaults to 0 and 4.",
+)
+@click.option(
+    "-e",
+    "--encryption",
+    "encryption_modes",
+    multiple=True,
+    type=click.Choice(ENCRYPTION_MODES),
+    help="Encryption modes to run. Defaults to all.",
+)
+@click.option(
+    "--frames", default=20000, show_default=True, help="Frames per throughput run"
+)
+@click.option(
+    "--samples", default=2000, show_default=True, help="Frames per latency run"
+)
+@click.option(
+    "--seed", default=0x101, show_default=True, help="Seed for frame generation"
+)
+@click.option(
+    "-o",
+    "--output",
+    type=click.Path(dir_okay=False, path_type=Path),
+    default="benchmark.json",
+    show_default=True,
+    help="The JSON file to write results to.",
+)
+def main(mixes, plugin_counts, encryption_modes, frames, samples, seed, output):
+    """Benchmarks proxy throughput and added latency over loopback."""
+    logger.disable("wizproxy")
+
+    results = []
+    for mix in mixes or SIZE_MIXES:
+        for plugins in plugin_counts or (0, 4):
+            for encryption in encryption_modes or ENCRYPTION_MODES:
+                result = trio.run(
+                    run_scenario, mix, plugins, encryption, frames, samples, seed
+                )
+                results.append(result)
+
+                throughput = result["throughput"]
+                latency = result["latency_us"]
+                click.echo(
+                    f"{mix:>6} plugins={plugins} {encryption:>5}: "
+                    f"{throughput['frames_per_second']:>9.0f} frames/s "
+                    f"{throughput['mb_per_second']:>7.2f} MB/s "
+                    f"added p50={latency['added_p50']:.0f}us "
+                    f"p99={latency['added_p99']:.0f}us "
+                    f"failed attempts={result['failed_attempts']}"
+                )
+
+    report = {
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "frames": frames,
+        "samples": samples,
+        "seed": seed,
+        "results": results,
+    }
+    output.write_text(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
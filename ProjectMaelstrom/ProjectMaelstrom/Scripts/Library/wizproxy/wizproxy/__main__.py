@@ -8,12 +8,26 @@ import click
 import trio
 from loguru import logger
 
-from .core import Proxy
+from .core import Proxy, Supervisor, WorkerLink, WorkerProxy
 from .crypto import KeyChain
+from .metrics import Metrics
 from .plugin.log import VerboseLogPlugin
-from .plugin.scapy import ScapyPlugin
-from .proto import SocketAddress
+from .plugin.pcapng import PcapNgPlugin
+from .plugin.record import RecordPlugin
+from .proto import Frame, MessageRegistry, SocketAddress
+from .record import Compression
 from .session import ClientSig
+from .tracing import EXPORT_INTERVAL, Tracer
+from .transport.writer import MAX_DELAY
+
+
+def _worker_path(path: Path, index: int) -> Path:
+    if path.is_dir():
+        path = path / f"worker{index}"
+        path.mkdir(exist_ok=True)
+        return path
+    else:
+        return path.with_name(f"{path.stem}.worker{index}{path.suffix}")
 
 
 async def main(
@@ -21,7 +35,18 @@ async def main(
     host: Optional[str],
     login: SocketAddress,
     capture: Optional[Path],
+    record: Optional[Path],
+    compression: Compression,
+    messages: Optional[Path],
     verbose: bool,
+    metrics_port: Optional[int],
+    metrics_interval: Optional[float],
+    shard_pool: int,
+    shard_ttl: Optional[float],
+    trace_every: Optional[int],
+    trace_export: Optional[Path],
+    batch_delay: float,
+    link: Optional[WorkerLink] = None,
 ):
     key_chain = KeyChain(
         json.loads((key_dir / "ki_keys.json").read_text()),
@@ -34,6 +59,14 @@ async def main(
     else:
         client_sig = None
 
+    # If requested, make message fields available to plugins.
+    if messages is not None:
+        registry = MessageRegistry()
+        registry.load_dir(messages)
+
+        logger.info(f"Loaded {len(registry)} message definitions")
+        Frame.registry = registry
+
     if host is None and platform.system() == "Windows":
         # Windows default wildcard interface behaves funky and
         # "0.0.0.0" causes trouble when the game client attempts
@@ -44,30 +77,89 @@ async def main(
         # on Windows.
         host = socket.gethostbyname(socket.gethostname())
 
+    if link is not None:
+        # Every worker writes its own files and serves its own metrics.
+        if capture is not None:
+            capture = _worker_path(capture, link.index)
+        if record is not None:
+            record = _worker_path(record, link.index)
+        if metrics_port is not None:
+            metrics_port += link.index
+        if trace_export is not None:
+            trace_export = _worker_path(trace_export, link.index)
+
+    # If requested, sample latency traces of frames.
+    if trace_every is not None or trace_export is not None:
+        tracer = Tracer(trace_every or 100)
+    else:
+        tracer = None
+
+    # Only pay for collecting metrics when somebody looks at them.
+    if metrics_port is not None or metrics_interval is not None or tracer is not None:
+        metrics = Metrics(tracer)
+    else:
+        metrics = None
+
     async with trio.open_nursery() as nursery:
-        proxy = Proxy(host, key_chain, client_sig, nursery)
+        options = dict(
+            max_batch_delay=batch_delay,
+            metrics=metrics,
+            pool_size=shard_pool,
+            shard_ttl=shard_ttl,
+        )
+        if link is None:
+            proxy = Proxy(host, key_chain, client_sig, nursery, **options)
+        else:
+            proxy = WorkerProxy(link, host, key_chain, client_sig, nursery, **options)
 
-        # If requested, enable the scapy plugin.
+        # If requested, enable the capture plugin.
         if capture is not None:
-            scapy = ScapyPlugin.from_file(capture)
+            pcapng = PcapNgPlugin.from_file(capture)
 
             logger.info(f"Capturing packets to {capture.resolve()}")
-            proxy.add_plugin(scapy)
+            proxy.add_plugin(pcapng)
+        else:
+            pcapng = None
+
+        # If requested, enable the traffic log.
+        if record is not None:
+            recorder = RecordPlugin.from_file(record, compression)
+
+            logger.info(f"Recording traffic to {recorder.writer.path}")
+            proxy.add_plugin(recorder)
         else:
-            scapy = None
+            recorder = None
 
         # If requested, enable verbose packet logging.
         if verbose:
             proxy.add_plugin(VerboseLogPlugin())
 
+        # If requested, expose runtime metrics to scrapers and/or the log.
+        if metrics_port is not None:
+            await nursery.start(metrics.serve, host, metrics_port)
+            logger.info(f"Serving metrics on port {metrics_port}")
+        if metrics_interval is not None:
+            nursery.start_soon(metrics.log_every, metrics_interval)
+        if trace_export is not None:
+            nursery.start_soon(tracer.export_every, trace_export, EXPORT_INTERVAL)
+            logger.info(f"Exporting latency traces to {trace_export.resolve()}")
+
         # Spawn the initial shard to proxy the login server.
-        await proxy.spawn_shard(login)
+        # With workers, the supervisor takes care of that.
+        if link is None:
+            await proxy.spawn_shard(login, persistent=True)
 
         try:
             await proxy.run()
         finally:
-            if scapy is not None:
-                scapy.writer.close()
+            if pcapng is not None:
+                pcapng.close()
+            if recorder is not None:
+                recorder.close()
+
+
+def work(link: WorkerLink, *args):
+    trio.run(main, *args, link)
 
 
 @click.command()
@@ -96,13 +188,97 @@ async def main(
     type=click.Path(path_type=Path),
     help="Captures packets to a pcapng file.",
 )
+@click.option(
+    "-r",
+    "--record",
+    type=click.Path(path_type=Path),
+    help="Records frames to an indexed traffic log.",
+)
+@click.option(
+    "--compression",
+    type=click.Choice([c.name.lower() for c in Compression]),
+    default="zlib",
+    show_default=True,
+    help="How to compress the traffic log.",
+)
+@click.option(
+    "-m",
+    "--messages",
+    type=click.Path(exists=True, file_okay=False, dir_okay=True, path_type=Path),
+    help="Loads message definition files from a directory.",
+)
 @click.option(
     "-v",
     "--verbose",
     is_flag=True,
     help="Enables verbose logging.",
 )
-def run(key_dir, host, login, port, capture, verbose):
+@click.option(
+    "--metrics-port",
+    type=int,
+    help="Serves metrics in the Prometheus text format on this port.",
+)
+@click.option(
+    "--metrics-interval",
+    type=float,
+    help="Logs a summary of the metrics every given number of seconds.",
+)
+@click.option(
+    "--trace-every",
+    type=int,
+    help="Traces the latency of one in this many frames, served on '/traces'.",
+)
+@click.option(
+    "--trace-export",
+    type=click.Path(dir_okay=False, path_type=Path),
+    help="Appends sampled traces to a file as OpenTelemetry JSON.",
+)
+@click.option(
+    "--shard-pool",
+    default=2,
+    show_default=True,
+    help="The number of listeners to keep ready for new shards.",
+)
+@click.option(
+    "--shard-ttl",
+    type=float,
+    default=600.0,
+    show_default=True,
+    help="Stops shards without clients after this many seconds; 0 disables it.",
+)
+@click.option(
+    "--batch-delay",
+    type=float,
+    default=MAX_DELAY,
+    show_default=True,
+    help="Holds back outgoing frames up to this many seconds to batch them.",
+)
+@click.option(
+    "-w",
+    "--workers",
+    default=1,
+    show_default=True,
+    help="The number of processes to distribute shards over.",
+)
+def run(
+    key_dir,
+    host,
+    login,
+    port,
+    capture,
+    record,
+    compression,
+    messages,
+    verbose,
+    metrics_port,
+    metrics_interval,
+    trace_every,
+    trace_export,
+    shard_pool,
+    shard_ttl,
+    batch_delay,
+    workers,
+):
     """Starts the proxy with required files in the key directory.
 
     The expected files are 'ki_keys.json', a dump of recent client public
@@ -113,7 +289,28 @@ def run(key_dir, host, login, port, capture, verbose):
     make the client communicate with the proxy in plaintext.
     """
     login = SocketAddress(login, port)
-    trio.run(main, key_dir, host, login, capture, verbose)
+    args = (
+        key_dir,
+        host,
+        login,
+        capture,
+        record,
+        Compression[compression.upper()],
+        messages,
+        verbose,
+        metrics_port,
+        metrics_interval,
+        shard_pool,
+        shard_ttl or None,
+        trace_every,
+        trace_export,
+        batch_delay,
+    )
+
+    if workers > 1:
+        Supervisor(workers, work, *args).run(login)
+    else:
+        trio.run(main, *args)
 
 
 if __name__ == "__main__":
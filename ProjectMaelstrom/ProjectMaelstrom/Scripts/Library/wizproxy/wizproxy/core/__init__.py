@@ -1,2 +1,3 @@
 from .proxy import Proxy  # noqa
-from .shard import Shard  # noqa
+from .shard import SessionIds, Shard  # noqa
+from .workers import Supervisor, WorkerLink, WorkerProxy  # noqa
@@ -0,0 +1,52 @@
+from typing import Optional
+
+import trio
+
+
+class ListenerPool:
+    """
+    Keeps bound TCP listeners around for new shards to serve on.
+
+    New shards are mostly needed while a client waits for its redirect
+    to another server. Listeners taken from the pool are already bound
+    and accepting connections, so the redirect can be sent right away
+    and the pool is refilled in the background.
+
+    :param host: The host interface to bind listeners to.
+    :param size: How many idle listeners to keep around.
+    """
+
+    def __init__(self, host: Optional[str], size: int):
+        self.host = host
+        self.size = size
+
+        self._idle: list[list[trio.SocketListener]] = []
+        self._taken = trio.Event()
+
+    async def _open(self) -> list[trio.SocketListener]:
+        # Port 0 makes the OS pick for us.
+        return await trio.open_tcp_listeners(0, host=self.host)
+
+    async def acquire(self) -> list[trio.SocketListener]:
+        """Takes idle listeners from the pool or binds new ones."""
+        if self._idle:
+            listeners = self._idle.pop()
+            self._taken.set()
+            return listeners
+
+        return await self._open()
+
+    async def run(self):
+        """Keeps the pool filled until cancelled."""
+        try:
+            while True:
+                while len(self._idle) < self.size:
+                    self._idle.append(await self._open())
+
+                self._taken = trio.Event()
+                await self._taken.wait()
+        finally:
+            for listeners in self._idle:
+                for listener in listeners:
+                    listener.socket.close()
+            self._idle.clear()
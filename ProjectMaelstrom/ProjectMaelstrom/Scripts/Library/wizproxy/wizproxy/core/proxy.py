@@ -1,14 +1,18 @@
 from typing import Optional
 
 import trio
+from loguru import logger
 
 from wizproxy.crypto import KeyChain
+from wizproxy.metrics import Metrics
 from wizproxy.plugin import Plugin, PluginCollection
 from wizproxy.plugin.builtin import BuiltinPlugin
 from wizproxy.proto import SocketAddress
 from wizproxy.session import ClientSig
+from wizproxy.transport.writer import MAX_DELAY
 
-from .shard import Shard
+from .pool import ListenerPool
+from .shard import SessionIds, Shard
 
 
 class Proxy:
@@ -27,6 +31,13 @@ class Proxy:
     :param key_chain: They key chain to use for cryptographic operations.
     :param client_sig: Optionally, a decrypted ClientSig if present.
     :param nursery: The nursery to spawn shards on.
+    :param max_batch_delay: How long shards may hold back outgoing frames
+                            to coalesce them into fewer socket writes.
+    :param metrics: Optionally, where shards and plugins record runtime
+                    statistics.
+    :param pool_size: How many bound listeners to keep ready for new shards.
+    :param shard_ttl: Optionally, after how many seconds without clients
+                      shards are stopped to free their resources.
     """
 
     def __init__(
@@ -35,33 +46,90 @@ class Proxy:
         key_chain: KeyChain,
         client_sig: Optional[ClientSig],
         nursery: trio.Nursery,
+        max_batch_delay: float = MAX_DELAY,
+        metrics: Optional[Metrics] = None,
+        pool_size: int = 0,
+        shard_ttl: Optional[float] = None,
     ):
         self.host = host
         self.key_chain = key_chain
         self.client_sig = client_sig
         self.nursery = nursery
+        self.max_batch_delay = max_batch_delay
+        self.metrics = metrics
+        self.shard_ttl = shard_ttl
 
-        self.plugins = PluginCollection()
+        self.session_ids = SessionIds()
+        self.plugins = PluginCollection(self.metrics)
         self.plugins.add(BuiltinPlugin())
 
-        self._shards = {}
+        self._shards: dict[tuple[bytes, int], Shard] = {}
+        self._pool = ListenerPool(host, pool_size)
 
         self._tx, self._rx = trio.open_memory_channel(32)
 
     def add_plugin(self, plugin: Plugin):
         self.plugins.add(plugin)
 
-    async def spawn_shard(self, addr: SocketAddress) -> SocketAddress:
+    async def spawn_shard(
+        self, addr: SocketAddress, persistent: bool = False
+    ) -> SocketAddress:
         # If the shard is already running, just return its address.
-        if shard := self._shards.get(addr):
-            return shard
-
-        shard = Shard(self.plugins, self.key_chain, self.client_sig, self._tx.clone())
-        self._shards[addr] = await shard.start(self.host, self.nursery, addr)
+        key = (addr.ip, addr.port)
+        if shard := self._shards.get(key):
+            shard.touch()
+            return shard.self_addr
+
+        shard = Shard(
+            self.plugins,
+            self.key_chain,
+            self.client_sig,
+            self._tx.clone(),
+            self.max_batch_delay,
+            self.metrics,
+            persistent,
+            self.session_ids,
+        )
+        listeners = await self._pool.acquire()
+        await shard.start(self.host, self.nursery, addr, listeners)
+        self._shards[key] = shard
 
         return shard.self_addr
 
+    async def _release(self, shard: Shard, idle: float) -> bool:
+        # Decides whether an idle shard may be stopped. Once this agrees,
+        # the shard is stopped no matter what happens in the meantime.
+        return True
+
+    async def _reap(self, ttl: float):
+        while True:
+            await trio.sleep(ttl / 4)
+
+            for key, shard in list(self._shards.items()):
+                if shard.persistent or (idle := shard.idle_time()) < ttl:
+                    continue
+
+                # Forget the shard while asking, so a shard spawned for the same
+                # server in the meantime is a new one and never this one.
+                del self._shards[key]
+                if not await self._release(shard, idle):
+                    self._shards[key] = shard
+                    continue
+
+                # The answer is final, since with workers the supervisor has
+                # already forgotten the shard. Clients that connected since
+                # keep their tunnels, only new ones are refused.
+                logger.info(f"[{shard}] Stopping shard after {idle:.0f}s idle")
+                shard.stop()
+
+    def _start_background(self):
+        self.nursery.start_soon(self._pool.run)
+        if self.shard_ttl is not None:
+            self.nursery.start_soon(self._reap, self.shard_ttl)
+
     async def run(self):
+        self._start_background()
+
         while True:
             parcel = await self._rx.receive()
             addr = await self.spawn_shard(parcel.data)
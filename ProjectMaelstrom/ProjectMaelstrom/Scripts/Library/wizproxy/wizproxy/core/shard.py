@@ -1,5 +1,4 @@
 import itertools
-from functools import partial
 from typing import Optional
 
 import trio
@@ -7,15 +6,36 @@ from exceptiongroup import ExceptionGroup, catch
 from loguru import logger
 
 from wizproxy.crypto import KeyChain
+from wizproxy.metrics import Metrics
 from wizproxy.plugin import Context, Direction, PluginCollection
-from wizproxy.proto import Bytes, Frame, SocketAddress
+from wizproxy.proto import Frame, SocketAddress, parse_header
 from wizproxy.session import ClientSig, Session
-from wizproxy.transport import FrameStream
+from wizproxy.transport import FrameStream, FrameWriter
+from wizproxy.transport.writer import MAX_DELAY
 
 from .parcel import Parcel
 
 _DUMMY_ADDR = SocketAddress("0.0.0.0", 0)
 
+# How many forwarded frames of a session may wait for deferred listeners
+# before the tunnels wait for them to catch up.
+DEFERRED_QUEUE = 256
+
+
+class SessionIds:
+    """
+    Hands out the session IDs of a proxy's clients.
+
+    IDs are unique across all shards, so traffic logs and captures of a
+    whole proxy can tell clients apart by them alone.
+    """
+
+    def __init__(self):
+        self._ids = itertools.count()
+
+    async def next(self) -> int:
+        return next(self._ids)
+
 
 class Shard:
     """
@@ -33,6 +53,13 @@ class Shard:
     :param key_chain: The :class:`KeyChain` for asymmetric crypto.
     :param client_sig: Optionally, a decrypted ClientSig if present.
     :param proxy_tx: The channel for sending commands to the supervisor.
+    :param max_batch_delay: How long outgoing frames may be held back to
+                            coalesce them into fewer socket writes.
+    :param metrics: Optionally, where to record traffic statistics.
+    :param persistent: Whether the shard must never be reaped when idle,
+                       e.g. because clients are configured to use it.
+    :param session_ids: Where to get IDs for new sessions from; shards of
+                        the same proxy share them.
     """
 
     def __init__(
@@ -41,20 +68,53 @@ class Shard:
         key_chain: KeyChain,
         client_sig: Optional[ClientSig],
         proxy_tx: trio.abc.SendChannel[Parcel[SocketAddress, SocketAddress]],
+        max_batch_delay: float = MAX_DELAY,
+        metrics: Optional[Metrics] = None,
+        persistent: bool = False,
+        session_ids: Optional[SessionIds] = None,
     ):
         self.plugins = plugins
         self.key_chain = key_chain
         self.client_sig = client_sig
         self.proxy_tx = proxy_tx
+        self.max_batch_delay = max_batch_delay
+        self.metrics = metrics
+        self.persistent = persistent
+        self.session_ids = session_ids or SessionIds()
 
         self.self_addr = _DUMMY_ADDR
         self.remote_addr = _DUMMY_ADDR
 
-        self._id_generator = itertools.count()
+        self._clients = 0
+        self._last_active = 0.0
+        self._scope = trio.CancelScope()
+        self._stopped = False
 
     def __str__(self) -> str:
         return str(self.self_addr)
 
+    def idle_time(self) -> float:
+        """How long the shard has been without any connected clients."""
+        if self._clients:
+            return 0.0
+        return trio.current_time() - self._last_active
+
+    def touch(self):
+        """Marks the shard as in use, e.g. when a client is sent to it."""
+        self._last_active = trio.current_time()
+
+    def stop(self):
+        """Stops accepting clients and closes the listeners."""
+        self._stopped = True
+        self._scope.cancel()
+        self._exit()
+
+    def _exit(self):
+        # Clients connected before the shard was stopped keep their tunnels,
+        # so its metrics are only dropped once the last of them is gone.
+        if self._stopped and not self._clients and self.metrics is not None:
+            self.metrics.drop_shard(str(self))
+
     async def tunnel(
         self,
         direction: Direction,
@@ -64,37 +124,81 @@ class Shard:
     ):
         is_client = direction == Direction.CLIENT_TO_SERVER
         session = ctx.session
-        buf = Bytes()
 
-        async for res in FrameStream(stream, session, is_client):
-            encrypted, frame = res
-
-            # Deserialize the next received frame.
-            buf.load_frame(frame)
-            frame = Frame.read(buf)
-
-            # Run all plugins on the frame and decide if it should be omitted.
-            if not await self.plugins.dispatch(direction, ctx, frame):
-                continue
-
-            # if the frame is marked dirty, re-serialize it.
-            # Otherwise, just reuse the original data we backed up.
-            if frame.dirty:
-                frame.write(buf)
-                raw = buf.getvalue()
-            else:
-                raw = frame.original
-
-            # Encrypt the frame data, if necessary.
-            if encrypted:
-                if is_client:
-                    raw = session.client_aes.encrypt(raw)
-                else:
-                    raw = session.server_aes.encrypt(raw)
-
-            await peer.send_all(raw)
-
-        buf.close()
+        metrics = self.metrics
+        if metrics is not None:
+            label, dir_label = str(self), direction.name.lower()
+            stats = metrics.stream(label, dir_label)
+            tracer = metrics.tracer
+        else:
+            stats = None
+            tracer = None
+
+        def stream_large(head: memoryview, size: int) -> bool:
+            # Large frames no listener is interested in are forwarded piece
+            # by piece as they arrive instead of being buffered completely.
+            header = parse_header(head)
+            if self.plugins.wants(direction, header):
+                return False
+
+            if metrics is not None:
+                metrics.record_frame(label, dir_label, header, size)
+            return True
+
+        frames = FrameStream(stream, session, is_client, stats, stream_large)
+        writer = FrameWriter(
+            peer, session, is_client, max_delay=self.max_batch_delay, stats=stats
+        )
+
+        async for res in frames:
+            # Process all frames that arrived with the same read before
+            # flushing them out to the peer with a single write.
+            while res is not None:
+                encrypted, raw = res
+                if frames.partial:
+                    await writer.write(encrypted, raw)
+                    res = frames.poll()
+                    continue
+
+                # Decode just enough of the frame to find out who wants it.
+                header = parse_header(raw)
+                if metrics is not None:
+                    metrics.record_frame(label, dir_label, header, len(raw))
+
+                trace = None
+                if tracer is not None:
+                    trace = tracer.sample(
+                        label, dir_label, header, len(raw), frames.received_at
+                    )
+
+                listeners = self.plugins.select(direction, raw, header)
+                frame = None
+                if listeners:
+                    # Run all plugins on the frame and decide if it should be omitted.
+                    frame = Frame.parse(raw, header)
+                    if not await self.plugins.invoke(listeners, ctx, frame):
+                        raw = None
+
+                if trace is not None:
+                    trace.mark()
+
+                # Frames nobody is interested in are forwarded without parsing.
+                if raw is not None:
+                    # If the frame is marked dirty, re-serialize it straight into
+                    # the outgoing batch. Otherwise, forward the received data.
+                    if frame is not None and frame.dirty:
+                        await writer.write_frame(encrypted, frame, trace)
+                    else:
+                        if trace is not None:
+                            trace.mark()
+                        await writer.write(encrypted, raw, trace)
+
+                    if listeners:
+                        await self.plugins.defer(listeners, ctx, frame)
+
+                res = frames.poll()
+
+            await writer.flush()
 
     async def _client_task(
         self,
@@ -112,20 +216,43 @@ class Shard:
     ):
         await self.tunnel(Direction.SERVER_TO_CLIENT, ctx, stream, peer)
 
+    async def _serve(
+        self,
+        handler,
+        listeners: list[trio.SocketListener],
+        nursery: trio.Nursery,
+        task_status=trio.TASK_STATUS_IGNORED,
+    ):
+        with self._scope:
+            await trio.serve_listeners(
+                handler, listeners, handler_nursery=nursery, task_status=task_status
+            )
+
     async def start(
         self,
         host: Optional[str],
         nursery: trio.Nursery,
         remote: SocketAddress,
+        listeners: Optional[list[trio.SocketListener]] = None,
     ) -> SocketAddress:
         async def accept_tcp_client(stream: trio.SocketStream):
+            self._clients += 1
+            try:
+                await handle_client(stream)
+            finally:
+                self._clients -= 1
+                self.touch()
+                self._exit()
+
+        async def handle_client(stream: trio.SocketStream):
             outward = await trio.open_tcp_stream(remote.ip, remote.port)
             client_sock = stream.socket.getsockname()
 
             client = SocketAddress(client_sock[0], client_sock[1])
-            sid = next(self._id_generator)
+            sid = await self.session_ids.next()
             session = Session(client, remote, sid, self.key_chain, self.client_sig)
-            context = Context(self, session)
+            deferred_tx, deferred_rx = trio.open_memory_channel(DEFERRED_QUEUE)
+            context = Context(self, session, deferred_tx)
 
             logger.info(f"[{self}] Client {sid} ({client}) connected")
 
@@ -149,13 +276,20 @@ class Shard:
                 ValueError: value_error_handler,
             }):
                 async with trio.open_nursery() as nursery:
-                    nursery.start_soon(self._client_task, context, stream, outward)
-                    nursery.start_soon(self._server_task, context, outward, stream)
+                    # Deferred listeners run alongside the tunnels and drain
+                    # the remaining frames once both of them are done.
+                    nursery.start_soon(self.plugins.run_deferred, context, deferred_rx)
+
+                    async with deferred_tx, trio.open_nursery() as tunnels:
+                        tunnels.start_soon(self._client_task, context, stream, outward)
+                        tunnels.start_soon(self._server_task, context, outward, stream)
 
         # Port 0 makes the OS pick for us. So we need to remember the
         # assigned address after the server has started.
-        serve_tcp = partial(trio.serve_tcp, host=host, handler_nursery=nursery)
-        listeners = await nursery.start(serve_tcp, accept_tcp_client, 0)
+        if listeners is None:
+            listeners = await trio.open_tcp_listeners(0, host=host)
+        await nursery.start(self._serve, accept_tcp_client, listeners, nursery)
+        self.touch()
 
         server_sock = listeners[0].socket.getsockname()
         self.self_addr = SocketAddress(server_sock[0], server_sock[1])
@@ -0,0 +1,306 @@
+import itertools
+import multiprocessing
+import time
+from contextlib import suppress
+from multiprocessing.connection import Connection, wait
+from typing import Any, Callable
+
+import trio
+from loguru import logger
+
+from wizproxy.proto import SocketAddress
+
+from .proxy import Proxy
+from .shard import SessionIds, Shard
+
+# How many session IDs a worker gets from the supervisor at once.
+SESSION_ID_BLOCK = 1024
+
+
+async def _receive(conn: Connection) -> Any:
+    return await trio.to_thread.run_sync(conn.recv, cancellable=True)
+
+
+async def _wait_exit(process: multiprocessing.Process):
+    await trio.to_thread.run_sync(wait, [process.sentinel], cancellable=True)
+
+
+class WorkerLink:
+    """
+    A worker process's end of the connection to its :class:`Supervisor`.
+
+    :param index: The index of the worker, starting at 0.
+    :param requests: Pipe for shard requests to the supervisor.
+    :param commands: Pipe for spawn commands from the supervisor.
+    """
+
+    def __init__(self, index: int, requests: Connection, commands: Connection):
+        self.index = index
+        self.requests = requests
+        self.commands = commands
+
+
+class _Release:
+    # Asks the supervisor to forget a shard that has been idle for a while.
+    def __init__(self, remote: SocketAddress, idle: float):
+        self.remote = remote
+        self.idle = idle
+
+
+class _SessionIdBlock:
+    # Asks the supervisor for the start of a new block of session IDs.
+    pass
+
+
+class _WorkerSessionIds(SessionIds):
+    # Session IDs are drawn from the supervisor in blocks, so they are unique
+    # across workers, including ones restarted after a crash.
+    def __init__(self, proxy: "WorkerProxy"):
+        self._proxy = proxy
+        self._ids = iter(())
+
+    async def next(self) -> int:
+        if (sid := next(self._ids, None)) is None:
+            start = await self._proxy._request(_SessionIdBlock())
+            self._ids = iter(range(start, start + SESSION_ID_BLOCK))
+            sid = next(self._ids)
+
+        return sid
+
+
+class WorkerProxy(Proxy):
+    """
+    A proxy running as one of many worker processes.
+
+    Instead of spawning shards itself, all requests of its shards are
+    forwarded to the supervisor. The supervisor keeps track of shards
+    across all workers and picks a worker to spawn new ones on, which
+    may be this one.
+
+    :param link: The connection to the supervisor.
+    """
+
+    def __init__(self, link: WorkerLink, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.link = link
+        self.session_ids = _WorkerSessionIds(self)
+
+        self._request_lock = trio.Lock()
+
+    async def _request(self, request: Any) -> Any:
+        async with self._request_lock:
+            self.link.requests.send(request)
+            return await _receive(self.link.requests)
+
+    async def _release(self, shard: Shard, idle: float) -> bool:
+        # Other workers may have sent clients to the shard in the meantime.
+        return await self._request(_Release(shard.remote_addr, idle))
+
+    async def _serve_commands(self):
+        while True:
+            addr, persistent = await _receive(self.link.commands)
+            self.link.commands.send(await self.spawn_shard(addr, persistent))
+
+    async def run(self):
+        self._start_background()
+        self.nursery.start_soon(self._serve_commands)
+
+        while True:
+            parcel = await self._rx.receive()
+            parcel.answer(await self._request(parcel.data))
+
+
+def _work(target: Callable[..., None], link: WorkerLink, args: tuple):
+    # Workers receive the interrupt alongside the supervisor, which
+    # already takes care of shutting down.
+    with suppress(KeyboardInterrupt):
+        target(link, *args)
+
+
+class _Worker:
+    def __init__(
+        self,
+        index: int,
+        process: multiprocessing.Process,
+        requests: Connection,
+        commands: Connection,
+    ):
+        self.index = index
+        self.process = process
+        self.requests = requests
+        self.commands = commands
+        self.shards = 0
+        self.persistent = False
+
+
+class Supervisor:
+    """
+    Distributes shards over multiple worker processes.
+
+    Each worker runs its own :class:`WorkerProxy` with its own plugins,
+    so traffic of shards on different workers is processed in parallel.
+    New shards are spawned on the worker with the least shards.
+
+    Workers that exit are restarted, their shards are gone with them and
+    spawned anew when clients are sent there again. A worker running a
+    persistent shard, which clients are configured to use, can't be
+    replaced like that, so its exit shuts the whole proxy down.
+
+    The supervisor is the single authority on which shard proxies which
+    remote server. This keeps redirects of clients to other servers
+    consistent, no matter which worker handles them.
+
+    :param workers: The number of worker processes to start.
+    :param target: A top-level function to run in each worker process.
+                   It is called with a :class:`WorkerLink` and `args`
+                   and is expected to run a :class:`WorkerProxy`.
+    :param args: Additional picklable arguments to `target`.
+    """
+
+    def __init__(self, workers: int, target: Callable[..., None], *args):
+        self.target = target
+        self.args = args
+
+        self._workers: list[_Worker] = []
+        self._count = workers
+
+        self._shards: dict[tuple[bytes, int], tuple[_Worker, SocketAddress]] = {}
+        self._handed_out: dict[tuple[bytes, int], float] = {}
+        self._session_ids = itertools.count(0, SESSION_ID_BLOCK)
+        self._lock = trio.Lock()
+
+    def _start_worker(self, index: int) -> _Worker:
+        # Spawn workers on all platforms, forking a process with running
+        # threads is asking for trouble.
+        ctx = multiprocessing.get_context("spawn")
+
+        requests, worker_requests = ctx.Pipe()
+        commands, worker_commands = ctx.Pipe()
+
+        link = WorkerLink(index, worker_requests, worker_commands)
+        process = ctx.Process(
+            target=_work,
+            args=(self.target, link, self.args),
+            name=f"wizproxy-worker-{index}",
+            daemon=True,
+        )
+        process.start()
+
+        return _Worker(index, process, requests, commands)
+
+    async def spawn_shard(
+        self, addr: SocketAddress, persistent: bool = False
+    ) -> SocketAddress:
+        async with self._lock:
+            key = (addr.ip, addr.port)
+            self._handed_out[key] = time.monotonic()
+
+            # If the shard is already running, just return its address.
+            if entry := self._shards.get(key):
+                return entry[1]
+
+            for worker in sorted(self._workers, key=lambda w: w.shards):
+                try:
+                    worker.commands.send((addr, persistent))
+                    shard = await _receive(worker.commands)
+                except (EOFError, OSError):
+                    # The worker died, it is replaced once its exit is noticed.
+                    continue
+
+                worker.shards += 1
+                worker.persistent |= persistent
+                self._shards[key] = (worker, shard)
+
+                logger.info(f"Shard {shard} for {addr} runs on {worker.process.name}")
+                return shard
+
+            raise RuntimeError(f"No worker is left to spawn a shard for {addr}")
+
+    async def release_shard(self, remote: SocketAddress, idle: float) -> bool:
+        async with self._lock:
+            key = (remote.ip, remote.port)
+
+            # Refuse if a client was sent to the shard after it became idle.
+            handed_out = self._handed_out.get(key)
+            if handed_out is not None and time.monotonic() - handed_out < idle:
+                return False
+
+            if entry := self._shards.pop(key, None):
+                entry[0].shards -= 1
+            self._handed_out.pop(key, None)
+
+            return True
+
+    async def _serve(self, worker: _Worker):
+        while True:
+            try:
+                request = await _receive(worker.requests)
+            except (EOFError, OSError):
+                # The worker died, which _supervise_worker takes care of.
+                return
+
+            if isinstance(request, _Release):
+                answer = await self.release_shard(request.remote, request.idle)
+            elif isinstance(request, _SessionIdBlock):
+                answer = next(self._session_ids)
+            else:
+                answer = await self.spawn_shard(request)
+
+            with suppress(OSError):
+                worker.requests.send(answer)
+
+    async def _replace(self, worker: _Worker):
+        async with self._lock:
+            # The process has exited, so this doesn't block.
+            worker.process.join()
+            name, code = worker.process.name, worker.process.exitcode
+            worker.requests.close()
+            worker.commands.close()
+
+            # Its shards went down with it, so forget them.
+            lost = [key for key, entry in self._shards.items() if entry[0] is worker]
+            for key in lost:
+                del self._shards[key]
+                self._handed_out.pop(key, None)
+
+            if worker.persistent:
+                raise RuntimeError(
+                    f"{name} running a persistent shard exited with code {code}"
+                )
+
+            logger.error(
+                f"{name} exited with code {code}, restarting it; "
+                f"its {len(lost)} shards are gone"
+            )
+            self._workers[worker.index] = self._start_worker(worker.index)
+
+    async def _supervise_worker(self, index: int):
+        while True:
+            worker = self._workers[index]
+
+            async with trio.open_nursery() as nursery:
+                nursery.start_soon(self._serve, worker)
+
+                await _wait_exit(worker.process)
+                nursery.cancel_scope.cancel()
+
+            await self._replace(worker)
+
+    async def _supervise(self, login: SocketAddress):
+        async with trio.open_nursery() as nursery:
+            for index in range(len(self._workers)):
+                nursery.start_soon(self._supervise_worker, index)
+
+            # Spawn the initial shard to proxy the login server.
+            await self.spawn_shard(login, persistent=True)
+
+    def run(self, login: SocketAddress):
+        """Starts the workers and supervises them until interrupted."""
+        self._workers = [self._start_worker(i) for i in range(self._count)]
+
+        try:
+            trio.run(self._supervise, login)
+        finally:
+            for worker in self._workers:
+                worker.process.terminate()
+                worker.process.join()
@@ -1,3 +1,5 @@
+from typing import Union
+
 from Crypto.Cipher import AES
 from Crypto.Random import get_random_bytes
 
@@ -69,10 +71,13 @@ class AesContext:
         )
         return nbytes - overhead
 
-    def encrypt(self, data: bytes) -> bytearray:
+    def encrypt(self, data: Union[bytes, bytearray, memoryview]) -> bytearray:
         data_len = len(data)
         output = bytearray(self.calculate_encryption_overhead(data_len))
 
+        # Any buffer is consumed in place, without copying it chunk-wise.
+        data = memoryview(data)
+
         # We have pre-allocated the entire `output` including any overhead
         # that may be created through nonce rotations. Now we use a view
         # to fill that buffer without needing any further allocations.
@@ -6,17 +6,39 @@ from Crypto.Hash import SHA1
 from Crypto.PublicKey import RSA
 from Crypto.Signature import pkcs1_15
 
+_FNV_PRIME = 0x01000193
+_FNV_MASK = 0xFFFF_FFFF
+
 
 def fnv_1a(data: bytes) -> int:
     state = 0x811C9DC5
-    for b in data:
-        state ^= b
-        state *= 0x01000193
-        state &= 0xFFFF_FFFF
+
+    # Every round depends on the previous one, so the best we can do is
+    # cut down interpreter overhead by consuming four bytes per iteration.
+    # The state is only truncated every other round, the low 32 bits of
+    # the products are unaffected by that.
+    end = len(data) & ~3
+    it = iter(memoryview(data)[:end])
+    for b0, b1, b2, b3 in zip(it, it, it, it):
+        state = ((state ^ b0) * _FNV_PRIME ^ b1) * _FNV_PRIME & _FNV_MASK
+        state = ((state ^ b2) * _FNV_PRIME ^ b3) * _FNV_PRIME & _FNV_MASK
+
+    for b in data[end:]:
+        state = (state ^ b) * _FNV_PRIME & _FNV_MASK
 
     return state
 
 
+def _hash_region(
+    cache: dict[tuple[int, int], int], buf: bytes, offset: int, length: int
+) -> int:
+    key = (offset, length)
+    if (value := cache.get(key)) is None:
+        value = cache[key] = fnv_1a(buf[offset : offset + length])
+
+    return value
+
+
 class KeyChain:
     """
     Key chain for managing asymmetric keys.
@@ -48,30 +70,38 @@ class KeyChain:
             for key in injected_keys["decoded"]
         ]
 
+        # The key buffers never change, so hashes of their regions are
+        # remembered across the handshakes of all sessions.
+        self._ki_hashes: dict[tuple[int, int], int] = {}
+        self._injected_hashes: dict[tuple[int, int], int] = {}
+
+        # Signature schemes and ciphers are stateless, so every key slot
+        # gets its own set once instead of one per handshake.
+        self._verifiers = [pkcs1_15.new(key) for key in self.public_keys]
+        self._encryptors = [PKCS1_OAEP.new(key) for key in self.public_keys]
+        self._signers = [pkcs1_15.new(key) for key in self.private_keys]
+        self._decryptors = [PKCS1_OAEP.new(key) for key in self.private_keys]
+
     def hash_key_buf(self, offset: int, length: int) -> int:
-        return fnv_1a(self.ki_key_buf[offset : offset + length])
+        return _hash_region(self._ki_hashes, self.ki_key_buf, offset, length)
 
     def verify_key_hash(self, offset: int, length: int, expected: int):
-        buf_hash = fnv_1a(self.injected_key_buf[offset : offset + length])
+        buf_hash = _hash_region(
+            self._injected_hashes, self.injected_key_buf, offset, length
+        )
         if buf_hash != expected:
             raise ValueError("key hash mismatch; algorithm changed?")
 
     def sign(self, key_slot: int, data: bytes) -> bytes:
-        key = self.private_keys[key_slot]
         data_hash = SHA1.new(data)
-
-        return pkcs1_15.new(key).sign(data_hash)
+        return self._signers[key_slot].sign(data_hash)
 
     def verify(self, key_slot: int, data: bytes, signature: bytes):
-        key = self.public_keys[key_slot]
         data_hash = SHA1.new(data)
-
-        pkcs1_15.new(key).verify(data_hash, signature)
+        self._verifiers[key_slot].verify(data_hash, signature)
 
     def encrypt(self, key_slot: int, data: bytes) -> bytes:
-        cipher = PKCS1_OAEP.new(self.public_keys[key_slot])
-        return cipher.encrypt(data)
+        return self._encryptors[key_slot].encrypt(data)
 
     def decrypt(self, key_slot: int, data: bytes) -> bytes:
-        cipher = PKCS1_OAEP.new(self.private_keys[key_slot])
-        return cipher.decrypt(data)
+        return self._decryptors[key_slot].decrypt(data)
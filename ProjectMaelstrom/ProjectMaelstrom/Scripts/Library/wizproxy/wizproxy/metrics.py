@@ -0,0 +1,289 @@
+import time
+from bisect import bisect_left
+from collections import defaultdict
+from functools import partial
+from typing import Optional
+
+import trio
+from loguru import logger
+
+from wizproxy.proto import Header
+from wizproxy.tracing import Tracer
+
+# Upper bounds of histogram buckets, in seconds.
+BUCKETS = (
+    0.000_005,
+    0.000_01,
+    0.000_025,
+    0.000_05,
+    0.000_1,
+    0.000_25,
+    0.000_5,
+    0.001,
+    0.002_5,
+    0.005,
+    0.01,
+    0.025,
+    0.1,
+    float("inf"),
+)
+
+# Bytes of an HTTP request after which it is refused; scrapers send far less.
+MAX_REQUEST_SIZE = 8192
+
+# Identifies frames by (shard, direction, opcode, service_id, order).
+FrameKey = tuple[str, str, Optional[int], Optional[int], Optional[int]]
+
+
+class Histogram:
+    """A cumulative histogram of durations with fixed buckets."""
+
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name: str, labels: str) -> list[str]:
+        sep = "," if labels else ""
+        lines = []
+
+        cumulative = 0
+        for bound, count in zip(BUCKETS, self.counts):
+            cumulative += count
+            le = "+Inf" if bound == float("inf") else repr(bound)
+            lines.append(f'{name}_bucket{{{labels}{sep}le="{le}"}} {cumulative}')
+
+        lines.append(f"{name}_sum{{{labels}}} {self.sum}")
+        lines.append(f"{name}_count{{{labels}}} {self.count}")
+        return lines
+
+
+class StreamStats:
+    """Statistics of one direction of traffic through a shard."""
+
+    __slots__ = ("received", "high_water", "decrypt", "encrypt")
+
+    def __init__(self):
+        self.received = 0
+        self.high_water = 0
+        self.decrypt = Histogram()
+        self.encrypt = Histogram()
+
+
+class ListenerStats:
+    """Statistics of a single plugin listener."""
+
+    __slots__ = ("execution", "lock_wait")
+
+    def __init__(self):
+        self.execution = Histogram()
+        self.lock_wait = Histogram()
+
+
+def _labels(**labels) -> str:
+    return ",".join(f'{k}="{"" if v is None else v}"' for k, v in labels.items())
+
+
+class Metrics:
+    """
+    Runtime metrics of the proxy.
+
+    Shards, their frame streams and the plugin collection record what
+    passes through them here. The collected data can be exposed in the
+    Prometheus text format with :meth:`serve` or summarized in a log
+    line with :meth:`log_every`.
+
+    With a :class:`Tracer`, shards also sample per-frame latency traces,
+    which are served as a summary under `/traces`.
+    """
+
+    def __init__(self, tracer: Optional[Tracer] = None):
+        self.tracer = tracer
+
+        self.frames: defaultdict[FrameKey, int] = defaultdict(int)
+        self.frame_bytes: defaultdict[FrameKey, int] = defaultdict(int)
+
+        self.streams: dict[tuple[str, str], StreamStats] = {}
+        self.listeners: dict[tuple[str, str], ListenerStats] = {}
+
+        # Frames of shards that were dropped, so totals keep adding up.
+        self._dropped_frames = 0
+
+        self._last_frames = 0
+        self._last_time = time.perf_counter()
+
+    def stream(self, shard: str, direction: str) -> StreamStats:
+        key = (shard, direction)
+        if (stats := self.streams.get(key)) is None:
+            stats = self.streams[key] = StreamStats()
+        return stats
+
+    def listener(self, plugin: str, listener: str) -> ListenerStats:
+        key = (plugin, listener)
+        if (stats := self.listeners.get(key)) is None:
+            stats = self.listeners[key] = ListenerStats()
+        return stats
+
+    def record_frame(self, shard: str, direction: str, header: Header, size: int):
+        opcode, service_id, order, _, _ = header
+        key = (shard, direction, opcode, service_id, order)
+        self.frames[key] += 1
+        self.frame_bytes[key] += size
+
+    def drop_shard(self, shard: str):
+        """Forgets all per-shard series of a shard that was stopped."""
+        for key in [key for key in self.frames if key[0] == shard]:
+            self._dropped_frames += self.frames.pop(key)
+            del self.frame_bytes[key]
+
+        for key in [key for key in self.streams if key[0] == shard]:
+            del self.streams[key]
+
+    def render(self) -> str:
+        """Renders all metrics in the Prometheus text exposition format."""
+        lines = [
+            "# TYPE wizproxy_frames_total counter",
+            *(
+                f"wizproxy_frames_total{{{_frame_labels(key)}}} {count}"
+                for key, count in self.frames.items()
+            ),
+            "# TYPE wizproxy_frame_bytes_total counter",
+            *(
+                f"wizproxy_frame_bytes_total{{{_frame_labels(key)}}} {count}"
+                for key, count in self.frame_bytes.items()
+            ),
+            "# TYPE wizproxy_received_bytes_total counter",
+            *(
+                f"wizproxy_received_bytes_total{{{_labels(shard=s, direction=d)}}} "
+                f"{stats.received}"
+                for (s, d), stats in self.streams.items()
+            ),
+            "# TYPE wizproxy_buffer_high_water_bytes gauge",
+            *(
+                f"wizproxy_buffer_high_water_bytes{{{_labels(shard=s, direction=d)}}} "
+                f"{stats.high_water}"
+                for (s, d), stats in self.streams.items()
+            ),
+            "# TYPE wizproxy_decrypt_seconds histogram",
+        ]
+        for (shard, direction), stats in self.streams.items():
+            labels = _labels(shard=shard, direction=direction)
+            lines.extend(stats.decrypt.render("wizproxy_decrypt_seconds", labels))
+
+        lines.append("# TYPE wizproxy_encrypt_seconds histogram")
+        for (shard, direction), stats in self.streams.items():
+            labels = _labels(shard=shard, direction=direction)
+            lines.extend(stats.encrypt.render("wizproxy_encrypt_seconds", labels))
+
+        lines.append("# TYPE wizproxy_listener_seconds histogram")
+        for (plugin, listener), stats in self.listeners.items():
+            labels = _labels(plugin=plugin, listener=listener)
+            lines.extend(stats.execution.render("wizproxy_listener_seconds", labels))
+
+        lines.append("# TYPE wizproxy_listener_lock_wait_seconds histogram")
+        for (plugin, listener), stats in self.listeners.items():
+            labels = _labels(plugin=plugin, listener=listener)
+            lines.extend(
+                stats.lock_wait.render("wizproxy_listener_lock_wait_seconds", labels)
+            )
+
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> str:
+        """Summarizes frame rates and the most expensive listeners."""
+        now = time.perf_counter()
+        frames = self._dropped_frames + sum(self.frames.values())
+
+        rate = (frames - self._last_frames) / (now - self._last_time)
+        self._last_frames, self._last_time = frames, now
+
+        high_water = max((s.high_water for s in self.streams.values()), default=0)
+        parts = [f"{frames} frames ({rate:.0f}/s)", f"buffer high-water {high_water}B"]
+
+        busiest = sorted(
+            self.listeners.items(), key=lambda item: item[1].execution.sum, reverse=True
+        )
+        for (plugin, listener), stats in busiest[:3]:
+            execution, lock_wait = stats.execution, stats.lock_wait
+            if execution.count:
+                parts.append(
+                    f"{plugin}.{listener} {execution.sum * 1000:.1f}ms "
+                    f"(avg {execution.sum / execution.count * 1e6:.0f}us, "
+                    f"lock wait {lock_wait.sum * 1000:.1f}ms)"
+                )
+
+        return ", ".join(parts)
+
+    async def log_every(self, interval: float):
+        """Periodically logs a :meth:`summary` of the metrics."""
+        while True:
+            await trio.sleep(interval)
+            logger.info(f"[metrics] {self.summary()}")
+
+    async def _handle_http(self, stream: trio.SocketStream):
+        # A scraper going away must never take the proxy down with it.
+        try:
+            await self._respond(stream)
+        except (trio.BrokenResourceError, trio.ClosedResourceError, ValueError):
+            pass
+        finally:
+            await trio.aclose_forcefully(stream)
+
+    async def _respond(self, stream: trio.SocketStream):
+        # We serve the metrics for any other request, so just drain it.
+        request = bytearray()
+        with trio.move_on_after(5):
+            while b"\r\n\r\n" not in request:
+                data = await stream.receive_some(MAX_REQUEST_SIZE)
+                if not data:
+                    break
+
+                request += data
+                if len(request) > MAX_REQUEST_SIZE:
+                    await stream.send_all(
+                        b"HTTP/1.1 400 Bad Request\r\n"
+                        b"Content-Length: 0\r\n"
+                        b"Connection: close\r\n\r\n"
+                    )
+                    return
+
+        path = request.split(b" ", 2)[1:2]
+        if path == [b"/traces"] and self.tracer is not None:
+            body = self.tracer.dump().encode()
+        else:
+            body = self.render().encode()
+        await stream.send_all(
+            b"HTTP/1.1 200 OK\r\n"
+            b"Content-Type: text/plain; version=0.0.4\r\n"
+            b"Content-Length: " + str(len(body)).encode() + b"\r\n"
+            b"Connection: close\r\n\r\n" + body
+        )
+
+    async def serve(
+        self,
+        host: Optional[str],
+        port: int,
+        *,
+        task_status=trio.TASK_STATUS_IGNORED,
+    ):
+        """Serves the metrics to HTTP clients, e.g. a Prometheus scraper."""
+        serve_tcp = partial(trio.serve_tcp, host=host)
+        await serve_tcp(self._handle_http, port, task_status=task_status)
+
+
+def _frame_labels(key: FrameKey) -> str:
+    shard, direction, opcode, service_id, order = key
+    return _labels(
+        shard=shard,
+        direction=direction,
+        opcode=opcode,
+        service_id=service_id,
+        order=order,
+    )
@@ -1,2 +1,2 @@
 from ._filter import Direction  # noqa
-from .interface import Context, Plugin, PluginCollection, listen  # noqa
+from .interface import Context, Locking, Plugin, PluginCollection, listen  # noqa
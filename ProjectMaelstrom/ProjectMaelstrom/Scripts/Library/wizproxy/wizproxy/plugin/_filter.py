@@ -1,5 +1,6 @@
+from collections.abc import Collection, Iterable
 from enum import Enum, auto
-from typing import Optional
+from typing import Optional, Union
 
 from wizproxy.proto import Frame
 
@@ -11,13 +12,51 @@ class Direction(Enum):
     CLIENT_TO_SERVER = auto()
 
 
+# Identifies the class of frames a filter decision applies to:
+# (direction, opcode, service_id, order).
+DispatchKey = tuple[Direction, Optional[int], Optional[int], Optional[int]]
+
+
+# A header field may be matched by a single value or any collection of
+# values, e.g. a set or a range.
+Values = Union[int, Iterable[int], None]
+
+
+def dispatch_key(direction: Direction, frame: Frame) -> DispatchKey:
+    return direction, frame.opcode, frame.service_id, frame.order
+
+
+def _value_set(values: Values) -> Optional[frozenset[int]]:
+    if values is None:
+        return None
+    elif isinstance(values, int):
+        return frozenset((values,))
+    else:
+        return frozenset(values)
+
+
 class Filter:
+    """
+    Decides which frames a listener is interested in.
+
+    Header fields are matched against sets of accepted values. Since
+    they are all known from the first few bytes of a frame, decisions
+    based on them are resolved once per kind of frame and cached in
+    dispatch tables.
+
+    Conditions on the payload, a byte prefix or its length, are checked
+    for every frame that passes the header conditions, directly on the
+    received data.
+    """
+
     def __init__(
         self,
         direction: Direction,
-        opcode: Optional[int],
-        service_id: Optional[int],
-        order: Optional[int],
+        opcode: Values,
+        service_id: Values,
+        order: Values,
+        prefix: Optional[bytes] = None,
+        length: Union[int, Collection[int], None] = None,
     ):
         if opcode is not None and service_id is not None:
             raise ValueError("unsupported filter for control and data frames")
@@ -26,18 +65,44 @@ class Filter:
             raise ValueError("cannot filter by order without service")
 
         self.direction = direction
-        self.opcode = opcode
-        self.service_id = service_id
-        self.order = order
+        self.opcode = _value_set(opcode)
+        self.service_id = _value_set(service_id)
+        self.order = _value_set(order)
+
+        self.prefix = prefix
+        self.length = range(length, length + 1) if isinstance(length, int) else length
+
+    @property
+    def filters_payload(self) -> bool:
+        return self.prefix is not None or self.length is not None
 
     def can_dispatch(self, frame: Frame) -> bool:
+        return self.accepts(
+            frame.opcode, frame.service_id, frame.order
+        ) and self.accepts_payload(frame.payload)
+
+    def accepts(
+        self,
+        opcode: Optional[int],
+        service_id: Optional[int],
+        order: Optional[int],
+    ) -> bool:
         if self.opcode is not None:
-            return frame.opcode == self.opcode
+            return opcode in self.opcode
 
         elif self.service_id is not None:
             if self.order is None:
-                return frame.service_id == self.service_id
+                return service_id in self.service_id
+
+            return service_id in self.service_id and order in self.order
+
+        return True
+
+    def accepts_payload(self, payload: Union[bytes, memoryview]) -> bool:
+        if self.length is not None and len(payload) not in self.length:
+            return False
 
-            return frame.service_id == self.service_id and frame.order == self.order
+        if self.prefix is not None:
+            return payload[: len(self.prefix)] == self.prefix
 
         return True
@@ -1,6 +1,6 @@
 from wizproxy.proto import Frame, SocketAddress, dml
 
-from . import Context, Direction, Plugin, listen
+from . import Context, Direction, Locking, Plugin, listen
 
 MSG_CHARACTERSELECTED = dml.Layout(
     ("IP", dml.Type.STR),
@@ -58,6 +58,9 @@ class BuiltinPlugin(Plugin):
     redirects of the client to other shards.
     """
 
+    # All state touched here belongs to the session of a frame.
+    locking = Locking.SESSION
+
     @listen(Direction.SERVER_TO_CLIENT, opcode=0)
     async def patch_session_offer(self, ctx: Context, frame: Frame):
         ctx.session.session_offer(frame)
@@ -68,7 +71,7 @@ class BuiltinPlugin(Plugin):
 
     @listen(Direction.SERVER_TO_CLIENT, service_id=7, order=3)
     async def redirect_character_selected(self, ctx: Context, frame: Frame):
-        msg = MSG_CHARACTERSELECTED.decode(frame.payload)
+        msg = MSG_CHARACTERSELECTED.decode_fields(frame.payload, "IP", "TCPPort")
 
         # Extract the server that should be proxied and check validity.
         socket = SocketAddress(msg["IP"], msg["TCPPort"])
@@ -82,11 +85,11 @@ class BuiltinPlugin(Plugin):
         msg["IP"] = shard.ip
         msg["TCPPort"] = shard.port
 
-        frame.payload = MSG_CHARACTERSELECTED.encode(msg)
+        frame.payload = MSG_CHARACTERSELECTED.patch(frame.payload, msg)
 
     @listen(Direction.SERVER_TO_CLIENT, service_id=5, order=221)
     async def redirect_server_transfer(self, ctx: Context, frame: Frame):
-        msg = MSG_SERVERTRANSFER.decode(frame.payload)
+        msg = MSG_SERVERTRANSFER.decode_fields(frame.payload, "IP", "TCPPort")
 
         # Spawn a new shard to proxy the server connection.
         addr = SocketAddress(msg["IP"], msg["TCPPort"])
@@ -100,16 +103,13 @@ class BuiltinPlugin(Plugin):
         msg["FallbackIP"] = fallback.ip
         msg["FallbackTCPPort"] = fallback.port
 
-        frame.payload = MSG_SERVERTRANSFER.encode(msg)
+        frame.payload = MSG_SERVERTRANSFER.patch(frame.payload, msg)
 
     @listen(Direction.CLIENT_TO_SERVER, service_id=53, order=67)
     async def patch_connection_stats(self, ctx: Context, frame: Frame):
-        msg = MSG_CONNECTIONSTATS.decode(frame.payload)
-
         # Client reports the host it is connected to to the server every now and then.
         # We need to spoof the address here or the server sees that we're proxying.
         remote = ctx.remote_addr
-        msg["ServerHostname"] = remote.ip
-        msg["ServerPort"] = remote.port
+        msg = {"ServerHostname": remote.ip, "ServerPort": remote.port}
 
-        frame.payload = MSG_CONNECTIONSTATS.encode(msg)
+        frame.payload = MSG_CONNECTIONSTATS.patch(frame.payload, msg)
@@ -1,21 +1,32 @@
-from typing import Callable, Optional
+import time
+import weakref
+from collections.abc import Collection
+from enum import Enum, auto
+from typing import Callable, Optional, Union
 
 import trio
+from trio.lowlevel import RunVar
 
 from wizproxy.core.parcel import Parcel
-from wizproxy.proto import Frame, SocketAddress
+from wizproxy.metrics import ListenerStats, Metrics
+from wizproxy.proto import Frame, Header, SocketAddress
 from wizproxy.session import Session
 
-from ._filter import Direction, Filter
+from ._filter import Direction, DispatchKey, Filter, Values, dispatch_key
 
 
 def listen(
     dir: Direction,
     *,
-    opcode: Optional[int] = None,
-    service_id: Optional[int] = None,
-    order: Optional[int] = None,
+    opcode: Values = None,
+    service_id: Values = None,
+    order: Values = None,
+    prefix: Optional[bytes] = None,
+    length: Union[int, Collection[int], None] = None,
     dirty: bool = True,
+    concurrent: bool = False,
+    offload: bool = False,
+    deferred: bool = False,
 ):
     """
     Defines a new packet listener inside a proxy plugin.
@@ -30,19 +41,80 @@ def listen(
     and must be re-serialized to account for eventual changes
     done by the handler.
 
+    Frames are filtered by `opcode` for control frames, or `service_id`
+    and `order` for data frames. Each of them accepts a single value or
+    a collection of values, e.g. `order=range(1, 10)`. Additionally, the
+    payload can be required to start with `prefix` bytes and to have a
+    `length` that is, or is contained in, the given value.
+
     Write filters which are conservative in what they accept to
-    keep the number of needed re-serializations low.
+    keep the number of needed re-serializations low. Frames which no
+    listener accepts are forwarded without being parsed at all.
+
+    Listeners which don't touch any shared plugin state may be marked
+    `concurrent` to run without taking the plugin's lock at all.
+
+    CPU-heavy listeners may be plain functions marked `offload` to run
+    on a bounded pool of worker threads instead of blocking all shards.
+    They are still awaited in order, so frames of a session reach them
+    in the order they were received. To call back into the proxy, e.g.
+    for `spawn_shard`, use :func:`trio.from_thread.run`.
+
+    Listeners which only observe frames may be marked `deferred` to run
+    after a frame was forwarded, so they add no latency to it. They get
+    every forwarded frame of a session in order, but cannot change or
+    drop frames anymore. Unless also `concurrent`, they still take the
+    plugin's lock like every other listener.
     """
 
     def decorator(func):
-        func.__proxy_filter__ = Filter(dir, opcode, service_id, order)
-        func.__proxy_dirty__ = dirty
+        func.__proxy_filter__ = Filter(dir, opcode, service_id, order, prefix, length)
+        func.__proxy_dirty__ = dirty and not deferred
+        func.__proxy_concurrent__ = concurrent
+        func.__proxy_offload__ = offload
+        func.__proxy_deferred__ = deferred
         func.__proxy_listener__ = True
         return func
 
     return decorator
 
 
+class Locking(Enum):
+    """How the listeners of a :class:`Plugin` are serialized."""
+
+    #: All listener calls are serialized by one lock per plugin.
+    PLUGIN = auto()
+    #: Listener calls are serialized per session, sessions run in parallel.
+    SESSION = auto()
+
+
+class _Unlocked:
+    """Stands in for a lock when a listener runs concurrently."""
+
+    async def __aenter__(self):
+        pass
+
+    async def __aexit__(self, *exc):
+        pass
+
+
+_UNLOCKED = _Unlocked()
+
+# The number of worker threads running offloaded listeners at once.
+OFFLOAD_THREADS = 4
+
+_offload_limiter = RunVar("offload_limiter")
+
+
+def _offload_limit() -> trio.CapacityLimiter:
+    try:
+        return _offload_limiter.get()
+    except LookupError:
+        limiter = trio.CapacityLimiter(OFFLOAD_THREADS)
+        _offload_limiter.set(limiter)
+        return limiter
+
+
 class Context:
     """
     Processing context for a proxy plugin.
@@ -51,9 +123,15 @@ class Context:
     connection a frame is coming from.
     """
 
-    def __init__(self, shard, session: Session):
+    def __init__(
+        self,
+        shard,
+        session: Session,
+        deferred: Optional[trio.MemorySendChannel] = None,
+    ):
         self._shard = shard
         self.session = session
+        self._deferred = deferred
 
     @property
     def shard_addr(self) -> SocketAddress:
@@ -79,6 +157,7 @@ class PluginMeta(type):
     """
 
     __proxy_listeners__: list[Callable]
+    __proxy_table__: dict[DispatchKey, tuple[Callable, ...]]
 
     def __new__(cls, name, bases, attrs):
         listeners = []
@@ -90,6 +169,7 @@ class PluginMeta(type):
                     listeners.append(value)
 
         new_cls.__proxy_listeners__ = listeners
+        new_cls.__proxy_table__ = {}
         return new_cls
 
 
@@ -105,27 +185,96 @@ class Plugin(metaclass=PluginMeta):
 
     Listener dispatch is task-safe by default, plugin writers do not have
     to employ synchronization when trying to access class state.
+
+    Plugins which only keep state per session should set :attr:`locking`
+    to :attr:`Locking.SESSION`, so that frames of different sessions
+    are not queued behind each other.
     """
 
+    locking: Locking = Locking.PLUGIN
+
     def __init__(self):
         self._lock = trio.Lock()
-
-    async def _dispatch(self, dir: Direction, ctx: Context, frame: Frame) -> bool:
-        should_not_skip = True
-
-        for listener in type(self).__proxy_listeners__:
-            f = getattr(listener, "__proxy_filter__")
-            if dir == f.direction and f.can_dispatch(frame):
-                async with self._lock:
-                    res = await listener(self, ctx, frame)
-                    if res is None:
-                        res = True
-
-                    should_not_skip = should_not_skip and res
-
-                frame.dirty = frame.dirty or getattr(listener, "__proxy_dirty__")
-
-        return should_not_skip
+        self._session_locks: weakref.WeakKeyDictionary[
+            Session, trio.Lock
+        ] = weakref.WeakKeyDictionary()
+
+    @classmethod
+    def _listeners_for(cls, key: DispatchKey) -> tuple[Callable, ...]:
+        # Filters are static per class, so the set of listeners accepting
+        # a given kind of frame is only resolved the first time it is seen.
+        table = cls.__proxy_table__
+        if (listeners := table.get(key)) is None:
+            dir, opcode, service_id, order = key
+            listeners = tuple(
+                listener
+                for listener in cls.__proxy_listeners__
+                if listener.__proxy_filter__.direction == dir
+                and listener.__proxy_filter__.accepts(opcode, service_id, order)
+            )
+            table[key] = listeners
+
+        return listeners
+
+    def _lock_for(
+        self, listener: Callable, ctx: Context
+    ) -> Union[trio.Lock, _Unlocked]:
+        if listener.__proxy_concurrent__:
+            return _UNLOCKED
+
+        if self.locking is Locking.PLUGIN:
+            return self._lock
+
+        session = ctx.session
+        if (lock := self._session_locks.get(session)) is None:
+            lock = self._session_locks[session] = trio.Lock()
+
+        return lock
+
+    async def _call(self, listener: Callable, ctx: Context, frame: Frame):
+        if listener.__proxy_offload__:
+            return await trio.to_thread.run_sync(
+                listener, self, ctx, frame, limiter=_offload_limit()
+            )
+
+        return await listener(self, ctx, frame)
+
+    async def _invoke(
+        self,
+        listener: Callable,
+        ctx: Context,
+        frame: Frame,
+        stats: Optional[ListenerStats] = None,
+    ) -> bool:
+        lock = self._lock_for(listener, ctx)
+        if stats is None:
+            async with lock:
+                res = await self._call(listener, ctx, frame)
+        else:
+            start = time.perf_counter()
+            async with lock:
+                acquired = time.perf_counter()
+                res = await self._call(listener, ctx, frame)
+
+            stats.lock_wait.observe(acquired - start)
+            stats.execution.observe(time.perf_counter() - acquired)
+
+        return True if res is None else res
+
+
+# A listener as resolved for dispatch: its plugin, whether it marks frames
+# dirty, where to record its statistics and whether it is deferred.
+_Entry = tuple[Plugin, Callable, bool, Optional[ListenerStats], bool]
+
+
+def _accepting(
+    listeners: tuple[_Entry, ...], payload: Union[bytes, memoryview]
+) -> tuple[_Entry, ...]:
+    return tuple(
+        entry
+        for entry in listeners
+        if entry[1].__proxy_filter__.accepts_payload(payload)
+    )
 
 
 class PluginCollection:
@@ -134,18 +283,138 @@ class PluginCollection:
 
     A call to :meth:`dispatch` will invoke all eligible listeners
     throughout all registered plugins.
+
+    Eligible listeners are looked up in a dispatch table keyed by the
+    direction and the opcode or service and order of a frame, so each
+    frame only touches the listeners which are interested in it. Only
+    listeners with conditions on the payload are checked per frame.
+
+    Shards call :meth:`select` with just the decoded header of a frame
+    and skip parsing it when no listener is interested.
+
+    When given :class:`Metrics`, the execution time of every listener
+    and the time it waited for its plugin's lock are recorded.
     """
 
-    def __init__(self):
+    def __init__(self, metrics: Optional[Metrics] = None):
         self.plugins = []
+        self.metrics = metrics
+
+        # Maps to the listeners accepting the header and whether any of
+        # them also has conditions on the payload.
+        self._table: dict[DispatchKey, tuple[tuple[_Entry, ...], bool]] = {}
 
     def add(self, plugin: Plugin):
         self.plugins.append(plugin)
 
-    async def dispatch(self, dir: Direction, ctx: Context, frame: Frame) -> bool:
+        # The set of listeners changed, so the table must be rebuilt.
+        self._table.clear()
+
+    def _stats_for(self, plugin: Plugin, listener: Callable) -> Optional[ListenerStats]:
+        if self.metrics is None:
+            return None
+        return self.metrics.listener(type(plugin).__name__, listener.__name__)
+
+    def _listeners_for(self, key: DispatchKey) -> tuple[tuple[_Entry, ...], bool]:
+        if (res := self._table.get(key)) is None:
+            listeners = tuple(
+                (
+                    plugin,
+                    listener,
+                    listener.__proxy_dirty__,
+                    self._stats_for(plugin, listener),
+                    listener.__proxy_deferred__,
+                )
+                for plugin in self.plugins
+                for listener in plugin._listeners_for(key)
+            )
+            filtered = any(
+                listener.__proxy_filter__.filters_payload
+                for _, listener, _, _, _ in listeners
+            )
+            res = self._table[key] = (listeners, filtered)
+
+        return res
+
+    def select(
+        self, dir: Direction, raw: memoryview, header: Header
+    ) -> tuple[_Entry, ...]:
+        """Selects the listeners interested in a raw frame with a decoded header."""
+        opcode, service_id, order, start, end = header
+
+        listeners, filtered = self._listeners_for((dir, opcode, service_id, order))
+        if filtered:
+            listeners = _accepting(listeners, raw[start:end])
+
+        return listeners
+
+    def wants(self, dir: Direction, header: Header) -> bool:
+        """Checks if any listener may be interested in a frame with a header."""
+        opcode, service_id, order, _, _ = header
+
+        listeners, _ = self._listeners_for((dir, opcode, service_id, order))
+        return bool(listeners)
+
+    async def invoke(
+        self, listeners: tuple[_Entry, ...], ctx: Context, frame: Frame
+    ) -> bool:
+        """Invokes previously selected listeners on a frame."""
         should_not_skip = True
-        for plugin in self.plugins:
-            res = await plugin._dispatch(dir, ctx, frame)
+        for plugin, listener, dirty, stats, deferred in listeners:
+            if deferred:
+                continue
+
+            res = await plugin._invoke(listener, ctx, frame, stats)
             should_not_skip = should_not_skip and res
 
+            frame.dirty = frame.dirty or dirty
+
         return should_not_skip
+
+    async def _invoke_deferred(
+        self, listeners: tuple[_Entry, ...], ctx: Context, frame: Frame
+    ):
+        for plugin, listener, _, stats, _ in listeners:
+            await plugin._invoke(listener, ctx, frame, stats)
+
+    async def defer(self, listeners: tuple[_Entry, ...], ctx: Context, frame: Frame):
+        """Hands a forwarded frame to the deferred ones of selected listeners."""
+        deferred = tuple(entry for entry in listeners if entry[4])
+        if not deferred:
+            return
+
+        # The frame outlives the buffer it was received into.
+        if frame.dirty:
+            raw = bytearray()
+            frame.write_into(raw)
+        else:
+            raw = frame.raw.tobytes()
+        frame = Frame.parse(raw)
+        if ctx._deferred is None:
+            await self._invoke_deferred(deferred, ctx, frame)
+        else:
+            await ctx._deferred.send((deferred, frame))
+
+    async def run_deferred(
+        self,
+        ctx: Context,
+        rx: trio.MemoryReceiveChannel,
+    ):
+        """Runs deferred listeners on the frames of a session until closed."""
+        async with rx:
+            async for listeners, frame in rx:
+                await self._invoke_deferred(listeners, ctx, frame)
+
+    async def dispatch(self, dir: Direction, ctx: Context, frame: Frame) -> bool:
+        listeners, filtered = self._listeners_for(dispatch_key(dir, frame))
+        if filtered:
+            listeners = _accepting(listeners, frame.payload)
+
+        res = await self.invoke(listeners, ctx, frame)
+
+        # Without any forwarding, deferred listeners just run afterwards.
+        deferred = tuple(entry for entry in listeners if entry[4])
+        if deferred:
+            await self._invoke_deferred(deferred, ctx, frame)
+
+        return res
@@ -8,10 +8,10 @@ from . import Direction, Plugin, listen
 class VerboseLogPlugin(Plugin):
     """Logs packets with their direction to stdout."""
 
-    @listen(Direction.CLIENT_TO_SERVER, dirty=False)
+    @listen(Direction.CLIENT_TO_SERVER, dirty=False, concurrent=True)
     async def cs(self, _, frame: Frame):
-        logger.info(f"[C -> S] {frame.original.hex(' ')}")
+        logger.info(f"[C -> S] {frame.raw.hex(' ')}")
 
-    @listen(Direction.SERVER_TO_CLIENT, dirty=False)
+    @listen(Direction.SERVER_TO_CLIENT, dirty=False, concurrent=True)
     async def sc(self, _, frame: Frame):
-        logger.info(f"[S -> C] {frame.original.hex(' ')}")
+        logger.info(f"[S -> C] {frame.raw.hex(' ')}")
@@ -0,0 +1,320 @@
+import queue
+import threading
+import time
+import weakref
+from datetime import datetime
+from pathlib import Path
+from struct import Struct
+from typing import BinaryIO, Optional, Union
+
+import trio
+from loguru import logger
+
+from wizproxy.proto import Frame, SocketAddress
+from wizproxy.session import Session
+
+from . import Context, Direction, Locking, Plugin, listen
+
+# Section Header Block and Interface Description Block for Ethernet.
+SECTION_HEADER = Struct("<IIIHHqI")
+INTERFACE_DESCRIPTION = Struct("<IIHHII")
+
+# Enhanced Packet Block, up to the captured data.
+ENHANCED_PACKET = Struct("<IIIIIII")
+OPTION = Struct("<HH")
+BLOCK_TRAILER = Struct("<I")
+
+# Packet headers preceding every frame; the fields which change for
+# every packet are patched into a per-stream template.
+ETHER_IP_TCP = Struct("!6s6sHBBHHHBBH4s4sHHIIBBHHH")
+IP_TOTAL_LENGTH = Struct("!H")
+IP_CHECKSUM = Struct("!H")
+TCP_SEQ = Struct("!I")
+
+IP_OFFSET = 14
+HEADERS_SIZE = ETHER_IP_TCP.size
+
+LINKTYPE_ETHERNET = 1
+OPT_COMMENT = 1
+END_OF_OPTIONS = OPTION.pack(0, 0)
+
+# How many packets may be pending before listeners have to wait.
+QUEUE_SIZE = 4096
+
+# How many pending packets the writer thread handles in one go.
+BATCH_SIZE = 256
+
+
+def _pad(length: int) -> int:
+    return -length % 4
+
+
+def _comment_option(comment: str) -> bytes:
+    raw = comment.encode()
+    return OPTION.pack(OPT_COMMENT, len(raw)) + raw + bytes(_pad(len(raw)))
+
+
+def _ones_complement_sum(data: bytes) -> int:
+    total = sum(IP_TOTAL_LENGTH.unpack_from(data, i)[0] for i in range(0, len(data), 2))
+    while total > 0xFFFF:
+        total = (total & 0xFFFF) + (total >> 16)
+    return total
+
+
+class _StreamTemplate:
+    """Prebuilt packet headers for one direction of a session."""
+
+    __slots__ = ("headers", "checksum_base", "comment", "option", "seq")
+
+    def __init__(self, src: SocketAddress, dest: SocketAddress, comment: str):
+        headers = ETHER_IP_TCP.pack(
+            b"\x02\x00\x00\x00\x00\x02",  # Destination MAC.
+            b"\x02\x00\x00\x00\x00\x01",  # Source MAC.
+            0x0800,  # IPv4.
+            0x45,  # Version and IHL.
+            0,  # DSCP and ECN.
+            0,  # Total length, patched per packet.
+            0,  # Identification.
+            0x4000,  # Don't fragment.
+            64,  # TTL.
+            6,  # TCP.
+            0,  # Header checksum, patched per packet.
+            _ip_bytes(src),
+            _ip_bytes(dest),
+            src.port,
+            dest.port,
+            0,  # Sequence number, patched per packet.
+            0,  # Acknowledgement number.
+            5 << 4,  # Data offset.
+            0x18,  # PSH, ACK.
+            0xFFFF,  # Window size.
+            0,  # Checksum; not computed.
+            0,  # Urgent pointer.
+        )
+
+        self.headers = headers
+        self.checksum_base = _ones_complement_sum(headers[IP_OFFSET : IP_OFFSET + 20])
+        self.comment = comment
+        self.option = _comment_option(comment)
+        self.seq = 0
+
+    def build(self, seq: int, size: int) -> bytearray:
+        headers = bytearray(self.headers)
+
+        # Oversized frames get a zero length like segmentation offloaded captures.
+        total_length = 40 + size
+        if total_length > 0xFFFF:
+            total_length = 0
+
+        checksum = self.checksum_base + total_length
+        checksum = (checksum & 0xFFFF) + (checksum >> 16)
+
+        IP_TOTAL_LENGTH.pack_into(headers, IP_OFFSET + 2, total_length)
+        IP_CHECKSUM.pack_into(headers, IP_OFFSET + 10, ~checksum & 0xFFFF)
+        TCP_SEQ.pack_into(headers, IP_OFFSET + 24, seq)
+
+        return headers
+
+
+def _ip_bytes(addr: SocketAddress) -> bytes:
+    try:
+        return bytes(int(part) for part in addr.ip.split(b"."))
+    except ValueError:
+        # Not an IPv4 address, so the capture has to do without it.
+        return bytes(4)
+
+
+class PcapNgPlugin(Plugin):
+    """
+    A plugin which writes frame data to pcapng files.
+
+    Produces the same captures as :class:`ScapyPlugin`, with each
+    frame written as a TCP packet between the client and the remote
+    server and annotated with a machine-parseable comment.
+
+    Packet blocks are serialized directly from header templates that
+    are prepared once per session, and written in batches by a single
+    background thread fed through a bounded queue. Listeners only have
+    to enqueue the frame data.
+    """
+
+    # Templates and sequence numbers are per session and the queue is
+    # thread-safe, so only frames of the same session need to be ordered.
+    locking = Locking.SESSION
+
+    def __init__(self, file: BinaryIO):
+        super().__init__()
+
+        self.file = file
+
+        self._templates: weakref.WeakKeyDictionary[
+            Session, tuple[_StreamTemplate, _StreamTemplate]
+        ] = weakref.WeakKeyDictionary()
+
+        self._queue: queue.Queue = queue.Queue(QUEUE_SIZE)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+        # Set when writing to the file failed; no more packets are captured.
+        self.error: Optional[Exception] = None
+
+        self.file.write(self._file_header())
+        self._thread.start()
+
+    @classmethod
+    def from_file(cls, path: Path):
+        if path.is_dir():
+            now = datetime.now()
+            path = path / now.strftime("wizproxy_%Y-%m-%d_%H-%M-%S.pcapng")
+
+        return cls(open(path.resolve(), "wb"))
+
+    def close(self):
+        """Writes out all pending packets and closes the file."""
+        self._queue.put(None)
+        self._thread.join()
+
+        self.file.close()
+
+    @staticmethod
+    def _file_header() -> bytes:
+        shb = SECTION_HEADER.pack(
+            0x0A0D0D0A, SECTION_HEADER.size, 0x1A2B3C4D, 1, 0, -1, SECTION_HEADER.size
+        )
+        idb = INTERFACE_DESCRIPTION.pack(
+            1,
+            INTERFACE_DESCRIPTION.size,
+            LINKTYPE_ETHERNET,
+            0,
+            0,
+            INTERFACE_DESCRIPTION.size,
+        )
+
+        return shb + idb
+
+    def _get_templates(self, ctx: Context) -> tuple[_StreamTemplate, _StreamTemplate]:
+        session = ctx.session
+        if (templates := self._templates.get(session)) is None:
+            comment = "\n".join(
+                [
+                    f"Shard {ctx.shard_addr}",
+                    f"Session {session.sid}",
+                    f"Client {session.client}",
+                    f"Server {session.server}",
+                ]
+            )
+
+            templates = (
+                _StreamTemplate(session.client, session.server, comment),
+                _StreamTemplate(session.server, session.client, comment),
+            )
+            self._templates[session] = templates
+
+        return templates
+
+    async def write_to_file(
+        self, ctx: Context, template: _StreamTemplate, frame: Frame
+    ):
+        if self.error is not None:
+            return
+
+        option = template.option
+        if frame.opcode == 5:
+            # When this is a Session Accept frame, also include the
+            # AES key and nonce for reference.
+            aes_context = ctx.session.server_aes
+            if aes_context is not None:
+                option = _comment_option(
+                    f"{template.comment}\n"
+                    f"AES-Key: {aes_context.key.hex()}\n"
+                    f"AES-Nonce: {aes_context.decryptor.nonce.hex()}"
+                )
+
+        # Sequence numbers are tracked here so they match the frame order.
+        # The data is copied, a view would pin the buffer it was received in.
+        data = frame.original
+        seq = template.seq
+        template.seq = (seq + len(data)) & 0xFFFF_FFFF
+
+        item = (time.time_ns() // 1000, template, seq, option, data)
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            # The writer can't keep up, so wait for it without blocking the loop.
+            await trio.to_thread.run_sync(self._queue.put, item)
+
+    @listen(Direction.CLIENT_TO_SERVER, dirty=False)
+    async def clientbound(self, ctx: Context, frame: Frame):
+        await self.write_to_file(ctx, self._get_templates(ctx)[0], frame)
+
+    @listen(Direction.SERVER_TO_CLIENT, dirty=False)
+    async def serverbound(self, ctx: Context, frame: Frame):
+        await self.write_to_file(ctx, self._get_templates(ctx)[1], frame)
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < BATCH_SIZE:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            # After a failure, packets are still drained so nobody waits on
+            # a full queue, but they are dropped.
+            if self.error is None:
+                try:
+                    self._write(batch)
+                except Exception as e:
+                    logger.error(f"Capture stopped, writing it failed: {e}")
+                    self.error = e
+
+            if None in batch:
+                return
+
+    def _write(self, batch: list):
+        out = bytearray()
+        for item in batch:
+            if item is None:
+                self.file.write(out)
+                self.file.flush()
+                return
+
+            self._serialize(out, *item)
+
+        self.file.write(out)
+
+    @staticmethod
+    def _serialize(
+        out: bytearray,
+        timestamp: int,
+        template: _StreamTemplate,
+        seq: int,
+        option: bytes,
+        data: Union[bytes, memoryview],
+    ):
+        packet_len = HEADERS_SIZE + len(data)
+        padding = _pad(packet_len)
+        block_len = (
+            ENHANCED_PACKET.size
+            + packet_len
+            + padding
+            + len(option)
+            + OPTION.size
+            + BLOCK_TRAILER.size
+        )
+
+        out += ENHANCED_PACKET.pack(
+            6,
+            block_len,
+            0,
+            timestamp >> 32,
+            timestamp & 0xFFFF_FFFF,
+            packet_len,
+            packet_len,
+        )
+        out += template.build(seq, len(data))
+        out += data
+        out += bytes(padding)
+        out += option
+        out += END_OF_OPTIONS
+        out += BLOCK_TRAILER.pack(block_len)
@@ -0,0 +1,122 @@
+import queue
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Optional
+
+import trio
+from loguru import logger
+
+from wizproxy.proto import Frame
+from wizproxy.record import Compression, LogWriter
+
+from . import Context, Direction, Locking, Plugin, listen
+
+# How many frames may be pending before listeners have to wait.
+QUEUE_SIZE = 4096
+
+# Seconds after which pending records are written out at the latest.
+FLUSH_INTERVAL = 5.0
+
+
+class RecordPlugin(Plugin):
+    """
+    A plugin which records frames to a compact, indexed traffic log.
+
+    Unlike pcapng captures, these logs can be queried for specific
+    sessions, message types and time ranges without a full scan using
+    :class:`wizproxy.record.LogReader`.
+
+    Records are written by a background thread fed through a bounded
+    queue, listeners only have to enqueue the frame data.
+    """
+
+    # Only frames of the same session need to be kept in order.
+    locking = Locking.SESSION
+
+    def __init__(self, writer: LogWriter):
+        super().__init__()
+
+        self.writer = writer
+
+        self._queue: queue.Queue = queue.Queue(QUEUE_SIZE)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+        # Set when writing to the log failed; no more frames are recorded.
+        self.error: Optional[Exception] = None
+
+        self._thread.start()
+
+    @classmethod
+    def from_file(cls, path: Path, compression: Compression = Compression.ZLIB):
+        if path.is_dir():
+            now = datetime.now()
+            path = path / now.strftime("wizproxy_%Y-%m-%d_%H-%M-%S.wzlog")
+
+        return cls(LogWriter(path.resolve(), compression))
+
+    def close(self):
+        """Writes out all pending records and closes the log."""
+        self._queue.put(None)
+        self._thread.join()
+
+        self.writer.close()
+
+    async def record(self, ctx: Context, client: bool, frame: Frame):
+        if self.error is not None:
+            return
+
+        item = (
+            time.time_ns() // 1000,
+            ctx.session.sid,
+            client,
+            frame.opcode,
+            frame.service_id,
+            frame.order,
+            frame.payload,
+        )
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            # The writer can't keep up, so wait for it without blocking the loop.
+            await trio.to_thread.run_sync(self._queue.put, item)
+
+    @listen(Direction.CLIENT_TO_SERVER, dirty=False)
+    async def clientbound(self, ctx: Context, frame: Frame):
+        await self.record(ctx, True, frame)
+
+    @listen(Direction.SERVER_TO_CLIENT, dirty=False)
+    async def serverbound(self, ctx: Context, frame: Frame):
+        await self.record(ctx, False, frame)
+
+    def _run(self):
+        last_flush = time.monotonic()
+
+        while True:
+            # Don't keep records in memory for long, even when frames keep
+            # trickling in too slowly to fill a chunk.
+            timeout = max(0.0, last_flush + FLUSH_INTERVAL - time.monotonic())
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = ()
+
+            if item is None:
+                return
+
+            flush = time.monotonic() - last_flush >= FLUSH_INTERVAL
+            if flush:
+                last_flush = time.monotonic()
+
+            # After a failure, frames are still drained so nobody waits on
+            # a full queue, but they are dropped.
+            if self.error is None:
+                try:
+                    if item:
+                        self.writer.append(*item)
+                    if flush:
+                        self.writer.flush()
+                except Exception as e:
+                    logger.error(f"Recording stopped, writing the log failed: {e}")
+                    self.error = e
@@ -1,4 +1,5 @@
 from .addr import SocketAddress  # noqa
 from .bytes import Bytes  # noqa
-from .frame import Frame  # noqa
+from .frame import Frame, Header, parse_header  # noqa
 from .handshake import EncryptedMessage, SignedMessage  # noqa
+from .messages import Message, MessageRegistry, MessageView  # noqa
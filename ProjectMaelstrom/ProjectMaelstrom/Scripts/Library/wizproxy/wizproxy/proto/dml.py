@@ -1,21 +1,9 @@
 from dataclasses import dataclass
 from enum import IntEnum
-from typing import Any, Iterable
+from struct import Struct
+from typing import Any, Iterable, Union
 
-from .bytes import Bytes
-
-_DML_DECODE_LOOKUP = (
-    (Bytes.i8, Bytes.write_i8),
-    (Bytes.u8, Bytes.write_u8),
-    (Bytes.u16, Bytes.write_u16),
-    (Bytes.i32, Bytes.write_i32),
-    (Bytes.u32, Bytes.write_u32),
-    (Bytes.u64, Bytes.write_u64),
-    (Bytes.string, Bytes.write_string),
-    (Bytes.wstr, Bytes.write_wstr),
-    (Bytes.f32, Bytes.write_f32),
-    (Bytes.f64, Bytes.write_f64),
-)
+from .bytes import U16
 
 
 class Type(IntEnum):
@@ -31,33 +19,193 @@ class Type(IntEnum):
     WSTR = 7
     FLT = 8
     DBL = 9
+    SHRT = 10
+
+
+# struct format characters of fixed-size types; the rest are length-prefixed.
+_DML_FORMATS = {
+    Type.BYT: "b",
+    Type.UBYT: "B",
+    Type.SHRT: "h",
+    Type.USHRT: "H",
+    Type.INT: "i",
+    Type.UINT: "I",
+    Type.GID: "Q",
+    Type.FLT: "f",
+    Type.DBL: "d",
+}
+
+
+class _Fixed:
+    """A run of consecutive fixed-size fields, packed as one struct."""
+
+    __slots__ = ("names", "struct", "fields")
+
+    def __init__(self, names: list[str], fmt: str):
+        self.names = tuple(names)
+        self.struct = Struct("<" + fmt)
+
+        # Relative offset and struct of every individual field in the run.
+        self.fields = {}
+        offset = 0
+        for name, c in zip(names, fmt):
+            s = Struct("<" + c)
+            self.fields[name] = (offset, s)
+            offset += s.size
+
+
+class _Var:
+    """A single length-prefixed STR or WSTR field."""
+
+    __slots__ = ("name", "wide")
+
+    def __init__(self, name: str, wide: bool):
+        self.name = name
+        self.wide = wide
+
+    def read(self, raw, offset: int) -> tuple[Union[bytes, str], int]:
+        size = U16.unpack_from(raw, offset)[0]
+        if self.wide:
+            size *= 2
+
+        start = offset + U16.size
+        end = start + size
+
+        data = bytes(raw[start:end])
+        return (data.decode("utf-16-le") if self.wide else data), end
+
+    def skip(self, raw, offset: int) -> int:
+        size = U16.unpack_from(raw, offset)[0]
+        return offset + U16.size + (size * 2 if self.wide else size)
+
+    def write(self, value: Union[bytes, str]) -> bytes:
+        if self.wide:
+            value = value.encode("utf-16-le")
+            return U16.pack(len(value) // 2) + value
+
+        return U16.pack(len(value)) + value
+
+
+def _compile(layout: Iterable[tuple[str, Type]]) -> list[Union[_Fixed, _Var]]:
+    segments = []
+    names, fmt = [], ""
+
+    for name, typ in layout:
+        if c := _DML_FORMATS.get(typ):
+            names.append(name)
+            fmt += c
+            continue
+
+        if names:
+            segments.append(_Fixed(names, fmt))
+            names, fmt = [], ""
+
+        segments.append(_Var(name, typ == Type.WSTR))
+
+    if names:
+        segments.append(_Fixed(names, fmt))
+
+    return segments
 
 
 @dataclass
 class Layout:
-    """Describes the data layout of a DML message."""
+    """
+    Describes the data layout of a DML message.
+
+    Layouts are compiled into a codec on construction; consecutive
+    fixed-size fields are packed and unpacked with a single struct
+    and strings are handled in place at their offsets.
+    """
 
     layout: Iterable[tuple[str, Type]]
 
     def __init__(self, *args: tuple[str, Type]):
         self.layout = args
+        self._segments = _compile(args)
 
     def encode(self, msg: dict[str, Any]) -> bytes:
-        buf = Bytes()
+        parts = []
 
-        for name, typ in self.layout:
-            value = msg[name]
-            _, encode = _DML_DECODE_LOOKUP[typ]
-            encode(buf, value)
+        for seg in self._segments:
+            if isinstance(seg, _Fixed):
+                parts.append(seg.struct.pack(*[msg[name] for name in seg.names]))
+            else:
+                parts.append(seg.write(msg[seg.name]))
 
-        return buf.getvalue()
+        return b"".join(parts)
 
     def decode(self, raw: bytes) -> dict[str, Any]:
-        buf = Bytes(raw)
+        msg = {}
+        offset = 0
+
+        for seg in self._segments:
+            if isinstance(seg, _Fixed):
+                msg.update(zip(seg.names, seg.struct.unpack_from(raw, offset)))
+                offset += seg.struct.size
+            else:
+                msg[seg.name], offset = seg.read(raw, offset)
+
+        return msg
+
+    def _spans(self, raw: bytes, names: Iterable[str]):
+        # Yields the (name, segment, start, end) of wanted fields in
+        # message order, skipping over everything else in between.
+        wanted = set(names)
+        offset = 0
+
+        for seg in self._segments:
+            if not wanted:
+                return
+
+            if isinstance(seg, _Fixed):
+                for name in wanted.intersection(seg.fields):
+                    rel, s = seg.fields[name]
+                    yield name, s, offset + rel, offset + rel + s.size
+                    wanted.discard(name)
+
+                offset += seg.struct.size
+            else:
+                end = seg.skip(raw, offset)
+                if seg.name in wanted:
+                    yield seg.name, seg, offset, end
+                    wanted.discard(seg.name)
+
+                offset = end
+
+        if wanted:
+            raise KeyError(f"unknown message fields: {', '.join(sorted(wanted))}")
+
+    def decode_fields(self, raw: bytes, *names: str) -> dict[str, Any]:
+        """Decodes only the given fields of a message."""
         msg = {}
 
-        for name, typ in self.layout:
-            decode, _ = _DML_DECODE_LOOKUP[typ]
-            msg[name] = decode(buf)
+        for name, seg, start, _ in self._spans(raw, names):
+            if isinstance(seg, _Var):
+                msg[name] = seg.read(raw, start)[0]
+            else:
+                msg[name] = seg.unpack_from(raw, start)[0]
 
         return msg
+
+    def patch(self, raw: bytes, changes: dict[str, Any]) -> bytes:
+        """
+        Replaces the given fields in an encoded message.
+
+        All other message data is copied over verbatim without
+        being decoded.
+        """
+        spans = sorted(self._spans(raw, changes.keys()), key=lambda span: span[2])
+
+        parts = []
+        last = 0
+        for name, seg, start, end in spans:
+            parts.append(raw[last:start])
+            if isinstance(seg, _Var):
+                parts.append(seg.write(changes[name]))
+            else:
+                parts.append(seg.pack(changes[name]))
+            last = end
+
+        parts.append(raw[last:])
+        return b"".join(parts)
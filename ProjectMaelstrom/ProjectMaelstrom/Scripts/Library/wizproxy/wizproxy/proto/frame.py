@@ -1,10 +1,52 @@
-from dataclasses import dataclass, field
-from typing import Optional
+from struct import Struct
+from typing import ClassVar, Optional, Union
 
 from .bytes import Bytes
+from .messages import MessageRegistry, MessageView
+
+# Frame headers for quick parsing, indexed by whether the frame is large.
+# Control frames decode (magic, size, opcode) and data frames decode
+# (magic, service_id, order, payload_len); everything else is skipped.
+_CONTROL_HEADERS = (Struct("<HHxB2x"), Struct("<H2xIxB2x"))
+_DATA_HEADERS = (Struct("<H6xBBH"), Struct("<H10xBBH"))
+
+# Frame headers for serialization, indexed by whether the frame is large.
+# Control frames encode (magic, size, [large size], 1, opcode, 0) and data
+# frames additionally (service_id, order, payload_len) after that.
+_CONTROL_WRITERS = (Struct("<HHBBH"), Struct("<HHIBBH"))
+_DATA_WRITERS = (Struct("<HHBBHBBH"), Struct("<HHIBBHBBH"))
+
+# The decoded header of a frame:
+# (opcode, service_id, order, payload start, payload end).
+Header = tuple[Optional[int], Optional[int], Optional[int], int, int]
+
+
+def parse_header(raw: memoryview) -> Header:
+    """
+    Decodes the header of a raw frame.
+
+    This only looks at the first 8 to 12 bytes of the frame, which
+    is enough to decide what to do with it before creating a
+    :class:`Frame` object at all.
+    """
+    # Large frames carry an additional 32-bit size after the header.
+    large = raw[3] >> 7
+
+    if raw[4 + 4 * large] != 0:
+        header = _CONTROL_HEADERS[large]
+        magic, payload_len, opcode = header.unpack_from(raw)
+        service_id, order = None, None
+    else:
+        header = _DATA_HEADERS[large]
+        magic, service_id, order, payload_len = header.unpack_from(raw)
+        opcode = None
+
+    assert magic == 0xF00D
+
+    start = header.size
+    return opcode, service_id, order, start, start + payload_len - 4
 
 
-@dataclass
 class Frame:
     """
     Parsed representation of a KingsIsle network frame.
@@ -12,76 +54,169 @@ class Frame:
     The payload portion needs implementation-defined handling
     depending on whether it is a control or data frame. It is
     not parsed by default.
-    """
 
-    original: bytes
+    Frames obtained from :meth:`parse` only decode their header
+    eagerly and keep a view of the raw frame data. The payload
+    and the :attr:`original` bytes are materialized on first
+    access, so frames nobody looks at are never copied.
 
-    opcode: Optional[int]
-    service_id: Optional[int]
-    order: Optional[int]
-    payload: bytes
+    When a :class:`MessageRegistry` is installed as :attr:`registry`,
+    data frames of known messages expose their fields through
+    :attr:`message`.
+    """
 
-    # Controls whether a frame needs to be reserialized after a change.
-    dirty: bool = field(default=False)
+    registry: ClassVar[Optional[MessageRegistry]] = None
+
+    __slots__ = (
+        "raw",
+        "opcode",
+        "service_id",
+        "order",
+        "dirty",
+        "_original",
+        "_payload",
+        "_payload_start",
+        "_payload_end",
+        "_message",
+    )
+
+    def __init__(
+        self,
+        original: Union[bytes, memoryview],
+        opcode: Optional[int],
+        service_id: Optional[int],
+        order: Optional[int],
+        payload: Optional[bytes],
+        dirty: bool = False,
+    ):
+        self.raw = memoryview(original)
+
+        self.opcode = opcode
+        self.service_id = service_id
+        self.order = order
+
+        # Controls whether a frame needs to be reserialized after a change.
+        self.dirty = dirty
+
+        self._original = original if isinstance(original, bytes) else None
+        self._payload = payload
+        self._payload_start = 0
+        self._payload_end = 0
+        self._message = None
+
+    def __repr__(self) -> str:
+        return (
+            f"{self.__class__.__name__}(opcode={self.opcode}, "
+            f"service_id={self.service_id}, order={self.order}, "
+            f"size={len(self.raw)}, dirty={self.dirty})"
+        )
+
+    @property
+    def original(self) -> bytes:
+        if self._original is None:
+            self._original = self.raw.tobytes()
+        return self._original
+
+    @property
+    def payload(self) -> bytes:
+        if self._payload is None:
+            self._payload = self.raw[self._payload_start : self._payload_end].tobytes()
+        return self._payload
+
+    @payload.setter
+    def payload(self, value: bytes):
+        self._payload = value
+        self._message = None
+
+    @property
+    def message(self) -> Optional[MessageView]:
+        """
+        Lazily decoded fields of the message in a data frame.
+
+        This is :data:`None` for control frames, unknown messages and
+        when no :attr:`registry` is installed.
+        """
+        if self._message is None and self.service_id is not None:
+            if (registry := self.registry) is not None:
+                self._message = registry.view(self.service_id, self.order, self.payload)
+        return self._message
 
     @classmethod
-    def read(cls, buf: Bytes) -> "Frame":
-        buf.seek(0)
-        original = buf.getvalue()
+    def parse(
+        cls, raw: Union[bytes, memoryview], header: Optional[Header] = None
+    ) -> "Frame":
+        """
+        Parses the header of a frame without copying any data.
 
-        assert buf.u16() == 0xF00D
+        The payload is only sliced out of ``raw`` when accessed,
+        so the backing memory must stay valid while the frame is
+        in use.
 
-        size = buf.u16()
-        if size >= 0x8000:
-            size = buf.u32()
+        A ``header`` previously obtained from :func:`parse_header`
+        may be passed in so it is not decoded twice.
+        """
+        raw = memoryview(raw)
+        if header is None:
+            header = parse_header(raw)
 
-        is_control = buf.u8() != 0
-        opcode = buf.u8()
-        buf.u16()  # Reserved.
+        opcode, service_id, order, start, end = header
 
-        if is_control:
-            service_id, order = None, None
-            payload = buf.read(size - 4)
-        else:
-            service_id = buf.u8()
-            order = buf.u8()
-            payload_len = buf.u16()
-            payload = buf.read(payload_len - 4)
-            buf.u8()  # Trailing null byte.
+        frame = cls(raw, opcode, service_id, order, None)
+        frame._payload_start = start
+        frame._payload_end = end
 
-        return cls(original, opcode if is_control else None, service_id, order, payload)
+        return frame
+
+    @classmethod
+    def read(cls, buf: Bytes) -> "Frame":
+        return cls.parse(buf.getvalue())
 
     def write(self, buf: Bytes) -> int:
-        buf.seek(0)
+        out = bytearray()
+        written = self.write_into(out)
 
-        written = 0
-        payload_len = len(self.payload)
+        buf.load_frame(out)
+        return written
 
-        size = 4 + payload_len
-        if self.opcode is None:
-            size += 5
+    def write_into(self, out: bytearray, offset: int = 0) -> int:
+        """
+        Serializes the frame into ``out`` at ``offset``.
 
-        written += buf.write_u16(0xF00D)
-        if size < 0x8000:
-            written += buf.write_u16(size)
-        else:
-            written += buf.write_u16(0x8000)
-            written += buf.write_u32(size)
+        The header is packed with a single struct and the payload is
+        copied once. ``out`` is grown if needed, but never shrunk, so
+        it can be reused for many frames.
+
+        Returns the number of bytes written.
+        """
+        payload = self.payload
+        payload_len = len(payload)
 
         is_control = self.opcode is not None
+        size = 4 + payload_len if is_control else 9 + payload_len
 
-        written += buf.write_u8(1 if is_control else 0)
-        written += buf.write_u8(self.opcode or 0)
-        written += buf.write_u16(0)
+        # Large frames store their actual size after a marker.
+        large = size >= 0x8000
+        sizes = (0x8000, size) if large else (size,)
 
         if is_control:
-            written += buf.write(self.payload)
+            header = _CONTROL_WRITERS[large]
+            fields = (1, self.opcode, 0)
+            end = offset + header.size + payload_len
         else:
-            written += buf.write_u8(self.service_id)
-            written += buf.write_u8(self.order)
-            written += buf.write_u16(payload_len + 4)
-            written += buf.write(self.payload)
-            written += buf.write_u8(0)
+            header = _DATA_WRITERS[large]
+            fields = (0, 0, 0, self.service_id, self.order, payload_len + 4)
+            end = offset + header.size + payload_len + 1
 
-        buf.truncate()
-        return written
+        if len(out) < end:
+            out.extend(bytes(end - len(out)))
+
+        header.pack_into(out, offset, 0xF00D, *sizes, *fields)
+
+        start = offset + header.size
+        out[start : start + payload_len] = payload
+
+        # Data frames are terminated by a null byte.
+        if not is_control:
+            out[end - 1] = 0
+
+        return end - offset
@@ -0,0 +1,197 @@
+import json
+import xml.etree.ElementTree as ET
+from pathlib import Path
+from typing import Any, Iterable, Optional, Union
+
+from .dml import Layout, Type
+
+
+class Message:
+    """
+    Definition of a DML message from a message definition file.
+
+    :param name: The name of the message, e.g. `MSG_SERVERTRANSFER`.
+    :param service_id: The service the message belongs to.
+    :param order: The order of the message within its service.
+    :param layout: The compiled layout of the message fields.
+    """
+
+    __slots__ = ("name", "service_id", "order", "layout")
+
+    def __init__(self, name: str, service_id: int, order: int, layout: Layout):
+        self.name = name
+        self.service_id = service_id
+        self.order = order
+        self.layout = layout
+
+    def __repr__(self) -> str:
+        return (
+            f"{self.__class__.__name__}({self.name}, "
+            f"service_id={self.service_id}, order={self.order})"
+        )
+
+
+class MessageView:
+    """
+    Lazy attribute-style access to the fields of an encoded message.
+
+    Fields are only decoded when they are accessed for the first time,
+    everything else in the message is skipped over.
+    """
+
+    __slots__ = ("message", "_raw", "_values")
+
+    def __init__(self, message: Message, raw: Union[bytes, memoryview]):
+        self.message = message
+        self._raw = raw
+        self._values: dict[str, Any] = {}
+
+    def __repr__(self) -> str:
+        return f"{self.__class__.__name__}({self.message.name})"
+
+    def __getattr__(self, name: str) -> Any:
+        values = self._values
+        if name not in values:
+            try:
+                values.update(self.message.layout.decode_fields(self._raw, name))
+            except KeyError:
+                raise AttributeError(
+                    f"{self.message.name} has no field '{name}'"
+                ) from None
+
+        return values[name]
+
+    def decode(self) -> dict[str, Any]:
+        """Decodes all fields of the message at once."""
+        return self.message.layout.decode(self._raw)
+
+
+def _layout(fields: Iterable[tuple[str, str]]) -> Layout:
+    try:
+        return Layout(*((name, Type[typ]) for name, typ in fields))
+    except KeyError as e:
+        raise ValueError(f"unsupported DML type {e}") from None
+
+
+def _order_messages(
+    path: Path, messages: list[tuple[str, Optional[int], Layout]]
+) -> Iterable[tuple[str, int, Layout]]:
+    missing = [name for name, order, _ in messages if order is None]
+
+    # Numbering only some messages could shift the ones with explicit orders.
+    if missing and len(missing) < len(messages):
+        raise ValueError(
+            f"{path} mixes messages with and without explicit orders, "
+            f"e.g. {missing[0]}"
+        )
+
+    # Without explicit orders, messages are numbered alphabetically by name.
+    if missing:
+        messages = sorted(messages, key=lambda msg: msg[0])
+        for order, (name, _, layout) in enumerate(messages, 1):
+            yield name, order, layout
+    else:
+        yield from messages
+
+
+def _parse_xml(path: Path) -> tuple[int, list[tuple[str, Optional[int], Layout]]]:
+    root = ET.parse(path).getroot()
+
+    service_id = None
+    messages = []
+
+    for element in root:
+        record = element.find("RECORD")
+        if record is None:
+            continue
+
+        if element.tag == "_ProtocolInfo":
+            service_id = int(record.findtext("ServiceID"))
+            continue
+
+        order = None
+        fields = []
+        for field in record:
+            if field.tag == "_MsgOrder":
+                order = int(field.text)
+
+            # Metadata fields are not transferred.
+            if field.get("NOXFER", "").upper() == "TRUE":
+                continue
+
+            fields.append((field.tag, field.get("TYPE")))
+
+        messages.append((element.tag, order, _layout(fields)))
+
+    if service_id is None:
+        raise ValueError(f"{path} has no protocol info")
+
+    return service_id, messages
+
+
+def _parse_json(path: Path) -> tuple[int, list[tuple[str, Optional[int], Layout]]]:
+    # {"service_id": 5, "messages": {"MSG_...": {"order": 1, "fields": [...]}}}
+    # where fields are lists of [name, type] pairs.
+    data = json.loads(path.read_text())
+
+    messages = [
+        (name, msg.get("order"), _layout(msg["fields"]))
+        for name, msg in data["messages"].items()
+    ]
+
+    return data["service_id"], messages
+
+
+class MessageRegistry:
+    """
+    A registry of DML messages loaded from message definition files.
+
+    This understands the XML definition files shipped with the game,
+    e.g. the `*Messages.xml` files inside `Root.wad`, as well as JSON
+    files of the same structure.
+
+    Every message is compiled into a :class:`Layout` once when it is
+    loaded. Lookups by service and order are a single dict access.
+    """
+
+    def __init__(self):
+        self.messages: dict[tuple[int, int], Message] = {}
+        self._names: dict[str, Message] = {}
+
+    def __len__(self) -> int:
+        return len(self.messages)
+
+    def load(self, path: Path):
+        """Loads the messages of a single XML or JSON definition file."""
+        if path.suffix.lower() == ".json":
+            service_id, messages = _parse_json(path)
+        else:
+            service_id, messages = _parse_xml(path)
+
+        for name, order, layout in _order_messages(path, messages):
+            msg = Message(name, service_id, order, layout)
+
+            self.messages[(service_id, order)] = msg
+            self._names[name] = msg
+
+    def load_dir(self, path: Path):
+        """Loads all definition files found in a directory."""
+        for file in sorted(path.glob("*Messages.xml")):
+            self.load(file)
+        for file in sorted(path.glob("*.json")):
+            self.load(file)
+
+    def get(self, service_id: int, order: int) -> Optional[Message]:
+        return self.messages.get((service_id, order))
+
+    def by_name(self, name: str) -> Optional[Message]:
+        return self._names.get(name)
+
+    def view(
+        self, service_id: int, order: int, payload: Union[bytes, memoryview]
+    ) -> Optional[MessageView]:
+        """Gets a lazy view of a message, if it is known."""
+        if (msg := self.messages.get((service_id, order))) is None:
+            return None
+
+        return MessageView(msg, payload)
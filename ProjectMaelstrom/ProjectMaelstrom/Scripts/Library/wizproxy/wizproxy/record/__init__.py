@@ -0,0 +1,3 @@
+from .format import ChunkInfo, Compression, Record  # noqa
+from .reader import LogReader  # noqa
+from .writer import LogWriter  # noqa
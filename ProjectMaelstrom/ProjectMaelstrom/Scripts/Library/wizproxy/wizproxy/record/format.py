@@ -0,0 +1,106 @@
+import zlib
+from dataclasses import dataclass
+from enum import IntEnum
+from struct import Struct
+from typing import Callable, Optional
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+VERSION = 1
+
+# Data files start with this header, followed by chunks of records.
+FILE_HEADER = Struct("<4sHB")
+FILE_MAGIC = b"WZTL"
+
+# Every chunk is prefixed with its stored and decompressed size.
+CHUNK_HEADER = Struct("<II")
+
+# Records in a chunk: timestamp in microseconds, session id, flags,
+# opcode or service id, order and payload size, followed by the payload.
+RECORD = Struct("<QIBBBI")
+FLAG_CLIENT = 1 << 0
+FLAG_CONTROL = 1 << 1
+
+# Index files start with this header, followed by one entry per chunk:
+# offset, stored size, first and last timestamp, the number of records,
+# message types and sessions. Then the message types and sessions follow.
+INDEX_HEADER = Struct("<4sH")
+INDEX_MAGIC = b"WZTI"
+INDEX_ENTRY = Struct("<QIQQIHH")
+
+# Message types are indexed as (1 << 16 | opcode) for control frames
+# and (service_id << 8 | order) for data frames.
+CONTROL_TYPE = 1 << 16
+
+
+def message_type(opcode: Optional[int], service_id: Optional[int], order: int) -> int:
+    if opcode is not None:
+        return CONTROL_TYPE | opcode
+    else:
+        return service_id << 8 | order
+
+
+class Compression(IntEnum):
+    """How the chunks of a traffic log are compressed."""
+
+    NONE = 0
+    ZLIB = 1
+    #: Requires the `zstandard` package.
+    ZSTD = 2
+
+    def compressor(self) -> Callable[[bytes], bytes]:
+        if self is Compression.ZLIB:
+            return zlib.compress
+        elif self is Compression.ZSTD:
+            return _zstandard().ZstdCompressor().compress
+        else:
+            return bytes
+
+    def decompressor(self) -> Callable[[bytes, int], bytes]:
+        if self is Compression.ZLIB:
+            return lambda data, size: zlib.decompress(data, bufsize=size)
+        elif self is Compression.ZSTD:
+            zstd = _zstandard().ZstdDecompressor()
+            return lambda data, size: zstd.decompress(data, max_output_size=size)
+        else:
+            return lambda data, size: data
+
+
+def _zstandard():
+    if zstandard is None:
+        raise RuntimeError("zstd compression requires the 'zstandard' package")
+    return zstandard
+
+
+@dataclass
+class Record:
+    """A single frame from a traffic log."""
+
+    #: Seconds since the epoch.
+    timestamp: float
+    session: int
+    #: Whether the frame was sent by the client.
+    client: bool
+
+    opcode: Optional[int]
+    service_id: Optional[int]
+    order: Optional[int]
+    payload: bytes
+
+
+@dataclass
+class ChunkInfo:
+    """Index entry describing a chunk of records in a traffic log."""
+
+    offset: int
+    size: int
+
+    first: int
+    last: int
+    count: int
+
+    types: frozenset[int]
+    sessions: frozenset[int]
@@ -0,0 +1,222 @@
+from pathlib import Path
+from struct import Struct
+from typing import Iterator, Optional
+
+from .format import (
+    CHUNK_HEADER,
+    CONTROL_TYPE,
+    FILE_HEADER,
+    FILE_MAGIC,
+    FLAG_CLIENT,
+    FLAG_CONTROL,
+    INDEX_ENTRY,
+    INDEX_HEADER,
+    INDEX_MAGIC,
+    RECORD,
+    ChunkInfo,
+    Compression,
+    Record,
+    message_type,
+)
+from .writer import index_path
+
+
+def _u32_array(count: int) -> Struct:
+    return Struct(f"<{count}I")
+
+
+class LogReader:
+    """
+    Reads and queries traffic logs written by a :class:`LogWriter`.
+
+    The sidecar index is used to find the chunks which may contain the
+    queried records. Chunks which were written after the last index
+    entry, e.g. because the proxy crashed in between, or logs without
+    an index are recovered by scanning the data file.
+
+    :param path: The path of the log.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._data = open(path, "rb")
+
+        magic, _, compression = FILE_HEADER.unpack(self._data.read(FILE_HEADER.size))
+        if magic != FILE_MAGIC:
+            raise ValueError(f"{path} is not a traffic log")
+
+        self.compression = Compression(compression)
+        self._decompress = self.compression.decompressor()
+
+        self.chunks = self._read_index()
+
+        end = self.chunks[-1].offset + self.chunks[-1].size if self.chunks else None
+        self.chunks.extend(self._scan(end or FILE_HEADER.size))
+
+    def __enter__(self) -> "LogReader":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self._data.close()
+
+    def _read_index(self) -> list[ChunkInfo]:
+        try:
+            index = index_path(self.path).read_bytes()
+        except FileNotFoundError:
+            return []
+
+        if index[: len(INDEX_MAGIC)] != INDEX_MAGIC:
+            raise ValueError(f"{index_path(self.path)} is not a traffic log index")
+
+        chunks = []
+        pos = INDEX_HEADER.size
+        while pos + INDEX_ENTRY.size <= len(index):
+            (
+                offset,
+                size,
+                first,
+                last,
+                count,
+                ntypes,
+                nsessions,
+            ) = INDEX_ENTRY.unpack_from(index, pos)
+            pos += INDEX_ENTRY.size
+
+            # A partially written entry at the end is left to the scan.
+            if pos + 4 * (ntypes + nsessions) > len(index):
+                break
+
+            types = _u32_array(ntypes).unpack_from(index, pos)
+            pos += 4 * ntypes
+            sessions = _u32_array(nsessions).unpack_from(index, pos)
+            pos += 4 * nsessions
+
+            chunks.append(
+                ChunkInfo(
+                    offset,
+                    size,
+                    first,
+                    last,
+                    count,
+                    frozenset(types),
+                    frozenset(sessions),
+                )
+            )
+
+        return chunks
+
+    def _scan(self, offset: int) -> Iterator[ChunkInfo]:
+        self._data.seek(offset)
+        while len(header := self._data.read(CHUNK_HEADER.size)) == CHUNK_HEADER.size:
+            stored, size = CHUNK_HEADER.unpack(header)
+            data = self._data.read(stored)
+            if len(data) != stored:
+                break
+
+            records = list(self._parse(self._decompress(data, size)))
+            if records:
+                yield ChunkInfo(
+                    offset,
+                    CHUNK_HEADER.size + stored,
+                    int(records[0].timestamp * 1_000_000),
+                    int(records[-1].timestamp * 1_000_000),
+                    len(records),
+                    frozenset(
+                        message_type(r.opcode, r.service_id, r.order) for r in records
+                    ),
+                    frozenset(r.session for r in records),
+                )
+
+            offset += CHUNK_HEADER.size + stored
+
+    @staticmethod
+    def _parse(data: bytes) -> Iterator[Record]:
+        pos = 0
+        while pos < len(data):
+            timestamp, session, flags, a, b, size = RECORD.unpack_from(data, pos)
+            pos += RECORD.size
+
+            if flags & FLAG_CONTROL:
+                opcode, service_id, order = a, None, None
+            else:
+                opcode, service_id, order = None, a, b
+
+            yield Record(
+                timestamp / 1_000_000,
+                session,
+                bool(flags & FLAG_CLIENT),
+                opcode,
+                service_id,
+                order,
+                data[pos : pos + size],
+            )
+            pos += size
+
+    def read_chunk(self, chunk: ChunkInfo) -> Iterator[Record]:
+        self._data.seek(chunk.offset)
+        stored, size = CHUNK_HEADER.unpack(self._data.read(CHUNK_HEADER.size))
+
+        return self._parse(self._decompress(self._data.read(stored), size))
+
+    def __iter__(self) -> Iterator[Record]:
+        for chunk in self.chunks:
+            yield from self.read_chunk(chunk)
+
+    def query(
+        self,
+        *,
+        session: Optional[int] = None,
+        client: Optional[bool] = None,
+        opcode: Optional[int] = None,
+        service_id: Optional[int] = None,
+        order: Optional[int] = None,
+        start: Optional[float] = None,
+        end: Optional[float] = None,
+    ) -> Iterator[Record]:
+        """
+        Finds all records matching the given conditions.
+
+        For example, ``query(session=3, service_id=5, order=221)`` yields
+        all server transfers sent in session 3.
+
+        Only the chunks which the index says may contain matching records
+        are read. Times are given as seconds since the epoch.
+        """
+        if opcode is not None and service_id is not None:
+            raise ValueError("unsupported query for control and data frames")
+
+        first = None if start is None else int(start * 1_000_000)
+        last = None if end is None else int(end * 1_000_000)
+
+        for chunk in self.chunks:
+            if first is not None and chunk.last < first:
+                continue
+            if last is not None and chunk.first > last:
+                continue
+            if session is not None and session not in chunk.sessions:
+                continue
+
+            if opcode is not None:
+                if CONTROL_TYPE | opcode not in chunk.types:
+                    continue
+            elif service_id is not None:
+                if order is not None:
+                    if message_type(None, service_id, order) not in chunk.types:
+                        continue
+                elif not any(t >> 8 == service_id for t in chunk.types):
+                    continue
+
+            for record in self.read_chunk(chunk):
+                if (
+                    (session is None or record.session == session)
+                    and (client is None or record.client == client)
+                    and (opcode is None or record.opcode == opcode)
+                    and (service_id is None or record.service_id == service_id)
+                    and (order is None or record.order == order)
+                    and (start is None or record.timestamp >= start)
+                    and (end is None or record.timestamp <= end)
+                ):
+                    yield record
@@ -0,0 +1,140 @@
+from pathlib import Path
+from typing import Optional
+
+from .format import (
+    CHUNK_HEADER,
+    FILE_HEADER,
+    FILE_MAGIC,
+    FLAG_CLIENT,
+    FLAG_CONTROL,
+    INDEX_ENTRY,
+    INDEX_HEADER,
+    INDEX_MAGIC,
+    RECORD,
+    VERSION,
+    Compression,
+    message_type,
+)
+
+# Amount of record data after which a chunk is written out.
+CHUNK_SIZE = 0x40000
+
+
+def index_path(path: Path) -> Path:
+    return path.with_name(f"{path.name}.idx")
+
+
+class LogWriter:
+    """
+    Writes frames to an append-only traffic log.
+
+    Records are collected into chunks, which are compressed and written
+    as a whole once ``chunk_size`` bytes of records are pending. For every
+    chunk, an entry with its time range, message types and sessions is
+    appended to a sidecar index file, so readers only need to decompress
+    the chunks which can contain what they are looking for.
+
+    :param path: The path of the log, the index is written next to it.
+    :param compression: How to compress the chunks.
+    :param chunk_size: The amount of record data to write in one chunk.
+    """
+
+    def __init__(
+        self,
+        path: Path,
+        compression: Compression = Compression.ZLIB,
+        chunk_size: int = CHUNK_SIZE,
+    ):
+        self.path = path
+        self.compression = compression
+        self.chunk_size = chunk_size
+
+        self._compress = compression.compressor()
+
+        self._data = open(path, "wb")
+        self._data.write(FILE_HEADER.pack(FILE_MAGIC, VERSION, compression))
+        self._index = open(index_path(path), "wb")
+        self._index.write(INDEX_HEADER.pack(INDEX_MAGIC, VERSION))
+
+        self._chunk = bytearray()
+        self._first = 0
+        self._last = 0
+        self._count = 0
+        self._types: set[int] = set()
+        self._sessions: set[int] = set()
+
+    def append(
+        self,
+        timestamp: int,
+        session: int,
+        client: bool,
+        opcode: Optional[int],
+        service_id: Optional[int],
+        order: Optional[int],
+        payload: bytes,
+    ):
+        """
+        Appends a record for a frame to the log.
+
+        :param timestamp: Microseconds since the epoch.
+        """
+        if opcode is not None:
+            flags, a, b = FLAG_CONTROL, opcode, 0
+        else:
+            flags, a, b = 0, service_id, order
+        if client:
+            flags |= FLAG_CLIENT
+
+        if not self._count:
+            self._first = timestamp
+        self._last = timestamp
+        self._count += 1
+
+        self._types.add(message_type(opcode, service_id, order))
+        self._sessions.add(session)
+
+        self._chunk += RECORD.pack(timestamp, session, flags, a, b, len(payload))
+        self._chunk += payload
+
+        if len(self._chunk) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        """Writes out all pending records as a chunk."""
+        if not self._count:
+            return
+
+        data = self._compress(bytes(self._chunk))
+        offset = self._data.tell()
+
+        self._data.write(CHUNK_HEADER.pack(len(data), len(self._chunk)))
+        self._data.write(data)
+        self._data.flush()
+
+        # The index entry is only written after its chunk is complete.
+        types, sessions = sorted(self._types), sorted(self._sessions)
+        self._index.write(
+            INDEX_ENTRY.pack(
+                offset,
+                CHUNK_HEADER.size + len(data),
+                self._first,
+                self._last,
+                self._count,
+                len(types),
+                len(sessions),
+            )
+        )
+        self._index.write(b"".join(t.to_bytes(4, "little") for t in types))
+        self._index.write(b"".join(s.to_bytes(4, "little") for s in sessions))
+        self._index.flush()
+
+        self._chunk.clear()
+        self._count = 0
+        self._types.clear()
+        self._sessions.clear()
+
+    def close(self):
+        self.flush()
+
+        self._data.close()
+        self._index.close()
@@ -0,0 +1,2 @@
+from .engine import Replayer, ReplayStats  # noqa
+from .reader import CapturedPacket, read_packets  # noqa
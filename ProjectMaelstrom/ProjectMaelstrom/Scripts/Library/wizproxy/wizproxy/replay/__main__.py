@@ -0,0 +1,103 @@
+import importlib
+from pathlib import Path
+from typing import Optional
+
+import click
+import trio
+from loguru import logger
+
+# The plugin package can only be imported after the core.
+import wizproxy.core  # noqa: F401
+from wizproxy.plugin import Plugin, PluginCollection
+from wizproxy.plugin.log import VerboseLogPlugin
+from wizproxy.proto import Frame, MessageRegistry
+
+from . import Replayer, read_packets
+
+
+def load_plugin(spec: str) -> Plugin:
+    module, _, name = spec.partition(":")
+    if not name:
+        raise click.BadParameter(f"expected 'module:Class', got '{spec}'")
+
+    return getattr(importlib.import_module(module), name)()
+
+
+async def main(
+    captures: list[Path],
+    plugins: list[str],
+    messages: Optional[Path],
+    verbose: bool,
+):
+    # If requested, make message fields available to plugins.
+    if messages is not None:
+        registry = MessageRegistry()
+        registry.load_dir(messages)
+        Frame.registry = registry
+
+    collection = PluginCollection()
+    for spec in plugins:
+        collection.add(load_plugin(spec))
+
+    # If requested, enable verbose packet logging.
+    if verbose:
+        collection.add(VerboseLogPlugin())
+
+    replayer = Replayer(collection)
+    for capture in captures:
+        with capture.open("rb") as f:
+            stats = await replayer.replay(read_packets(f))
+
+        logger.info(
+            f"[{capture.name}] Replayed {stats.frames} frames ({stats.bytes} bytes) "
+            f"of {stats.sessions} sessions in {stats.elapsed:.3f}s: "
+            f"{stats.frames_per_second:.0f} frames/s, "
+            f"{stats.bytes_per_second / 1e6:.2f} MB/s"
+        )
+        if stats.skipped:
+            logger.warning(
+                f"[{capture.name}] Skipped {stats.skipped} unannotated packets"
+            )
+
+
+@click.command()
+@click.argument(
+    "captures",
+    nargs=-1,
+    required=True,
+    type=click.Path(exists=True, file_okay=True, dir_okay=False, path_type=Path),
+)
+@click.option(
+    "-p",
+    "--plugin",
+    "plugins",
+    multiple=True,
+    help="A plugin to run, given as 'module:Class'. May be repeated.",
+)
+@click.option(
+    "-m",
+    "--messages",
+    type=click.Path(exists=True, file_okay=False, dir_okay=True, path_type=Path),
+    help="Loads message definition files from a directory.",
+)
+@click.option(
+    "-v",
+    "--verbose",
+    is_flag=True,
+    help="Enables verbose logging.",
+)
+def run(captures, plugins, messages, verbose):
+    """Replays pcapng captures of the proxy through a set of plugins.
+
+    Captures must have been written by the proxy with the '-c' option,
+    so every packet is annotated with the session it belongs to.
+
+    Frames are dispatched without any network I/O and as fast as
+    possible, which makes this suited both for running analysis
+    plugins over recorded traffic and for benchmarking plugins.
+    """
+    trio.run(main, list(captures), list(plugins), messages, verbose)
+
+
+if __name__ == "__main__":
+    run()
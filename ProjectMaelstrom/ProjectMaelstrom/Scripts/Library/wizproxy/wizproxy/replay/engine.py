@@ -0,0 +1,144 @@
+import time
+from dataclasses import dataclass, field
+from typing import Iterable, Optional
+
+from wizproxy.core.parcel import Parcel
+from wizproxy.crypto import AesContext
+from wizproxy.plugin import Context, Direction, PluginCollection
+from wizproxy.proto import Frame, SocketAddress
+from wizproxy.session import Session
+
+from .reader import CapturedPacket
+
+
+def _parse_addr(addr: str) -> SocketAddress:
+    ip, _, port = addr.rpartition(":")
+    return SocketAddress(ip, int(port))
+
+
+def _parse_comment(comment: str) -> dict[str, str]:
+    fields = {}
+    for line in comment.splitlines():
+        key, _, value = line.partition(" ")
+        fields[key.rstrip(":")] = value
+
+    return fields
+
+
+class _ReplayParcels:
+    """Answers shard spawn requests without spawning anything."""
+
+    async def send(self, parcel: Parcel[SocketAddress, SocketAddress]):
+        parcel.answer(parcel.data)
+
+
+class _ReplayShard:
+    """Stands in for the :class:`Shard` that recorded a session."""
+
+    def __init__(self, self_addr: SocketAddress, remote_addr: SocketAddress):
+        self.self_addr = self_addr
+        self.remote_addr = remote_addr
+        self.proxy_tx = _ReplayParcels()
+
+    def __str__(self) -> str:
+        return str(self.self_addr)
+
+
+@dataclass
+class ReplayStats:
+    """Statistics of a replay run."""
+
+    frames: int = 0
+    bytes: int = 0
+    skipped: int = 0
+    sessions: int = 0
+    elapsed: float = field(default=0.0)
+
+    @property
+    def frames_per_second(self) -> float:
+        return self.frames / self.elapsed if self.elapsed else 0.0
+
+    @property
+    def bytes_per_second(self) -> float:
+        return self.bytes / self.elapsed if self.elapsed else 0.0
+
+
+class Replayer:
+    """
+    Runs captured traffic through the plugins of the proxy, offline.
+
+    Sessions are reconstructed from the comments the capture plugins
+    attach to each packet, including the AES contexts of sessions
+    whose Session Accept frame was captured. Frames are then
+    dispatched to the plugins as fast as possible, without sockets.
+
+    :param plugins: The plugins to run the captured frames through.
+    """
+
+    def __init__(self, plugins: PluginCollection):
+        self.plugins = plugins
+
+        self._sessions: dict[tuple[str, str], tuple[Context, SocketAddress]] = {}
+        self._comments: dict[str, dict[str, str]] = {}
+
+    def _get_context(
+        self, fields: dict[str, str]
+    ) -> Optional[tuple[Context, SocketAddress]]:
+        key = (fields.get("Shard"), fields.get("Session"))
+        if (res := self._sessions.get(key)) is not None:
+            return res
+
+        try:
+            shard = _parse_addr(fields["Shard"])
+            client = _parse_addr(fields["Client"])
+            server = _parse_addr(fields["Server"])
+            sid = int(fields["Session"])
+        except (KeyError, ValueError):
+            return None
+
+        session = Session(client, server, sid, None, None)
+        res = Context(_ReplayShard(shard, server), session), client
+        self._sessions[key] = res
+
+        return res
+
+    async def replay(self, packets: Iterable[CapturedPacket]) -> ReplayStats:
+        stats = ReplayStats()
+        start = time.perf_counter()
+
+        for packet in packets:
+            comment = packet.comment or ""
+            if (fields := self._comments.get(comment)) is None:
+                fields = self._comments[comment] = _parse_comment(comment)
+
+            if (res := self._get_context(fields)) is None:
+                stats.skipped += 1
+                continue
+
+            ctx, client = res
+            session = ctx.session
+
+            if packet.src.ip == client.ip and packet.src.port == client.port:
+                direction = Direction.CLIENT_TO_SERVER
+            else:
+                direction = Direction.SERVER_TO_CLIENT
+
+            frame = Frame.parse(packet.payload)
+
+            # Session Accept frames carry the AES secrets of the session.
+            if "AES-Key" in fields and "AES-Nonce" in fields:
+                key = bytes.fromhex(fields["AES-Key"])
+                nonce = bytes.fromhex(fields["AES-Nonce"])
+
+                session.client_aes = AesContext.client(key, nonce)
+                session.server_aes = AesContext.server(key, nonce)
+
+            await self.plugins.dispatch(direction, ctx, frame)
+
+            stats.frames += 1
+            stats.bytes += len(packet.payload)
+
+        stats.elapsed = time.perf_counter() - start
+        stats.sessions = len(self._sessions)
+
+        return stats
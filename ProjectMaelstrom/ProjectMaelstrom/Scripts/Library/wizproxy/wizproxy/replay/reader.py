@@ -0,0 +1,124 @@
+from dataclasses import dataclass
+from struct import Struct
+from typing import BinaryIO, Iterator, Optional
+
+from wizproxy.proto import SocketAddress
+
+BLOCK_SECTION_HEADER = 0x0A0D0D0A
+BLOCK_ENHANCED_PACKET = 6
+
+BYTE_ORDER_MAGIC = 0x1A2B3C4D
+OPT_END = 0
+OPT_COMMENT = 1
+
+ETHERTYPE_IPV4 = 0x0800
+ETHER_HEADER_SIZE = 14
+
+U32 = {"<": Struct("<I"), ">": Struct(">I")}
+BLOCK_HEADER = {"<": Struct("<II"), ">": Struct(">II")}
+ENHANCED_PACKET = {"<": Struct("<IIIII"), ">": Struct(">IIIII")}
+OPTION = {"<": Struct("<HH"), ">": Struct(">HH")}
+
+# Fields of interest from IPv4 and TCP headers.
+IPV4_HEADER = Struct("!BxH5x B2x4s4s")
+TCP_HEADER = Struct("!HH8xB")
+
+
+@dataclass
+class CapturedPacket:
+    """A single TCP segment read from a pcapng capture."""
+
+    timestamp: int
+    src: SocketAddress
+    dest: SocketAddress
+    payload: memoryview
+    comment: Optional[str]
+
+
+def _parse_options(data: memoryview, order: str) -> Optional[str]:
+    option = OPTION[order]
+
+    offset = 0
+    while offset + option.size <= len(data):
+        code, length = option.unpack_from(data, offset)
+        offset += option.size
+
+        if code == OPT_END:
+            break
+        if code == OPT_COMMENT:
+            return bytes(data[offset : offset + length]).decode()
+
+        offset += length + (-length % 4)
+
+    return None
+
+
+def _parse_tcp(
+    packet: memoryview,
+) -> Optional[tuple[SocketAddress, SocketAddress, memoryview]]:
+    if len(packet) < ETHER_HEADER_SIZE or packet[12:14] != b"\x08\x00":
+        return None
+
+    ip = packet[ETHER_HEADER_SIZE:]
+    version_ihl, total_length, protocol, src_ip, dest_ip = IPV4_HEADER.unpack_from(ip)
+    if version_ihl >> 4 != 4 or protocol != 6:
+        return None
+
+    # A zero length is used for segments too large to describe.
+    if total_length != 0:
+        ip = ip[:total_length]
+
+    tcp = ip[(version_ihl & 0xF) * 4 :]
+    sport, dport, data_offset = TCP_HEADER.unpack_from(tcp)
+
+    src = SocketAddress(".".join(map(str, src_ip)), sport)
+    dest = SocketAddress(".".join(map(str, dest_ip)), dport)
+
+    return src, dest, tcp[(data_offset >> 4) * 4 :]
+
+
+def read_packets(file: BinaryIO) -> Iterator[CapturedPacket]:
+    """
+    Reads all TCP packets from a pcapng capture, as written by the
+    capture plugins of the proxy.
+
+    Each packet holds exactly one frame and the comment describing
+    the shard and session it belongs to.
+    """
+    order = "<"
+
+    while header := file.read(8):
+        if len(header) < 8:
+            raise ValueError("truncated pcapng block")
+
+        if U32["<"].unpack_from(header)[0] == BLOCK_SECTION_HEADER:
+            # Every section declares its own byte order.
+            magic = file.read(4)
+            order = "<" if U32["<"].unpack(magic)[0] == BYTE_ORDER_MAGIC else ">"
+
+            block_len = U32[order].unpack_from(header, 4)[0]
+            file.read(block_len - 12)
+            continue
+
+        block_type, block_len = BLOCK_HEADER[order].unpack(header)
+        body = memoryview(file.read(block_len - 8))
+        if len(body) != block_len - 8:
+            raise ValueError("truncated pcapng block")
+
+        if block_type != BLOCK_ENHANCED_PACKET:
+            continue
+
+        _, ts_high, ts_low, captured_len, _ = ENHANCED_PACKET[order].unpack_from(body)
+
+        packet = body[20 : 20 + captured_len]
+        options = body[20 + captured_len + (-captured_len % 4) : -4]
+
+        if res := _parse_tcp(packet):
+            src, dest, payload = res
+            yield CapturedPacket(
+                (ts_high << 32) | ts_low,
+                src,
+                dest,
+                payload,
+                _parse_options(options, order),
+            )
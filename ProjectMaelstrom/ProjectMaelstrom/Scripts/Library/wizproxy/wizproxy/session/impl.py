@@ -1,8 +1,7 @@
 from typing import Optional
 
 from wizproxy.crypto import AesContext, KeyChain
-from wizproxy.proto import (Bytes, EncryptedMessage, Frame, SignedMessage,
-                            SocketAddress)
+from wizproxy.proto import Bytes, EncryptedMessage, Frame, SignedMessage, SocketAddress
 from wizproxy.proto.bytes import U32
 
 from .challenges import ClientSig, process_challenge
@@ -35,7 +34,8 @@ class Session:
 
     :param client: The socket address of the connected client.
     :param server: The socket address of the connected server.
-    :param sid: The Session ID of the client. Never changes.
+    :param sid: The Session ID of the client, unique across all shards and
+                worker processes of a proxy. Never changes.
     :param key_chain: The key chain for asymmetric crypto.
     :param client_sig: A decrypted ClientSig, if any.
     """
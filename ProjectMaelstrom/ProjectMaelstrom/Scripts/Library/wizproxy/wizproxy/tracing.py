@@ -0,0 +1,271 @@
+import json
+import os
+import time
+from collections import deque
+from pathlib import Path
+from typing import Any, Iterable, Optional
+
+import click
+import trio
+
+from wizproxy.proto import Header
+
+# The points in time recorded for every traced frame, in order.
+POINTS = (
+    "received",
+    "decrypted",
+    "dispatched",
+    "serialized",
+    "flushed",
+    "encrypted",
+    "sent",
+)
+
+# The stages between two consecutive points, named by what ends them.
+# "decrypt" includes the time a frame waited behind others that arrived
+# with the same read, "batch" the time it waited for its batch to fill.
+STAGES = ("decrypt", "dispatch", "serialize", "batch", "encrypt", "send")
+
+# How many traces are kept in the ring buffer by default.
+CAPACITY = 4096
+
+# How often new traces are appended to an export file, in seconds.
+EXPORT_INTERVAL = 10.0
+
+
+class Trace:
+    """
+    Timestamps of a single frame on its way through a shard.
+
+    :attr:`times` are :func:`time.perf_counter` values of the points
+    in :data:`POINTS` the frame already passed.
+    """
+
+    __slots__ = ("shard", "direction", "header", "size", "times", "exported")
+
+    def __init__(self, shard: str, direction: str, header: Header, size: int):
+        self.shard = shard
+        self.direction = direction
+        self.header = header
+        self.size = size
+        self.times: list[float] = []
+        self.exported = False
+
+    @property
+    def complete(self) -> bool:
+        return len(self.times) == len(POINTS)
+
+    def mark(self):
+        self.times.append(time.perf_counter())
+
+    def stages(self) -> dict[str, float]:
+        """Durations of all stages in seconds."""
+        times = self.times
+        return {stage: times[i + 1] - times[i] for i, stage in enumerate(STAGES)}
+
+
+def _percentile(values: list[float], p: float) -> float:
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def summarize(durations: Iterable[dict[str, float]]) -> str:
+    """Renders p50/p99/max of every stage and the total latency."""
+    columns: dict[str, list[float]] = {stage: [] for stage in (*STAGES, "total")}
+    for stages in durations:
+        for stage, value in stages.items():
+            columns[stage].append(value)
+        if "total" not in stages:
+            columns["total"].append(sum(stages.values()))
+
+    count = len(columns["total"])
+    if not count:
+        return "no complete traces"
+
+    lines = [f"{count} traces", f"{'stage':<10} {'p50':>9} {'p99':>9} {'max':>9}"]
+    for stage, values in columns.items():
+        values.sort()
+        lines.append(
+            f"{stage:<10} {_percentile(values, 0.5) * 1e6:>7.0f}us "
+            f"{_percentile(values, 0.99) * 1e6:>7.0f}us {values[-1] * 1e6:>7.0f}us"
+        )
+
+    return "\n".join(lines)
+
+
+class Tracer:
+    """
+    Samples per-frame latency traces into a ring buffer.
+
+    Every `every`-th frame through a shard is traced from the socket
+    read it arrived with until it was sent to the peer. The most recent
+    traces can be summarized with :meth:`dump` and written as
+    OpenTelemetry JSON with :meth:`export`.
+
+    :param every: Trace one in this many frames.
+    :param capacity: How many of the most recent traces to keep.
+    """
+
+    def __init__(self, every: int = 100, capacity: int = CAPACITY):
+        self.every = every
+        self.traces: deque[Trace] = deque(maxlen=capacity)
+
+        self._countdown = every
+
+        # Maps perf_counter values to Unix time for exports.
+        self._epoch_ns = time.time_ns() - time.perf_counter_ns()
+
+    def sample(
+        self, shard: str, direction: str, header: Header, size: int, received: float
+    ) -> Optional[Trace]:
+        """Starts a trace for the next frame, if it is sampled."""
+        self._countdown -= 1
+        if self._countdown:
+            return None
+        self._countdown = self.every
+
+        trace = Trace(shard, direction, header, size)
+        trace.times.append(received)
+        trace.mark()
+
+        self.traces.append(trace)
+        return trace
+
+    def completed(self) -> list[Trace]:
+        return [trace for trace in self.traces if trace.complete]
+
+    def dump(self) -> str:
+        """Summarizes the traces in the ring buffer by stage."""
+        return summarize(trace.stages() for trace in self.completed()) + "\n"
+
+    def _unix_ns(self, t: float) -> str:
+        return str(self._epoch_ns + int(t * 1e9))
+
+    def _spans(self, trace: Trace) -> list[dict[str, Any]]:
+        opcode, service_id, order, _, _ = trace.header
+        attributes = {
+            "wizproxy.shard": trace.shard,
+            "wizproxy.direction": trace.direction,
+            "wizproxy.opcode": opcode,
+            "wizproxy.service_id": service_id,
+            "wizproxy.order": order,
+            "wizproxy.size": trace.size,
+        }
+
+        trace_id = os.urandom(16).hex()
+        root_id = os.urandom(8).hex()
+        times = trace.times
+
+        spans = [
+            {
+                "traceId": trace_id,
+                "spanId": root_id,
+                "name": "frame",
+                "kind": 1,
+                "startTimeUnixNano": self._unix_ns(times[0]),
+                "endTimeUnixNano": self._unix_ns(times[-1]),
+                "attributes": [
+                    {"key": key, "value": {"intValue": str(value)}}
+                    if isinstance(value, int)
+                    else {"key": key, "value": {"stringValue": str(value)}}
+                    for key, value in attributes.items()
+                    if value is not None
+                ],
+            }
+        ]
+        for i, stage in enumerate(STAGES):
+            spans.append(
+                {
+                    "traceId": trace_id,
+                    "spanId": os.urandom(8).hex(),
+                    "parentSpanId": root_id,
+                    "name": stage,
+                    "kind": 1,
+                    "startTimeUnixNano": self._unix_ns(times[i]),
+                    "endTimeUnixNano": self._unix_ns(times[i + 1]),
+                }
+            )
+
+        return spans
+
+    def export(self, path: Path) -> int:
+        """
+        Appends completed traces not exported before to a file.
+
+        Each call writes one line with an OTLP/JSON trace export
+        request, as understood by OpenTelemetry collectors.
+        """
+        traces = [trace for trace in self.completed() if not trace.exported]
+        if not traces:
+            return 0
+
+        spans = []
+        for trace in traces:
+            spans.extend(self._spans(trace))
+            trace.exported = True
+
+        request = {
+            "resourceSpans": [
+                {
+                    "resource": {
+                        "attributes": [
+                            {
+                                "key": "service.name",
+                                "value": {"stringValue": "wizproxy"},
+                            }
+                        ]
+                    },
+                    "scopeSpans": [{"scope": {"name": "wizproxy"}, "spans": spans}],
+                }
+            ]
+        }
+        with path.open("a") as f:
+            f.write(json.dumps(request, separators=(",", ":")) + "\n")
+
+        return len(traces)
+
+    async def export_every(self, path: Path, interval: float):
+        """Periodically exports new traces to a file."""
+        try:
+            while True:
+                await trio.sleep(interval)
+                self.export(path)
+        finally:
+            self.export(path)
+
+
+def read_export(path: Path) -> Iterable[dict[str, float]]:
+    """Reads the stage durations of traces exported by :meth:`Tracer.export`."""
+    with path.open() as f:
+        for line in f:
+            for resource in json.loads(line)["resourceSpans"]:
+                for scope in resource["scopeSpans"]:
+                    traces: dict[str, dict[str, float]] = {}
+                    for span in scope["spans"]:
+                        duration = (
+                            int(span["endTimeUnixNano"])
+                            - int(span["startTimeUnixNano"])
+                        ) / 1e9
+
+                        name = "total" if span["name"] == "frame" else span["name"]
+                        traces.setdefault(span["traceId"], {})[name] = duration
+
+                    yield from traces.values()
+
+
+@click.command()
+@click.argument(
+    "export",
+    type=click.Path(exists=True, dir_okay=False, path_type=Path),
+)
+def run(export):
+    """Summarizes frame latencies by stage from a trace export file.
+
+    The file is written by the proxy with the '--trace-export' option.
+    To look at the most recent traces of a running proxy instead, fetch
+    '/traces' from its metrics port.
+    """
+    click.echo(summarize(read_export(export)))
+
+
+if __name__ == "__main__":
+    run()
@@ -1 +1,2 @@
 from .stream import FrameStream  # noqa
+from .writer import FrameWriter  # noqa
@@ -1,20 +1,28 @@
 from enum import IntEnum
 from struct import Struct
-from typing import Optional
+from typing import Callable, Optional
 
 from wizproxy.crypto import AesContext
 
 FRAME_HEADER = Struct("<HHI")
 
+# Large frames carry their message header in the first 16 bytes.
+LARGE_HEAD_SIZE = 16
+
+# Decides whether a large frame should be streamed, given its first
+# bytes and its total size.
+StreamPredicate = Callable[[memoryview, int], bool]
+
 
 class State(IntEnum):
     EMPTY = 0
     GOT_ENCRYPTED_FOOD = 1
     GOT_FOOD = 2
+    STREAMING = 3
 
 
-def is_plaintext_frame(raw: memoryview) -> bool:
-    return raw[1] == 0xF0 and raw[0] == 0x0D
+def is_plaintext_frame(raw: memoryview, offset: int = 0) -> bool:
+    return raw[offset + 1] == 0xF0 and raw[offset] == 0x0D
 
 
 def is_large_frame(size: int) -> bool:
@@ -28,26 +36,60 @@ class PacketBuffer:
     This class is meant to be reusable; each connection should
     maintain an instance and reuse the memory to reduce the
     number of allocations in the program.
+
+    Consumed data is tracked by a read offset instead of being cut
+    off the front of the buffer, so splitting off a frame hands out
+    a :class:`memoryview` without copying anything. The consumed
+    prefix is only reclaimed when new data is fed.
+
+    Large frames may optionally be streamed instead of being buffered
+    completely. They are then handed out in pieces as data arrives,
+    with :attr:`partial` set to tell them apart from whole frames.
     """
 
     def __init__(self):
         self.buf = bytearray()
         self.buf_len = 0
+        self.pos = 0
+
+        # Whether the last polled data is a piece of a streamed frame.
+        self.partial = False
 
         self._state = State.EMPTY
         self._food = None
+        self._food_len = 0
+
+        self._decided = False
+        self._stream_encrypted = False
+        self._remaining = 0
 
     def feed(self, data: bytes):
-        self.buf.extend(data)
+        # Reclaim the consumed prefix once it outweighs the unread bytes
+        # we would have to move. This keeps compaction amortized O(1).
+        if self.pos != 0 and self.pos >= self.buf_len:
+            self._compact()
+
+        try:
+            self.buf.extend(data)
+        except BufferError:
+            # Views of previously returned frames pin the buffer memory.
+            # Move the unread tail into a new buffer and leave them the old one.
+            self._compact()
+            self.buf.extend(data)
+
         self.buf_len += len(data)
 
-    def split_off(self, nbytes: int) -> bytes:
-        data = self.buf[:nbytes]
+    def _compact(self):
+        self.buf = self.buf[self.pos :]
+        self.pos = 0
+
+    def split_off(self, nbytes: int) -> memoryview:
+        start = self.pos
 
-        self.buf = self.buf[nbytes:]
+        self.pos += nbytes
         self.buf_len -= nbytes
 
-        return data
+        return memoryview(self.buf)[start : self.pos]
 
     def _required_bytes(self, aes: Optional[AesContext], nbytes: int) -> int:
         if aes is not None:
@@ -63,23 +105,91 @@ class PacketBuffer:
                 return
 
             # Determine if the frame is encrypted by some magic header bytes.
-            encrypted = aes is not None and not is_plaintext_frame(self.buf)
+            encrypted = aes is not None and not is_plaintext_frame(self.buf, self.pos)
 
-            self._food = self.split_off(food_bytes)
             if encrypted:
-                self._food = aes.decrypt(self._food)
+                self._food = aes.decrypt(self.split_off(food_bytes))
                 self._state = State.GOT_ENCRYPTED_FOOD
             else:
+                # Plaintext headers are only peeked at, so that header and
+                # body can later be split off as one contiguous view.
+                self._food_len = food_bytes
                 self._state = State.GOT_FOOD
 
-    def poll_frame(self, aes: Optional[AesContext]) -> Optional[tuple[bool, bytes]]:
+    def _peek_head(self, aes: Optional[AesContext], encrypted: bool) -> Optional[bytes]:
+        if encrypted:
+            # Decrypt the rest of the head, it becomes part of the food.
+            if len(self._food) < LARGE_HEAD_SIZE:
+                nbytes = aes.calculate_decryption_overhead(LARGE_HEAD_SIZE - 8)
+                if self.buf_len < nbytes:
+                    return None
+
+                self._food += aes.decrypt(self.split_off(nbytes))
+
+            return self._food[:LARGE_HEAD_SIZE]
+
+        else:
+            if self.buf_len < LARGE_HEAD_SIZE:
+                return None
+
+            return bytes(self.buf[self.pos : self.pos + LARGE_HEAD_SIZE])
+
+    def _poll_piece(
+        self, aes: Optional[AesContext]
+    ) -> Optional[tuple[bool, memoryview]]:
+        encrypted = self._stream_encrypted
+
+        size = min(self._remaining, self.buf_len)
+        if encrypted:
+            # Pieces must not end right at a nonce rotation without the tag
+            # and nonce that follow it, or decryption can't continue.
+            until_rotation = aes.chunk_size - aes.decrypted
+            size = min(self._remaining, until_rotation)
+            if aes.calculate_decryption_overhead(size) > self.buf_len:
+                size = min(size, self.buf_len, until_rotation - 1)
+
+        if size <= 0:
+            return None
+
+        self._remaining -= size
+        if self._remaining == 0:
+            self._state = State.EMPTY
+            self._decided = False
+
+        self.partial = True
+        if encrypted:
+            ciphertext = self.split_off(aes.calculate_decryption_overhead(size))
+            return encrypted, memoryview(aes.decrypt(ciphertext))
+        else:
+            return encrypted, self.split_off(size)
+
+    def poll_frame(
+        self,
+        aes: Optional[AesContext],
+        stream: Optional[StreamPredicate] = None,
+    ) -> Optional[tuple[bool, memoryview]]:
+        """
+        Gets the next frame if it is completely buffered.
+
+        When ``stream`` is given, it is asked for every large frame
+        whether it should be streamed. Pieces of streamed frames are
+        then returned as soon as they arrive.
+        """
+        self.partial = False
+        if self._state == State.STREAMING:
+            return self._poll_piece(aes)
+
         # Read and decrypt the next frame's header, or wait for more data.
         self._poll_header(aes)
         if self._state == State.EMPTY:
             return None
 
         # Unpack the header data and make sure we can consume the frame.
-        magic, size, large_size = FRAME_HEADER.unpack(self._food)
+        encrypted = self._state == State.GOT_ENCRYPTED_FOOD
+        if encrypted:
+            magic, size, large_size = FRAME_HEADER.unpack_from(self._food)
+        else:
+            magic, size, large_size = FRAME_HEADER.unpack_from(self.buf, self.pos)
 
         # Validate the header magic to make sure the data is valid.
         if magic != 0xF00D:
@@ -88,22 +198,56 @@ class PacketBuffer:
         # Unpack the size and compute how many bytes we still need to consume.
         if is_large_frame(size):
             size = large_size
+
+            # Let the caller decide whether to stream the frame once its
+            # head is known. The head might already consume body bytes.
+            if stream is not None and not self._decided:
+                if (head := self._peek_head(aes, encrypted)) is None:
+                    return None
+
+                self._decided = True
+                if stream(memoryview(head), 8 + large_size):
+                    return self._start_stream(aes, encrypted, large_size)
+
+            if encrypted:
+                size -= len(self._food) - 8
         else:
             # We already consumed the first 4 bytes of the body prematurely
             # to make sure our header is big enough.
             size -= 4
         size = self._required_bytes(aes, size)
 
+        # Plaintext headers are still in the buffer and count towards the frame.
+        if not encrypted:
+            size += self._food_len
+
         # If we don't have enough data yet, wait for more.
         if self.buf_len < size:
             return None
 
         # Extract the frame body and decrypt it, if necessary.
         body = self.split_off(size)
-        encrypted = self._state == State.GOT_ENCRYPTED_FOOD
+        self._state = State.EMPTY
+        self._decided = False
+
         if encrypted:
-            body = aes.decrypt(body)
+            return encrypted, memoryview(self._food + aes.decrypt(body))
+        else:
+            return encrypted, body
 
-        self._state = State.EMPTY
+    def _start_stream(
+        self, aes: Optional[AesContext], encrypted: bool, large_size: int
+    ) -> Optional[tuple[bool, memoryview]]:
+        self._state = State.STREAMING
+        self._stream_encrypted = encrypted
+
+        if encrypted:
+            # The decrypted head is handed out first, the body follows.
+            self._remaining = large_size - (len(self._food) - 8)
 
-        return encrypted, self._food + body
+            self.partial = True
+            return encrypted, memoryview(self._food)
+        else:
+            # The header was only peeked at, so stream the frame as a whole.
+            self._remaining = 8 + large_size
+            return self._poll_piece(aes)
@@ -1,11 +1,13 @@
+import time
 from typing import Optional
 
 import trio
 
 from wizproxy.crypto import AesContext
+from wizproxy.metrics import StreamStats
 from wizproxy.session import Session
 
-from .packet_buffer import PacketBuffer
+from .packet_buffer import PacketBuffer, StreamPredicate
 
 # Timeout is chosen so that it represents double the serverbound
 # Keep Alive Rsp interval. If one party is too slow to send
@@ -24,16 +26,34 @@ class FrameStream:
     Implementation-wise, this class buffers data from a socket
     until a complete frame can be pulled out of it. Decryption
     is handled internally.
+
+    When given :class:`StreamStats`, the stream records the received
+    bytes, the high-water mark of its buffer and decryption times.
+
+    When given a ``stream_large`` predicate, large frames it accepts are
+    yielded in pieces as they arrive, see :attr:`partial`.
     """
 
-    def __init__(self, stream: trio.SocketStream, session: Session, client: bool):
+    def __init__(
+        self,
+        stream: trio.SocketStream,
+        session: Session,
+        client: bool,
+        stats: Optional[StreamStats] = None,
+        stream_large: Optional[StreamPredicate] = None,
+    ):
         self._stream = stream.__aiter__()
 
         self.session = session
         self.client = client
+        self.stats = stats
+        self.stream_large = stream_large
 
         self.buffer = PacketBuffer()
 
+        # When the most recent data was read from the socket.
+        self.received_at = 0.0
+
     @property
     def aes_context(self) -> Optional[AesContext]:
         if self.client:
@@ -41,16 +61,39 @@ class FrameStream:
         else:
             return self.session.server_aes
 
+    @property
+    def partial(self) -> bool:
+        """Whether the last yielded data is a piece of a streamed frame."""
+        return self.buffer.partial
+
     def __aiter__(self) -> "FrameStream":
         return self
 
-    async def __anext__(self) -> tuple[bool, bytes]:
+    def poll(self) -> Optional[tuple[bool, memoryview]]:
+        """Gets the next frame if it is already buffered, without waiting."""
+        aes = self.aes_context
+        if self.stats is None or aes is None:
+            return self.buffer.poll_frame(aes, self.stream_large)
+
+        start = time.perf_counter()
+        res = self.buffer.poll_frame(aes, self.stream_large)
+        if res is not None and res[0]:
+            self.stats.decrypt.observe(time.perf_counter() - start)
+
+        return res
+
+    async def __anext__(self) -> tuple[bool, memoryview]:
         while True:
             # If a frame is ready to be consumed, return it.
-            if frame := self.buffer.poll_frame(self.aes_context):
+            if frame := self.poll():
                 return frame
 
             # Otherwise, wait for more stream data and try again.
             with trio.fail_after(TIMEOUT):
                 data = await self._stream.__anext__()
+                self.received_at = time.perf_counter()
                 self.buffer.feed(data)
+
+            if (stats := self.stats) is not None:
+                stats.received += len(data)
+                stats.high_water = max(stats.high_water, self.buffer.buf_len)
@@ -0,0 +1,178 @@
+import time
+from typing import Optional, Union
+
+import trio
+
+from wizproxy.crypto import AesContext
+from wizproxy.metrics import StreamStats
+from wizproxy.proto import Frame
+from wizproxy.session import Session
+from wizproxy.tracing import Trace
+
+# Upper bound for how long a frame may wait for others to be batched with it.
+MAX_DELAY = 0.001
+
+# Upper bound for the amount of frame data to accumulate before a flush.
+MAX_BYTES = 0x10000
+
+
+def _stamp(traces: list[Trace]):
+    now = time.perf_counter()
+    for trace in traces:
+        trace.times.append(now)
+
+
+class FrameWriter:
+    """
+    Coalesces outgoing frames into as few socket writes as possible.
+
+    Frames are accumulated until :meth:`flush` is called, which is
+    meant to happen when no more received frames are buffered. The
+    whole batch is then encrypted in one go and sent with a single
+    call to :meth:`trio.SocketStream.send_all`.
+
+    Since AES-GCM is used as a stream cipher with nonce rotations
+    after a fixed number of bytes, encrypting a batch yields the
+    same output as encrypting each frame individually.
+
+    Traces passed along with frames are stamped when their batch is
+    flushed, encrypted and sent.
+
+    :param stream: The stream to write frames to.
+    :param session: The session to get the AES context from.
+    :param client: Whether this writes data that was sent by the client.
+    :param max_delay: Seconds after which a pending batch is flushed early.
+    :param max_bytes: Batch size after which a pending batch is flushed early.
+    :param stats: Optionally, where to record encryption times.
+    """
+
+    def __init__(
+        self,
+        stream: trio.SocketStream,
+        session: Session,
+        client: bool,
+        *,
+        max_delay: float = MAX_DELAY,
+        max_bytes: int = MAX_BYTES,
+        stats: Optional[StreamStats] = None,
+    ):
+        self._stream = stream
+
+        self.session = session
+        self.client = client
+
+        self.max_delay = max_delay
+        self.max_bytes = max_bytes
+        self.stats = stats
+
+        # Frames are copied into one reusable buffer until they are sent.
+        self._batch = bytearray()
+        self._pending_len = 0
+        self._encrypted = False
+        self._since = 0.0
+
+        self._traces: list[Trace] = []
+
+    @property
+    def aes_context(self) -> Optional[AesContext]:
+        if self.client:
+            return self.session.client_aes
+        else:
+            return self.session.server_aes
+
+    async def _begin(self, encrypted: bool):
+        # A batch is either entirely encrypted or entirely plaintext.
+        if self._pending_len and encrypted != self._encrypted:
+            await self.flush()
+
+        if not self._pending_len:
+            self._encrypted = encrypted
+            self._since = trio.current_time()
+
+    async def _added(self, trace: Optional[Trace]):
+        if trace is not None:
+            self._traces.append(trace)
+
+        # Don't hold back frames for too long when more keep coming in.
+        if (
+            self._pending_len >= self.max_bytes
+            or trio.current_time() - self._since >= self.max_delay
+        ):
+            await self.flush()
+
+    async def write(
+        self,
+        encrypted: bool,
+        raw: Union[bytes, memoryview],
+        trace: Optional[Trace] = None,
+    ):
+        # Data too large for a batch is sent on its own without copying.
+        if len(raw) >= self.max_bytes:
+            await self.flush()
+            await self._send(encrypted, raw, [] if trace is None else [trace])
+            return
+
+        await self._begin(encrypted)
+
+        start = self._pending_len
+        end = start + len(raw)
+        if len(self._batch) < end:
+            self._batch.extend(bytes(end - len(self._batch)))
+
+        self._batch[start:end] = raw
+        self._pending_len = end
+
+        await self._added(trace)
+
+    async def write_frame(
+        self, encrypted: bool, frame: Frame, trace: Optional[Trace] = None
+    ):
+        """Serializes a changed frame straight into the pending batch."""
+        await self._begin(encrypted)
+
+        self._pending_len += frame.write_into(self._batch, self._pending_len)
+        if trace is not None:
+            trace.mark()
+
+        await self._added(trace)
+
+    async def flush(self):
+        if not self._pending_len:
+            return
+
+        pending_len, self._pending_len = self._pending_len, 0
+        traces, self._traces = self._traces, []
+
+        # The buffer can only be resized again once it is not viewed,
+        # so the views are released even when sending fails.
+        with memoryview(self._batch) as view, view[:pending_len] as raw:
+            await self._send(self._encrypted, raw, traces)
+
+        # Don't keep the memory of unusually large frames around.
+        if len(self._batch) > 2 * self.max_bytes:
+            self._batch = bytearray()
+
+    async def _send(
+        self,
+        encrypted: bool,
+        raw: Union[bytes, memoryview],
+        traces: list[Trace],
+    ):
+        if traces:
+            _stamp(traces)
+
+        # Encrypt the frame data, if necessary.
+        if encrypted:
+            if self.stats is None:
+                raw = self.aes_context.encrypt(raw)
+            else:
+                start = time.perf_counter()
+                raw = self.aes_context.encrypt(raw)
+                self.stats.encrypt.observe(time.perf_counter() - start)
+
+        if traces:
+            _stamp(traces)
+            await self._stream.send_all(raw)
+            _stamp(traces)
+        else:
+            await self._stream.send_all(raw)
@@ -1,3 +1,4 @@
+import os
 import sys
 import tempfile
 import zlib
@@ -122,3 +123,222 @@ def test_data_make_wad():
             new_data = new.read()
 
             assert zlib.crc32(old_data) == zlib.crc32(new_data)
+
+
+def test_data_extract_all_workers():
+    with tempfile.TemporaryDirectory(ignore_cleanup_errors=True) as temp_dir:
+        temp_dir = Path(temp_dir)
+
+        source = temp_dir / "source"
+        (source / "nested" / "deeper").mkdir(parents=True)
+
+        # large enough to be streamed in several pieces
+        (source / "nested" / "deeper" / "large.txt").write_bytes(
+            b"".join(b"line %d\n" % i for i in range(500_000))
+        )
+        (source / "nested" / "song.mp3").write_bytes(bytes(range(256)) * 64)
+        (source / "text.txt").write_bytes(b"some text")
+        (source / "empty.txt").write_bytes(b"")
+
+        wad = wizwad.Wad.from_full_add(
+            source, temp_dir / "Wad.wad", workers=get_worker_count()
+        )
+
+        serial = temp_dir / "serial"
+        parallel = temp_dir / "parallel"
+        wad.extract_all(serial)
+        wad.extract_all(parallel, workers=4)
+
+        for name in wad.name_list():
+            expected = (source / name).read_bytes()
+
+            assert (serial / name).read_bytes() == expected
+            assert (parallel / name).read_bytes() == expected
+
+        wad.close()
+
+
+def test_data_make_wad_workers():
+    with tempfile.TemporaryDirectory(ignore_cleanup_errors=True) as temp_dir:
+        temp_dir = Path(temp_dir)
+
+        source = temp_dir / "source"
+        for index in range(50):
+            file = source / f"directory_{index % 5}" / f"file_{index}.txt"
+            file.parent.mkdir(parents=True, exist_ok=True)
+            file.write_bytes(b"data %d\n" % index * (index * 100))
+
+        wads = [
+            wizwad.Wad.from_full_add(
+                source, temp_dir / f"Wad{workers}.wad", workers=workers, wad_version=2
+            )
+            for workers in (1, 3, get_worker_count())
+        ]
+
+        data = [wad.file_path.read_bytes() for wad in wads]
+        assert data[0] == data[1] == data[2]
+
+        for name in wads[0].name_list():
+            assert wads[0].read(name) == (source / name).read_bytes()
+
+        for wad in wads:
+            wad.close()
+
+
+def test_data_incremental_add():
+    with tempfile.TemporaryDirectory(ignore_cleanup_errors=True) as temp_dir:
+        temp_dir = Path(temp_dir)
+
+        source = temp_dir / "source"
+        for index in range(20):
+            file = source / f"directory_{index % 3}" / f"file_{index}.txt"
+            file.parent.mkdir(parents=True, exist_ok=True)
+            file.write_bytes(b"data %d\n" % index * 1000)
+
+        # packed with a different level so reused entries can be told apart
+        base = wizwad.Wad.from_full_add(
+            source, temp_dir / "Base.wad", compression_level=1, wad_version=2
+        )
+        base.close()
+
+        (source / "directory_1" / "file_4.txt").write_bytes(b"changed")
+        (source / "directory_2" / "new.txt").write_bytes(b"new")
+        (source / "directory_0" / "file_3.txt").unlink()
+
+        # touched but unchanged files are compared by content
+        touched = source / "directory_2" / "file_5.txt"
+        mtime = base.file_path.stat().st_mtime + 10
+        os.utime(touched, (mtime, mtime))
+
+        wad = wizwad.Wad.from_incremental_add(
+            base.file_path, source, temp_dir / "Wad.wad", wad_version=2
+        )
+        full = wizwad.Wad.from_full_add(
+            source, temp_dir / "Full.wad", compression_level=1, wad_version=2
+        )
+
+        assert wad.name_list() == full.name_list()
+        for name in wad.name_list():
+            assert wad.read(name) == (source / name).read_bytes()
+
+        # unchanged entries are copied over, changed ones are recompressed
+        changed = {"directory_1/file_4.txt", "directory_2/new.txt"}
+        for new_entry, full_entry in zip(wad.info_list(), full.info_list()):
+            if new_entry.name in changed:
+                assert new_entry.zipped_size <= full_entry.zipped_size
+            else:
+                assert new_entry.crc == full_entry.crc
+
+        wad.close()
+        full.close()
+
+        before = wad.file_path.read_bytes()
+
+        # rebuilding in place reuses every entry and keeps the wad version
+        in_place = wizwad.Wad.from_incremental_add(temp_dir / "Wad.wad", source)
+        in_place.close()
+
+        assert in_place.version == 2
+        assert wad.file_path.read_bytes() == before
+        assert not (temp_dir / "Wad.wad.partial").exists()
+
+
+def test_data_wad_index():
+    test_data = get_test_data_dir()
+
+    with tempfile.TemporaryDirectory(ignore_cleanup_errors=True) as temp_dir:
+        temp_dir = Path(temp_dir)
+
+        game_data = temp_dir / "GameData"
+        game_data.mkdir()
+
+        wizwad.Wad.from_full_add(test_data, game_data / "First.wad").close()
+        wizwad.Wad.from_full_add(
+            test_data / "directory_with_files", game_data / "Second.wad"
+        ).close()
+
+        with wizwad.WadIndex(temp_dir / "index.sqlite3", game_data) as index:
+            assert index.refresh() == 2
+            assert index.refresh() == 0
+
+            [text] = index.find("text.txt")
+            assert text.wad == game_data / "First.wad"
+            assert index.read(text) == (test_data / "text.txt").read_bytes()
+
+            assert [file.wad.name for file in index.find("more_text.txt")] == [
+                "Second.wad"
+            ]
+            assert [file.info.name for file in index.find_prefix("directory_")] == [
+                "directory_with_files/more_text.txt"
+            ]
+            assert len(index.glob("*.txt")) == 3
+            assert index.find("missing") == []
+
+        (game_data / "Second.wad").unlink()
+        wizwad.Wad.from_full_add(
+            test_data / "directory_with_files", game_data / "Third.wad"
+        ).close()
+
+        # the index is kept on disk and only updated for changed wads
+        with wizwad.WadIndex(temp_dir / "index.sqlite3", game_data) as index:
+            assert index.refresh() == 1
+
+            [more_text] = index.find("more_text.txt")
+            assert more_text.wad == game_data / "Third.wad"
+
+            # reads through a stale index are refused until it is refreshed
+            wizwad.Wad.from_full_add(
+                test_data, game_data / "Third.wad", overwrite=True
+            ).close()
+            with pytest.raises(RuntimeError):
+                index.read(more_text)
+
+            assert index.refresh() == 1
+
+            _, text = index.find("text.txt")
+            assert text.wad == game_data / "Third.wad"
+            assert index.read(text) == (test_data / "text.txt").read_bytes()
+
+
+def test_data_read_view_and_cache():
+    with tempfile.TemporaryDirectory(ignore_cleanup_errors=True) as temp_dir:
+        temp_dir = Path(temp_dir)
+
+        source = temp_dir / "source"
+        source.mkdir()
+        (source / "song.mp3").write_bytes(b"stored" * 100)
+        for name in ("a.txt", "b.txt", "c.txt"):
+            (source / name).write_bytes(name.encode() * 100)
+
+        wizwad.Wad.from_full_add(source, temp_dir / "Wad.wad").close()
+
+        # room for two of the 500 byte files
+        wad = wizwad.Wad(temp_dir / "Wad.wad", cache_size=1000)
+
+        view = wad.read_view("song.mp3")
+        assert view is not None and view.readonly
+        assert view == (source / "song.mp3").read_bytes()
+        view.release()
+
+        for name in ("a.txt", "b.txt", "a.txt", "c.txt", "b.txt"):
+            assert wad.read(name) == (source / name).read_bytes()
+
+        # b was evicted by c since a was used more recently
+        assert (wad.cache_hits, wad.cache_misses) == (1, 4)
+
+        assert wad.read_view("a.txt") == (source / "a.txt").read_bytes()
+        assert wad.read("song.mp3") == (source / "song.mp3").read_bytes()
+        assert (wad.cache_hits, wad.cache_misses) == (1, 5)
+
+        # a held view keeps the wad open
+        view = wad.read_view("song.mp3")
+        assert view is not None
+        with pytest.raises(BufferError):
+            wad.close()
+
+        assert not wad.closed
+        assert view == (source / "song.mp3").read_bytes()
+
+        view.release()
+        wad.close()
+        assert wad.closed
@@ -1,9 +1,10 @@
 import logging
 
+from .index import IndexedFile, WadIndex
 from .wad import Wad, WadFileInfo
 
 logging.getLogger(__name__).addHandler(logging.NullHandler())
 
 del logging
 
-__all__ = ["Wad", "WadFileInfo"]
+__all__ = ["IndexedFile", "Wad", "WadFileInfo", "WadIndex"]
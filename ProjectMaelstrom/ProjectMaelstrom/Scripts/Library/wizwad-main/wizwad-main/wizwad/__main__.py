@@ -1,9 +1,12 @@
+import hashlib
 import logging
+import os
 import sys
 from pathlib import Path
 
 import click
 
+from .index import WadIndex
 from .wad import Wad
 
 logging.getLogger("wizwad").addHandler(logging.StreamHandler())
@@ -16,6 +19,25 @@ def _get_recommended_workers() -> int:
     return 100
 
 
+def _default_index_path(wad_dir: Path) -> Path:
+    """
+    an index per wad directory in the user's cache directory
+    """
+    if sys.platform == "win32":
+        cache_dir = Path(os.environ.get("LOCALAPPDATA", Path.home()))
+    elif sys.platform == "darwin":
+        cache_dir = Path.home() / "Library" / "Caches"
+    else:
+        cache_dir = Path(os.environ.get("XDG_CACHE_HOME", Path.home() / ".cache"))
+
+    key = hashlib.sha1(str(wad_dir.resolve()).encode()).hexdigest()[:16]
+
+    index_dir = cache_dir / "wizwad"
+    index_dir.mkdir(parents=True, exist_ok=True)
+
+    return index_dir / f"index_{key}.sqlite3"
+
+
 @click.group()
 def main():
     """
@@ -31,13 +53,23 @@ def main():
 @click.argument(
     "output_dir", type=click.Path(file_okay=False, path_type=Path), default="."
 )
-def extract(input_wad: Path, output_dir: Path):
+@click.option(
+    "--workers",
+    type=int,
+    default=8,
+    help="the number of threads to decompress files with",
+)
+def extract(input_wad: Path, output_dir: Path, workers: int):
     """
     Extract the content of a wad to <output_dir> which defaults to the current directory
     """
+    if workers <= 0:
+        click.echo("workers must be greater than 0")
+        exit(1)
+
     wad = Wad(input_wad)
     click.echo("Extracting")
-    wad.extract_all(output_dir)
+    wad.extract_all(output_dir, workers=workers)
 
 
 @main.command()
@@ -49,7 +81,21 @@ def extract(input_wad: Path, output_dir: Path):
     default=False,
     help="overwrite a wad if there already is one",
 )
-@click.option("--wad-version", type=int, default=1, help="the wad version to use")
+@click.option(
+    "--incremental",
+    is_flag=True,
+    default=False,
+    help=(
+        "only compress files that changed since target_wad was packed; "
+        "replaces target_wad without needing --overwrite"
+    ),
+)
+@click.option(
+    "--wad-version",
+    type=int,
+    help="the wad version to use; defaults to 1, or to the version of "
+    "target_wad with --incremental",
+)
 @click.option(
     "--workers",
     type=int,
@@ -66,14 +112,17 @@ def pack(
     target_wad: Path,
     content_to_add: Path,
     overwrite: bool,
-    wad_version: int,
+    incremental: bool,
+    wad_version: int | None,
     workers: int,
     compression_level: int,
 ):
     """
     Pack a directory into <target_wad>
     """
-    if wad_version == 1 and target_wad.name == "Root.wad":
+    rebuild = incremental and target_wad.exists()
+
+    if not rebuild and wad_version in (None, 1) and target_wad.name == "Root.wad":
         click.echo("You may wish to use --wad-version 2 for Root.wad")
 
     recommended_workers = _get_recommended_workers()
@@ -90,14 +139,50 @@ def pack(
         click.echo("compression level must be 1-9")
         exit(1)
 
+    if rebuild:
+        Wad.from_incremental_add(
+            target_wad,
+            content_to_add,
+            wad_version=wad_version,
+            workers=workers,
+            compression_level=compression_level,
+        ).close()
+        return
+
     Wad.from_full_add(
         content_to_add,
         target_wad,
         overwrite=overwrite,
+        wad_version=1 if wad_version is None else wad_version,
         compression_level=compression_level,
     )
 
 
+@main.command()
+@click.argument(
+    "wad_dir", type=click.Path(exists=True, file_okay=False, path_type=Path)
+)
+@click.argument("pattern")
+@click.option(
+    "--index",
+    type=click.Path(dir_okay=False, path_type=Path),
+    help="where to keep the index, it is updated for changed wads; "
+    "defaults to one per wad_dir in the user cache directory",
+)
+def find(wad_dir: Path, pattern: str, index: Path | None):
+    """
+    List the files matching a glob <pattern> in all wads of <wad_dir>
+    """
+    if index is None:
+        index = _default_index_path(wad_dir)
+
+    with WadIndex(index, wad_dir) as wad_index:
+        wad_index.refresh()
+
+        for file in wad_index.glob(pattern):
+            click.echo(f"{file.wad.name}: {file.info.name}")
+
+
 @main.command(name="list")
 @click.argument(
     "wad_to_list", type=click.Path(path_type=Path, exists=True, dir_okay=False)
@@ -0,0 +1,214 @@
+import logging
+import os
+import sqlite3
+import struct
+import zlib
+from dataclasses import dataclass
+from pathlib import Path
+from typing import List, Union
+
+from .wad import Wad, WadFileInfo
+
+# upper bound for any name that starts with a given prefix
+_PREFIX_END = "\U0010ffff"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS wads (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS files (
+    name TEXT NOT NULL,
+    wad INTEGER NOT NULL REFERENCES wads (id) ON DELETE CASCADE,
+    offset INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    zipped_size INTEGER NOT NULL,
+    is_zip INTEGER NOT NULL,
+    crc INTEGER NOT NULL,
+    PRIMARY KEY (name, wad)
+) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS files_wad ON files (wad);
+"""
+
+_SELECT = """
+SELECT wads.name, files.name, offset, files.size, zipped_size, is_zip, crc
+FROM files JOIN wads ON wads.id = files.wad
+"""
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class IndexedFile:
+    wad: Path
+    info: WadFileInfo
+
+
+class WadIndex:
+    """
+    Persistent index of the files in every wad of a directory, e.g. GameData
+
+    Lookups don't need to open any wad. Call refresh to bring the index up to
+    date; only wads whose size or mtime changed since are read again.
+    """
+
+    def __init__(self, index_path: Union[Path, str], wad_dir: Union[Path, str]):
+        self.index_path = Path(index_path)
+        self.wad_dir = Path(wad_dir)
+
+        self._connection = sqlite3.connect(self.index_path)
+        self._connection.execute("PRAGMA foreign_keys = ON")
+        self._connection.executescript(_SCHEMA)
+
+    def __repr__(self):
+        return f"<WadIndex {self.wad_dir=}>"
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_: object):
+        self.close()
+
+    def close(self):
+        self._connection.close()
+
+    def refresh(self) -> int:
+        """
+        Index new and changed wads and forget removed ones
+
+        Returns:
+            number of wads that were (re)indexed
+        """
+        indexed = {
+            name: (wad_id, size, mtime_ns)
+            for wad_id, name, size, mtime_ns in self._connection.execute(
+                "SELECT id, name, size, mtime_ns FROM wads"
+            )
+        }
+        refreshed = 0
+
+        with self._connection:
+            for wad_path in sorted(self.wad_dir.glob("*.wad")):
+                stat = wad_path.stat()
+                known = indexed.pop(wad_path.name, None)
+
+                if known is not None:
+                    wad_id, size, mtime_ns = known
+                    if (size, mtime_ns) == (stat.st_size, stat.st_mtime_ns):
+                        continue
+
+                    self._connection.execute("DELETE FROM wads WHERE id = ?", (wad_id,))
+
+                if self._index_wad(wad_path, stat.st_size, stat.st_mtime_ns):
+                    refreshed += 1
+
+            for wad_id, _, _ in indexed.values():
+                self._connection.execute("DELETE FROM wads WHERE id = ?", (wad_id,))
+
+        return refreshed
+
+    def _index_wad(self, wad_path: Path, size: int, mtime_ns: int) -> bool:
+        try:
+            with Wad(wad_path) as wad:
+                infos = wad.info_list()
+        # skipped wads are tried again on the next refresh
+        except (OSError, ValueError, struct.error) as error:
+            logger.warning(f'Skipping unreadable wad "{wad_path}": {error}')
+            return False
+
+        cursor = self._connection.execute(
+            "INSERT INTO wads (name, size, mtime_ns) VALUES (?, ?, ?)",
+            (wad_path.name, size, mtime_ns),
+        )
+        wad_id = cursor.lastrowid
+
+        self._connection.executemany(
+            "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (
+                (
+                    info.name,
+                    wad_id,
+                    info.offset,
+                    info.size,
+                    info.zipped_size,
+                    info.is_zip,
+                    info.crc,
+                )
+                for info in infos
+            ),
+        )
+
+        return True
+
+    def _select(self, where: str, *args: str) -> List[IndexedFile]:
+        rows = self._connection.execute(
+            f"{_SELECT} WHERE {where} ORDER BY files.name, wads.name", args
+        )
+
+        return [
+            IndexedFile(
+                self.wad_dir / wad_name,
+                WadFileInfo(name, offset, size, zipped_size, bool(is_zip), crc),
+            )
+            for wad_name, name, offset, size, zipped_size, is_zip, crc in rows
+        ]
+
+    def find(self, name: str) -> List[IndexedFile]:
+        """
+        All wads containing a file with this exact name
+        """
+        return self._select("files.name = ?", name)
+
+    def find_prefix(self, prefix: str) -> List[IndexedFile]:
+        """
+        All files whose name starts with prefix
+        """
+        return self._select(
+            "files.name >= ? AND files.name < ?", prefix, prefix + _PREFIX_END
+        )
+
+    def glob(self, pattern: str) -> List[IndexedFile]:
+        """
+        All files whose name matches a case sensitive glob pattern like "*.xml"
+        """
+        return self._select("files.name GLOB ?", pattern)
+
+    def read(self, file: IndexedFile) -> bytes | None:
+        """
+        Get the data contents of an indexed file without parsing its wad
+
+        Raises RuntimeError if the wad changed since the last refresh.
+        Args:
+            file: the file as returned by a lookup
+        Returns:
+            Bytes of the file or None for "unpatched" dummy files
+        """
+        info = file.info
+
+        with open(file.wad, "rb") as fp:
+            stat = os.fstat(fp.fileno())
+            indexed = self._connection.execute(
+                "SELECT size, mtime_ns FROM wads WHERE name = ?", (file.wad.name,)
+            ).fetchone()
+
+            # offsets of a rewritten wad point at garbage
+            if indexed != (stat.st_size, stat.st_mtime_ns):
+                raise RuntimeError(
+                    f"{file.wad} changed since it was indexed, refresh the index"
+                )
+
+            fp.seek(info.offset)
+            data = fp.read(info.zipped_size if info.is_zip else info.size)
+
+        # unpatched file
+        if data[:4] == b"\x00\x00\x00\x00":
+            return None
+
+        if info.is_zip:
+            data = zlib.decompress(data)
+
+        return data
@@ -1,15 +1,15 @@
 import concurrent.futures
 import logging
+import multiprocessing
 import os
 import struct
 import zlib
+from collections import OrderedDict
 from dataclasses import dataclass
 from io import BytesIO
 from mmap import ACCESS_READ, mmap
 from pathlib import Path
-from typing import Iterator, List, Optional, Union
-
-import more_itertools
+from typing import Any, List, Optional, Union
 
 _NO_COMPRESS = frozenset(
     (
@@ -18,6 +18,15 @@ _NO_COMPRESS = frozenset(
     )
 )
 
+# compressed bytes fed to zlib at once while extracting
+_EXTRACT_READ_SIZE = 0x40000
+# upper bound for decompressed bytes held in memory at once while extracting
+_EXTRACT_WRITE_SIZE = 0x100000
+# packed bytes a batch holds in memory before it waits for its turn to write them
+_PACK_BATCH_SIZE = 0x1000000
+# batches per worker to aim for, so a slow batch doesn't hold up the end
+_PACK_BATCHES_PER_WORKER = 4
+
 logger = logging.getLogger(__name__)
 
 
@@ -32,8 +41,17 @@ class WadFileInfo:
 
 
 class Wad:
+    """
+    A wad file
+
+    Args:
+        file: path to the wad
+        cache_size: bytes of decompressed files to keep around for repeated
+            reads, least recently used first out; 0 disables the cache
+    """
+
     # TODO: allow for `file` that doesnt exist yet
-    def __init__(self, file: Union[Path, str]):
+    def __init__(self, file: Union[Path, str], *, cache_size: int = 0):
         self.file_path = Path(file)
         self.name = self.file_path.stem
 
@@ -44,6 +62,12 @@ class Wad:
         self._size: None | int = None
         self._refreshed_once = False
 
+        self.cache_size = cache_size
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self._cache: OrderedDict[str, bytes] = OrderedDict()
+        self._cache_used = 0
+
         self._refresh_journal()
 
     @property
@@ -90,8 +114,10 @@ class Wad:
         return BytesIO(data)
 
     def close(self):
-        self._file_pointer.close()
+        # raises BufferError while views from read_view are still held,
+        # leaving the wad open
         self._mmap.close()
+        self._file_pointer.close()
 
     def _read(self, start: int, size: int) -> bytes:
         return self._mmap[start: start + size]
@@ -105,13 +131,13 @@ class Wad:
         # WAD id string
         file_offset = 5
 
-        version, file_num = struct.unpack(
+        self.version, file_num = struct.unpack(
             "<ll", self._mmap[file_offset: file_offset + 8]
         )
 
         file_offset += 8
 
-        if version >= 2:
+        if self.version >= 2:
             file_offset += 1
 
         for _ in range(file_num):
@@ -143,17 +169,70 @@ class Wad:
         target_file = self.get_info(name)
 
         if target_file.is_zip:
-            data = self._read(target_file.offset, target_file.zipped_size)
+            return self._decompress(target_file)
 
-        else:
-            data = self._read(target_file.offset, target_file.size)
+        data = self._read(target_file.offset, target_file.size)
 
         # unpatched file
         if data[:4] == b"\x00\x00\x00\x00":
             return None
 
+        return data
+
+    def read_view(self, name: str) -> Optional[memoryview]:
+        """
+        Get the data contents of the named file without copying stored files
+
+        Stored files are viewed directly in the wad's mmap, so all of their
+        views have to be released before the wad can be closed.
+        Args:
+            name: name of the file to get
+        Returns:
+            A read-only view of the file or None for "unpatched" dummy files
+        """
+        target_file = self.get_info(name)
+
         if target_file.is_zip:
-            data = zlib.decompress(data)
+            data = self._decompress(target_file)
+            return None if data is None else memoryview(data)
+
+        with memoryview(self._mmap) as view:
+            data_view = view[target_file.offset : target_file.offset + target_file.size]
+
+        # unpatched file
+        if data_view[:4] == b"\x00\x00\x00\x00":
+            data_view.release()
+            return None
+
+        return data_view
+
+    def _decompress(self, target_file: WadFileInfo) -> Optional[bytes]:
+        if self.cache_size:
+            cached = self._cache.get(target_file.name)
+
+            if cached is not None:
+                self._cache.move_to_end(target_file.name)
+                self.cache_hits += 1
+                return cached
+
+            self.cache_misses += 1
+
+        start = target_file.offset
+        with memoryview(self._mmap) as view:
+            with view[start : start + target_file.zipped_size] as compressed:
+                # unpatched file
+                if compressed[:4] == b"\x00\x00\x00\x00":
+                    return None
+
+                data = zlib.decompress(compressed)
+
+        if self.cache_size and len(data) <= self.cache_size:
+            self._cache[target_file.name] = data
+            self._cache_used += len(data)
+
+            while self._cache_used > self.cache_size:
+                _, evicted = self._cache.popitem(last=False)
+                self._cache_used -= len(evicted)
 
         return data
 
@@ -175,51 +254,63 @@ class Wad:
 
         return target_file
 
-    def extract_all(self, path: Union[Path, str]):
+    def extract_all(self, path: Union[Path, str], *, workers: int = 1):
         """
         Extract a wad file into a directory
 
         Args:
             path: source_path to the directory to unpack the wad
+            workers: number of threads to extract files with; zlib releases
+                the GIL so decompression runs in parallel
         """
         path = Path(path)
 
-        self._extract_all(path)
+        self._extract_all(path, workers)
 
-    def _extract_all(self, path: Path):
+    def _extract_all(self, path: Path, workers: int = 1):
         # we need to resolve both since `path` may have symlinks in it
         # and the previous .resolve would have resolved these
         path = path.resolve()
 
-        with open(self.file_path, "rb") as fp:
-            with mmap(fp.fileno(), 0, access=ACCESS_READ) as mm:
-                for file in self._file_map.values():
-                    file_path = (path / file.name).resolve()
+        targets: list[tuple[WadFileInfo, Path]] = []
+        directories: set[Path] = set()
+
+        for file in self._file_map.values():
+            file_path = (path / file.name).resolve()
 
-                    if not file_path.is_relative_to(path):
-                        raise RuntimeError(
-                            f"Escaping path detected: {file.name} -> {file_path}"
-                        )
+            if not file_path.is_relative_to(path):
+                raise RuntimeError(
+                    f"Escaping path detected: {file.name} -> {file_path}"
+                )
+
+            targets.append((file, file_path))
+            directories.add(file_path.parent)
 
-                    file_path.parent.mkdir(parents=True, exist_ok=True)
+        # create the whole tree up front so extracting only writes files
+        for directory in sorted(directories):
+            directory.mkdir(parents=True, exist_ok=True)
 
-                    if file.is_zip:
-                        data = mm[file.offset : file.offset + file.zipped_size]
+        with open(self.file_path, "rb") as fp:
+            with mmap(fp.fileno(), 0, access=ACCESS_READ) as mm:
+                if workers <= 1:
+                    for file, file_path in targets:
+                        _extract_file(mm, file, file_path)
 
-                    else:
-                        data = mm[file.offset : file.offset + file.size]
+                    return
 
-                    # TODO: why don't we just write a file full of zeros instead of an empty file
-                    # unpatched file
-                    if data[:4] == b"\x00\x00\x00\x00":
-                        logger.warning(f'Touching unpatched file "{file.name}"')
-                        file_path.touch()
-                        continue
+                # largest first so a big file doesn't hold up the end
+                targets.sort(key=lambda target: target[0].size, reverse=True)
 
-                    if file.is_zip:
-                        data = zlib.decompress(data)
+                with concurrent.futures.ThreadPoolExecutor(
+                    max_workers=workers
+                ) as executor:
+                    futures = [
+                        executor.submit(_extract_file, mm, file, file_path)
+                        for file, file_path in targets
+                    ]
 
-                    file_path.write_bytes(data)
+                    for future in futures:
+                        future.result()
 
     @classmethod
     def from_full_add(
@@ -252,6 +343,81 @@ class Wad:
         )
         return cls(new_wad_name)
 
+    @classmethod
+    def from_incremental_add(
+        cls,
+        base_wad: Path | str,
+        source_path: Path | str,
+        new_wad_name: Path | str | None = None,
+        *,
+        overwrite: bool = False,
+        wad_version: int | None = None,
+        workers: int = 10,
+        compression_level: int = 9,
+    ):
+        """
+        Rebuild a wad from a directory, only compressing files that changed
+
+        A file is unchanged if it has the same size as its entry in `base_wad`
+        and was either last modified before `base_wad` or has the same contents.
+        Unchanged entries are copied over verbatim, so they keep the
+        compression level they were packed with. Like with make, a same-sized
+        edit made before `base_wad` was last written goes unnoticed.
+
+        Args:
+            base_wad: the wad to reuse entries from
+            source_path: the directory to pack
+            new_wad_name: where to write the new wad, defaults to replacing base_wad
+            wad_version: the wad version to use, defaults to the one of base_wad
+        """
+        if isinstance(base_wad, str):
+            base_wad = Path(base_wad)
+
+        if isinstance(source_path, str):
+            source_path = Path(source_path)
+
+        if not source_path.is_dir():
+            if not source_path.exists():
+                raise FileNotFoundError(source_path)
+
+            raise ValueError(f"{source_path} is not a directory.")
+
+        if new_wad_name is None:
+            new_wad_name = base_wad
+
+        elif isinstance(new_wad_name, str):
+            new_wad_name = Path(new_wad_name)
+
+        if (
+            not overwrite
+            and new_wad_name.exists()
+            and not new_wad_name.samefile(base_wad)
+        ):
+            raise FileExistsError(f"{new_wad_name} already exists.")
+
+        # base_wad is still read while writing, and may be the target
+        partial = new_wad_name.with_name(new_wad_name.name + ".partial")
+
+        try:
+            with cls(base_wad) as base:
+                if wad_version is None:
+                    wad_version = base.version
+
+                cls._insert_all_fast(
+                    source_path,
+                    partial,
+                    wad_version,
+                    workers,
+                    compression_level,
+                    base,
+                )
+
+            os.replace(partial, new_wad_name)
+        finally:
+            partial.unlink(missing_ok=True)
+
+        return cls(new_wad_name)
+
     @staticmethod
     def _insert_all_fast(
         source_path: Path,
@@ -259,6 +425,7 @@ class Wad:
         wad_version: int = 1,
         workers: int = 100,
         compression_level: int = 9,
+        base: Optional["Wad"] = None,
     ):
         to_write: list[Path] = []
         source_path_string = str(source_path)
@@ -285,95 +452,289 @@ class Wad:
         if wad_version == 1:
             journal_size -= 1
 
-        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
-            futures: list[concurrent.futures.Future[tuple[int, BytesIO, list[WadFileInfo]]]] = []
+        # the journal is written last, once every entry's offset is known
+        with open(output_path, "wb+") as fp:
+            fp.truncate(journal_size)
+
+        # consecutive files are packed in batches, so that tasks and writes
+        # are not per file
+        batch_len = -(-file_num // (workers * _PACK_BATCHES_PER_WORKER)) or 1
+        batches = [
+            to_write[start : start + batch_len]
+            for start in range(0, file_num, batch_len)
+        ]
+
+        # batches take turns to get their offsets strictly in name order.
+        # tasks are picked up in submission order, so at most `workers`
+        # consecutive batches are in progress and each has its own turn
+        turns = [multiprocessing.Semaphore(0) for _ in range(workers)]
+        turns[0].release()
+
+        # only the batch whose turn it is touches this
+        next_offset = multiprocessing.Value("q", journal_size, lock=False)
+
+        if base is None:
+            base_path, base_mtime, base_infos = None, 0.0, {}
+        else:
+            base_path = base.file_path
+            base_mtime = base_path.stat().st_mtime
+            base_infos = base._file_map
+
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=_init_writer,
+            initargs=(
+                source_path,
+                output_path,
+                compression_level,
+                turns,
+                next_offset,
+                base_path,
+                base_mtime,
+                base_infos,
+            ),
+        ) as executor:
+            futures = [
+                executor.submit(_write_batch, index, batch)
+                for index, batch in enumerate(batches)
+            ]
+
+            infos = [info for future in futures for info in future.result()]
+
+        with open(output_path, "r+b") as fp:
+            # magic bytes
+            fp.write(b"KIWAD")
+
+            fp.write(struct.pack("<ll", wad_version, file_num))
+
+            if wad_version >= 2:
+                # version 2 thing
+                fp.write(b"\x01")
+
+            for info in infos:
+                fp.write(
+                    struct.pack(
+                        "<lll?Ll",
+                        info.offset,
+                        info.size,
+                        info.zipped_size,
+                        info.is_zip,
+                        info.crc,
+                        len(info.name) + 1,
+                    )
+                )
+
+                # only / paths are allowed
+                fp.write(info.name.encode() + b"\x00")
+
+
+def _extract_file(mm: mmap, file: WadFileInfo, file_path: Path):
+    """
+    streams a single file out of a wad's mmap without holding all of it in memory
+    """
+    size = file.zipped_size if file.is_zip else file.size
+
+    # TODO: why don't we just write a file full of zeros instead of an empty file
+    # unpatched file
+    if mm[file.offset : file.offset + min(size, 4)] == b"\x00\x00\x00\x00":
+        logger.warning(f'Touching unpatched file "{file.name}"')
+        file_path.touch()
+        return
+
+    with (
+        open(file_path, "wb") as fp,
+        memoryview(mm) as view,
+        view[file.offset : file.offset + size] as data,
+    ):
+        if not file.is_zip:
+            fp.write(data)
+            return
 
-            for chunk in more_itertools.divide(workers, to_write):
-                futures.append(
-                    executor.submit(
-                        _calculate_chunk, chunk, 0, source_path, compression_level
+        decompressor = zlib.decompressobj()
+
+        for start in range(0, size, _EXTRACT_READ_SIZE):
+            with data[start : start + _EXTRACT_READ_SIZE] as chunk:
+                fp.write(decompressor.decompress(chunk, _EXTRACT_WRITE_SIZE))
+
+            while decompressor.unconsumed_tail:
+                fp.write(
+                    decompressor.decompress(
+                        decompressor.unconsumed_tail, _EXTRACT_WRITE_SIZE
                     )
                 )
 
-            with open(output_path, "wb+") as fp:
-                data_block = BytesIO()
+        fp.write(decompressor.flush())
 
-                chunk_offset = journal_size
 
-                # magic bytes
-                fp.write(b"KIWAD")
+# state of a writer process, set by _init_writer
+_writer: dict[str, Any] = {}
 
-                fp.write(struct.pack("<ll", wad_version, file_num))
 
-                if wad_version >= 2:
-                    # version 2 thing
-                    fp.write(b"\x01")
+# has to be defined here
+def _init_writer(
+    source: Path,
+    output_path: Path,
+    compression_level: int,
+    turns: list[Any],
+    next_offset: Any,
+    base_path: Optional[Path],
+    base_mtime: float,
+    base_infos: dict[str, WadFileInfo],
+):
+    base = None
+    if base_path is not None:
+        with open(base_path, "rb") as fp:
+            base = mmap(fp.fileno(), 0, access=ACCESS_READ)
+
+    _writer.update(
+        source=source,
+        output=open(output_path, "r+b"),
+        compression_level=compression_level,
+        turns=turns,
+        next_offset=next_offset,
+        base=base,
+        base_mtime=base_mtime,
+        base_infos=base_infos,
+    )
 
-                for future in futures:
-                    end, buffer, infos = future.result()
 
-                    for info in infos:
-                        fp.write(
-                            struct.pack(
-                                "<lll?Ll",
-                                info.offset + chunk_offset,  # 0 for first chunk
-                                info.size,
-                                info.zipped_size,
-                                info.is_zip,
-                                info.crc,
-                                len(info.name) + 1,
-                            )
-                        )
+def _reserve(size: int) -> int:
+    """
+    reserves `size` bytes at the end of the wad; only call this during a turn
+    """
+    next_offset = _writer["next_offset"]
 
-                        # only / paths are allowed
-                        fp.write(info.name.encode() + b"\x00")
+    offset = next_offset.value
+    next_offset.value += size
 
-                    chunk_offset += end
+    return offset
 
-                    buffer.seek(0)
-                    data_block.write(buffer.getvalue())
 
-                data_block.seek(0)
-                fp.write(data_block.getvalue())
+def _stored(info: WadFileInfo) -> memoryview:
+    """
+    the data of an entry as it is stored in the base wad
+    """
+    size = info.zipped_size if info.is_zip else info.size
+    return memoryview(_writer["base"])[info.offset : info.offset + size]
 
 
-# has to be defined here
-def _calculate_chunk(
-    files: Iterator[Path],
-    start: int,
-    source: Path,
-    compression_level: int = 9,
-) -> tuple[int, BytesIO, list[WadFileInfo]]:
+def _unchanged(file: Path, info: WadFileInfo) -> bool:
     """
-    returns end offset, data block, and journal entries
+    checks if a file still has the contents of its entry in the base wad
     """
-    current_offset = start
-    data_buffer = BytesIO()
-    journal_entries: list[WadFileInfo] = []
-
-    for file in files:
-        is_zip = file.suffix not in _NO_COMPRESS
-        data = (source / file).read_bytes()
-        size = len(data)
-        name = file.as_posix()
-
-        if is_zip:
-            # this is where 90% of processing time is spent
-            compressed_data = zlib.compress(data, level=compression_level)
-            zipped_size = len(compressed_data)
-
-            data = compressed_data
-        else:
-            zipped_size = -1
+    stat = file.stat()
+    if stat.st_size != info.size:
+        return False
+
+    # not touched since the base wad was written
+    if stat.st_mtime < _writer["base_mtime"]:
+        return True
 
-        # crc is of compressed data for some reason
-        crc = zlib.crc32(data, 0xFFFF_FFFF) ^ 0xFFFF_FFFF
+    # this is still a lot cheaper than compressing it again
+    data = file.read_bytes()
+    with _stored(info) as stored:
+        if not info.is_zip:
+            return zlib.crc32(data, 0xFFFF_FFFF) ^ 0xFFFF_FFFF == info.crc
 
-        journal_entries.append(
-            WadFileInfo(name, current_offset, size, zipped_size, is_zip, crc)
+        try:
+            return zlib.decompress(stored) == data
+        # unpatched file
+        except zlib.error:
+            return False
+
+
+def _pack_entry(file: Path) -> tuple[bytes | memoryview, WadFileInfo]:
+    """
+    compresses a file, or reuses its entry in the base wad, leaving its offset 0
+    """
+    name = file.as_posix()
+    base_info = _writer["base_infos"].get(name)
+
+    if base_info is not None and _unchanged(_writer["source"] / file, base_info):
+        return _stored(base_info), WadFileInfo(
+            name,
+            0,
+            base_info.size,
+            base_info.zipped_size,
+            base_info.is_zip,
+            base_info.crc,
         )
 
-        current_offset += len(data)
-        data_buffer.write(data)
+    is_zip = file.suffix not in _NO_COMPRESS
+    data = (_writer["source"] / file).read_bytes()
+    size = len(data)
+
+    if is_zip:
+        # this is where 90% of processing time is spent
+        data = zlib.compress(data, level=_writer["compression_level"])
+        zipped_size = len(data)
+    else:
+        zipped_size = -1
+
+    # crc is of compressed data for some reason
+    crc = zlib.crc32(data, 0xFFFF_FFFF) ^ 0xFFFF_FFFF
+
+    return data, WadFileInfo(name, 0, size, zipped_size, is_zip, crc)
+
+
+def _write_packed(
+    packed: list[tuple[bytes | memoryview, WadFileInfo]],
+) -> list[WadFileInfo]:
+    """
+    writes packed entries back to back at a freshly reserved offset
+    """
+    offset = _reserve(sum(len(data) for data, _ in packed))
+
+    output = _writer["output"]
+    output.seek(offset)
+
+    for data, info in packed:
+        output.write(data)
+
+        info.offset = offset
+        offset += len(data)
+
+        if isinstance(data, memoryview):
+            data.release()
+
+    return [info for _, info in packed]
+
+
+def _write_batch(index: int, files: list[Path]) -> list[WadFileInfo]:
+    """
+    packs a batch of consecutive files and writes them to the wad during the
+    turn of batch `index`
+    """
+    turns = _writer["turns"]
+    infos: list[WadFileInfo] = []
+    packed: list[tuple[bytes | memoryview, WadFileInfo]] = []
+    packed_size = 0
+    has_turn = False
+
+    try:
+        for file in files:
+            data, info = _pack_entry(file)
+            packed.append((data, info))
+            packed_size += len(data)
+
+            # keep the turn once taken, so the rest of the batch follows on
+            if packed_size >= _PACK_BATCH_SIZE:
+                if not has_turn:
+                    turns[index % len(turns)].acquire()
+                    has_turn = True
+
+                infos += _write_packed(packed)
+                packed = []
+                packed_size = 0
+    finally:
+        # the turn has to be taken even on errors so later batches don't wait forever
+        if not has_turn:
+            turns[index % len(turns)].acquire()
+
+        try:
+            infos += _write_packed(packed)
+            _writer["output"].flush()
+        finally:
+            turns[(index + 1) % len(turns)].release()
 
-    return current_offset, data_buffer, journal_entries
+    return infos